@@ -0,0 +1,197 @@
+# Benchmark of the hot routes over synthetic datasets of several sizes, written to a JSON report:
+# python benchmark.py --sizes small medium --repeat 5 --output benchmark.json --compare previous.json
+# Every size runs in its own process with a fresh SQLite database seeded by synthetic_data.py.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+
+BENCHMARK_USER = 'benchmark@example.com'
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def scenarios(project_url, stage_url):
+    # (name, setup requests, measured request), the setup GETs reset the tables state kept in the session
+    stage_path = f'/project/{project_url}/stage/{stage_url}'
+    concepts_path = f'{stage_path}/concepts_catalog'
+    return [
+        ('get_all_projects', [], ('GET', '/', None)),
+        ('show_stage', [], ('GET', stage_path, None)),
+        ('show_concepts', [], ('GET', concepts_path, None)),
+        ('get_users', [], ('GET', '/users', None)),
+        ('filter_users', [('GET', '/users', None)], ('POST', '/users', {
+            'column': 'name', 'condition': 'contains', 'input': 'Usuario 1', 'logical_operator': '&', 'add_filter': '1',
+        })),
+        ('filter_concepts', [('GET', concepts_path, None)], ('POST', concepts_path, {
+            'column': 'name', 'condition': 'contains', 'input': 'Concepto 1', 'logical_operator': '&', 'add_filter': '1',
+        })),
+        ('sort_concepts', [('GET', concepts_path, None)], ('POST', concepts_path, {
+            'sort_column': 'direct cost', 'sort_direction': 'desc',
+        })),
+        ('filter_stage_phases', [('GET', stage_path, None)], ('POST', stage_path, {
+            'column': 'direct cost', 'condition': '>', 'input': '1000', 'logical_operator': '&', 'add_filter': '1',
+        })),
+    ]
+
+
+def send(client, request, expected_status=200):
+    method, path, data = request
+    response = client.open(path, method=method, data=data)
+    if response.status_code != expected_status:
+        raise RuntimeError(f'{method} {path} returned {response.status_code}')
+    return response
+
+
+def run_size(size, repeat):
+    # Runs in the child process, DB_URI already points to an empty database
+    from sqlalchemy import event
+    from main import app, seed_creator
+    from migrations import upgrade_database
+    from models import db
+    from project_tree import url_from_name
+    from synthetic_data import seed_synthetic_data, SYNTHETIC_VOLUMES
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['QUERY_BUDGET'] = None
+
+    with app.app_context():
+        upgrade_database(db.engine)
+        seed_creator()
+        started = time.perf_counter()
+        rows = seed_synthetic_data(SYNTHETIC_VOLUMES[size])
+        seed_time = time.perf_counter() - started
+
+        query_count = [0]
+
+        @event.listens_for(db.engine, 'after_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            query_count[0] += 1
+
+    client = app.test_client()
+    send(client, ('POST', '/login', {'email': BENCHMARK_USER, 'password': BENCHMARK_PASSWORD}), expected_status=302)
+
+    routes = {}
+    for name, setup, measured in scenarios(url_from_name('Proyecto 0 S0'), url_from_name('Etapa 0')):
+        latencies = []
+        queries = []
+        for run in range(repeat):
+            for request in setup:
+                send(client, request)
+            query_count[0] = 0
+            started = time.perf_counter()
+            response = send(client, measured)
+            latencies.append(time.perf_counter() - started)
+            queries.append(query_count[0])
+
+        for request in setup:
+            send(client, request)
+        tracemalloc.start()
+        send(client, measured)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        routes[name] = {
+            'method': measured[0],
+            'path': measured[1],
+            'min_ms': latencies_ms[0],
+            'median_ms': statistics.median(latencies_ms),
+            'p95_ms': latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.95))],
+            'mean_ms': statistics.mean(latencies_ms),
+            # The first run also refreshes stale caches
+            'cold_queries': queries[0],
+            'queries': queries[-1],
+            'peak_memory_kb': peak_memory / 1024,
+            'response_kb': len(response.data) / 1024,
+        }
+
+    return {
+        'volumes': SYNTHETIC_VOLUMES[size],
+        'rows': rows,
+        'seed_time_s': seed_time,
+        'routes': routes,
+    }
+
+
+def benchmark_size(size, repeat):
+    # Each size gets a new process and database, main.py configures the app when it is imported
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(
+            os.environ,
+            DB_URI=f'sqlite:///{os.path.join(directory, "benchmark.db")}',
+            FLASK_KEY='benchmark',
+            CREATOR_USER=BENCHMARK_USER,
+            CREATOR_PASSWORD=BENCHMARK_PASSWORD,
+            METRICS_DIR=os.path.join(directory, 'metrics'),
+            PROFILES_DIR=os.path.join(directory, 'profiles'),
+        )
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-size', size, '--repeat', str(repeat)],
+            env=environment,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+    return json.loads(result.stdout)
+
+
+def compare_reports(previous, current):
+    # Median latency and queries of the routes measured in both reports
+    lines = []
+    for size, results in current['sizes'].items():
+        previous_routes = previous.get('sizes', {}).get(size, {}).get('routes', {})
+        for name, route in results['routes'].items():
+            if name not in previous_routes:
+                continue
+            before = previous_routes[name]
+            change = (route['median_ms'] / before['median_ms'] - 1) * 100 if before['median_ms'] else 0
+            lines.append(
+                f'{size:8} {name:20} {before["median_ms"]:9.1f} -> {route["median_ms"]:9.1f} ms ({change:+.0f}%)'
+                f'  {before["queries"]:5} -> {route["queries"]:5} queries'
+            )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot routes over synthetic datasets.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], help='small, medium and/or large')
+    parser.add_argument('--repeat', type=int, default=5, help='measured requests per route')
+    parser.add_argument('--output', default='benchmark.json', help='JSON report to write')
+    parser.add_argument('--compare', help='previous JSON report to compare with')
+    parser.add_argument('--run-size', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run_size:
+        json.dump(run_size(arguments.run_size, arguments.repeat), sys.stdout)
+        return
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'repeat': arguments.repeat,
+        'sizes': {},
+    }
+    for size in arguments.sizes:
+        print(f'Benchmarking the {size} dataset...', file=sys.stderr)
+        report['sizes'][size] = benchmark_size(size, arguments.repeat)
+        for name, route in report['sizes'][size]['routes'].items():
+            print(f'{size:8} {name:20} {route["median_ms"]:9.1f} ms {route["queries"]:5} queries {route["peak_memory_kb"]:9.0f} KB', file=sys.stderr)
+
+    with open(arguments.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            print(compare_reports(json.load(file), report), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+from sqlalchemy import func, select, or_
+from models import db, Unit, Stage, Phase, Concept, ConceptCost, Job, Machinery, Material, MatGenerator, MoGenerator, MaqGenerator
+from stock_ledger import DIALECT_INSERTS
+
+
+# Tools are not budgeted from the HerGenerator table yet, they are charged as a percentage of the labour.
+TOOLS_LABOUR_RATE = 0.03
+
+# Generator families that are priced against a catalog: (generator model, catalog model, generator FK column).
+COST_FAMILIES = {
+    'material': (MatGenerator, Material, MatGenerator.material_id),
+    'machinery': (MaqGenerator, Machinery, MaqGenerator.machinery_id),
+    'labour': (MoGenerator, Job, MoGenerator.job_id),
+}
+
+# Types of the columns shown in the concepts catalog, in the order of concept_cost_columns().
+CATALOG_COLUMN_TYPES = [str, str, str, float, str, float, float, float, float, float, float, float, float, float, float]
+
+
+def family_totals(family, criterion):
+    # One grouped JOIN/SUM per generator family: {concept_id: sum(quantity * catalog price)}
+    generator, catalog, catalog_fk = COST_FAMILIES[family]
+    rows = db.session.query(
+        generator.concept_id,
+        func.sum(generator.quantity * catalog.price)
+    ).join(
+        catalog, catalog.id == catalog_fk
+    ).join(
+        Concept, Concept.id == generator.concept_id
+    ).join(
+        Phase, Phase.id == Concept.phase_id
+    ).filter(
+        criterion
+    ).group_by(
+        generator.concept_id
+    ).all()
+
+    return {concept_id: total or 0 for concept_id, total in rows}
+
+
+def concept_totals(quantity, material, machinery, labour):
+    tools = TOOLS_LABOUR_RATE * labour
+    direct_cost = material + machinery + labour + tools
+
+    # Concepts without a quantity yet can't be priced per unit, so they are shown in zeros.
+    if not quantity:
+        return {
+            'material_total': 0,
+            'machinery_total': 0,
+            'labour_total': 0,
+            'tools_total': 0,
+            'direct_cost': 0,
+            'unit_price': 0,
+        }
+
+    return {
+        'material_total': material,
+        'machinery_total': machinery,
+        'labour_total': labour,
+        'tools_total': tools,
+        'direct_cost': direct_cost,
+        'unit_price': direct_cost/quantity,
+    }
+
+
+def refresh_concept_costs(*criteria):
+    # Recompute only the concepts whose cached cost is missing or stale, criteria can filter by Phase or Stage columns.
+    # The stale set is always read from the primary, and once there is something to refresh the session is flagged
+    # as writing so the totals are read there too: a lagging replica would cache old totals as fresh.
+    stale_concepts = db.session.execute(
+        select(
+            Concept.id,
+            Concept.quantity
+        ).join(
+            Phase, Phase.id == Concept.phase_id
+        ).join(
+            Stage, Stage.id == Phase.stage_id
+        ).outerjoin(
+            ConceptCost, ConceptCost.concept_id == Concept.id
+        ).where(
+            *criteria,
+            or_(ConceptCost.concept_id.is_(None), ConceptCost.is_stale.is_(True))
+        ),
+        bind_arguments={'bind': db.engine}
+    ).all()
+
+    if not stale_concepts:
+        return 0
+
+    db.session.info['wrote'] = True
+    stale_ids = [concept_id for concept_id, quantity in stale_concepts]
+    totals = {family: family_totals(family, Concept.id.in_(stale_ids)) for family in COST_FAMILIES}
+
+    costs = []
+    for concept_id, quantity in stale_concepts:
+        cost = concept_totals(
+            quantity,
+            material=totals['material'].get(concept_id, 0),
+            machinery=totals['machinery'].get(concept_id, 0),
+            labour=totals['labour'].get(concept_id, 0)
+        )
+        cost['concept_id'] = concept_id
+        cost['is_stale'] = False
+        costs.append(cost)
+
+    # Upserted, two requests refreshing the same stage at once both write instead of one failing on the key
+    statement = DIALECT_INSERTS[db.engine.dialect.name](ConceptCost.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['concept_id'],
+        set_={key: statement.excluded[key] for key in costs[0] if key != 'concept_id'}
+    )
+    db.session.execute(statement, costs)
+    db.session.commit()
+
+    return len(costs)
+
+
+def concept_cost_columns():
+    # Catalog columns as SQL expressions over the cached concept costs.
+    quantity_divisor = func.coalesce(func.nullif(Concept.quantity, 0), 1)
+    return {
+        'phase': Phase.code,
+        'code': Concept.code,
+        'name': Concept.name,
+        'quantity': Concept.quantity,
+        'unit': Unit.name,
+        'material unit price': ConceptCost.material_total/quantity_divisor,
+        'material total': ConceptCost.material_total,
+        'machinery unit price': ConceptCost.machinery_total/quantity_divisor,
+        'machinery total': ConceptCost.machinery_total,
+        'labour unit price': ConceptCost.labour_total/quantity_divisor,
+        'labour total': ConceptCost.labour_total,
+        'tools unit price': ConceptCost.tools_total/quantity_divisor,
+        'tools total': ConceptCost.tools_total,
+        'unit price': ConceptCost.unit_price,
+        'direct cost': ConceptCost.direct_cost,
+    }
+
+
+def stage_concept_costs_query(stage_id, columns):
+    # Query of the catalog columns of a stage, stale concept costs are refreshed first.
+    refresh_concept_costs(Phase.stage_id == stage_id)
+
+    return db.session.query(
+        *columns.values()
+    ).select_from(
+        Concept
+    ).join(
+        Phase, Phase.id == Concept.phase_id
+    ).join(
+        Unit, Unit.id == Concept.unit_id
+    ).join(
+        ConceptCost, ConceptCost.concept_id == Concept.id
+    ).filter(
+        Phase.stage_id == stage_id
+    )
+
+
+def stage_concept_costs(stage_id):
+    # Returns the concepts catalog rows of a stage from the cached concept costs.
+    columns = concept_cost_columns()
+    rows = stage_concept_costs_query(stage_id, columns).order_by(Phase.id, Concept.id).all()
+    return [dict(zip(columns, row)) for row in rows]
+
+
+# Budget rollups: Concept -> Phase -> Stage -> Project
+ROLLUP_LEVELS = {
+    'phase': Phase.id,
+    'stage': Stage.id,
+    'project': Stage.project_id,
+}
+
+
+def budget_totals(level, *criteria):
+    # Sums the cached concept costs by phase, stage or project: {id: {'material': ..., 'direct cost': ...}}
+    refresh_concept_costs(*criteria)
+
+    key = ROLLUP_LEVELS[level]
+    rows = db.session.query(
+        key,
+        func.sum(ConceptCost.material_total),
+        func.sum(ConceptCost.machinery_total),
+        func.sum(ConceptCost.labour_total),
+        func.sum(ConceptCost.tools_total),
+        func.sum(ConceptCost.direct_cost)
+    ).select_from(
+        ConceptCost
+    ).join(
+        Concept, Concept.id == ConceptCost.concept_id
+    ).join(
+        Phase, Phase.id == Concept.phase_id
+    ).join(
+        Stage, Stage.id == Phase.stage_id
+    ).filter(
+        *criteria
+    ).group_by(
+        key
+    ).all()
+
+    return {
+        row_id: {
+            'material': material or 0,
+            'machinery': machinery or 0,
+            'labour': labour or 0,
+            'tools': tools or 0,
+            'direct cost': direct_cost or 0,
+        }
+        for row_id, material, machinery, labour, tools, direct_cost in rows
+    }
+
+
+def budget_total(budgets):
+    # Direct cost of a parent from the rollup of its children.
+    return sum(budget['direct cost'] for budget in budgets.values())
+
+
+def phase_budgets_subquery():
+    # Direct cost per phase from the cached concept costs, to be joined in the phases table query.
+    return db.session.query(
+        Concept.phase_id.label('phase_id'),
+        func.sum(ConceptCost.direct_cost).label('direct_cost')
+    ).join(
+        ConceptCost, ConceptCost.concept_id == Concept.id
+    ).group_by(
+        Concept.phase_id
+    ).subquery()
@@ -0,0 +1,55 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SQLITE_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def environment_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options(database_uri):
+    # Pool of the server databases, set next to DB_URI. SQLite keeps the pool of SQLAlchemy and is tuned with pragmas.
+    if make_url(database_uri).get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'pool_size': int(os.environ.get("DB_POOL_SIZE", 5)),
+        'max_overflow': int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        'pool_timeout': int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        # Connections older than this are replaced before the server or a proxy drops them
+        'pool_recycle': int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        'pool_pre_ping': environment_flag("DB_POOL_PRE_PING", True),
+    }
+
+
+def sqlite_pragmas():
+    # WAL lets readers work while a worker writes, and NORMAL only syncs at checkpoints, which is safe in WAL mode.
+    journal_mode = os.environ.get("SQLITE_JOURNAL_MODE", 'WAL').upper()
+    synchronous = os.environ.get("SQLITE_SYNCHRONOUS", 'NORMAL').upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f'SQLITE_JOURNAL_MODE must be one of {", ".join(SQLITE_JOURNAL_MODES)}')
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f'SQLITE_SYNCHRONOUS must be one of {", ".join(SQLITE_SYNCHRONOUS_MODES)}')
+    return {
+        'journal_mode': journal_mode,
+        'synchronous': synchronous,
+        # Milliseconds a connection waits for a lock before "database is locked"
+        'busy_timeout': int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+        'mmap_size': int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    }
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    # Sets the pragmas on every new connection of a SQLite engine.
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
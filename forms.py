@@ -3,11 +3,14 @@ from wtforms import StringField, SubmitField, PasswordField, DateField, SelectFi
 from wtforms.validators import DataRequired, URL, Email, Length
 from flask_ckeditor import CKEditorField
 from flask import request, session, flash
-import pandas as pd
+from markupsafe import Markup
+import html
+import operator
+import re
 from flask_wtf.file import FileField
 
 from sqlalchemy import Integer, String, Boolean, Float, Date, DateTime
-from sqlalchemy import inspect
+from sqlalchemy import inspect, cast, case, and_, or_
 from models import db, Unit, Project, Stage, Phase, Concept, Tool, Job, Machinery, Material, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, Locations, MaterialEntry, MaterialMove, MaterialExit, ToolEntry, ToolMove, ToolExit, Providor, MaqRental, Investor, jobs_history_employees, Employee, JobsHistory, Specialty, NewUser, User, Position, File
 
 
@@ -142,6 +145,21 @@ def create_filtering_form(column_choices):
     return FilteringForm()
 
 
+def render_table_body(table):
+    # Pre-renders the <tr> rows of a plain table in one pass over its columns, escaping every cell.
+    if table.empty:
+        return Markup('<tr><td>No elements found</td></tr>')
+
+    # pandas is imported by the tables that use it, it is too heavy for the boot of every worker
+    import pandas as pd
+
+    cells = table.astype(str).map(html.escape)
+    body = pd.Series('<tr>', index=table.index)
+    for column in table.columns:
+        body = body + '<td>' + cells[column] + '</td>'
+    return Markup(''.join(body + '</tr>'))
+
+
 class SelfFilteringTable:
     def __init__(self, df, columns, column_types):
         self.df = df
@@ -171,6 +189,15 @@ class SelfFilteringTable:
 
         self.table = self.apply_filters()
 
+    @property
+    def rows(self):
+        # The table as a list of {column: value} rows, for templates that need per cell markup.
+        return self.table.to_dict('records')
+
+    @property
+    def body(self):
+        return render_table_body(self.table)
+
     def initialize_session(self):
         if not self.df.empty:  # Check if DataFrame is not empty
             self.sort_column = self.df.columns[0]  # Access first column only if DataFrame is not empty
@@ -244,3 +271,232 @@ class SelfFilteringTable:
             else:
                 table = table.sort_values(by=self.sort_column, ascending=False)
         return table
+
+
+# Comparison conditions of the filtering form as SQL operators.
+SQL_CONDITIONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+LOGICAL_OPERATOR_LABELS = {'&': 'and', '|': 'or'}
+
+# Maximum number of rows loaded by a query backed table.
+TABLE_PAGE_SIZE = 100
+
+
+class QueryFilteringTable(SelfFilteringTable):
+    # Same filtering form as SelfFilteringTable, but the filters are kept in the session as structured data
+    # and compiled to the WHERE/ORDER BY/LIMIT of the query, so only the rows on screen are loaded.
+    # columns maps each column name to its SQLAlchemy expression in the query, and key is a unique
+    # expression (the first column by default) used to break ties when sorting and paginating.
+    def __init__(self, query, columns, column_types, key=None, page_size=TABLE_PAGE_SIZE):
+        self.query = query
+        self.column_expressions = columns
+        self.key = key if key is not None else list(columns.values())[0]
+        self.page_size = page_size
+        self.page_cursor = None
+        self.has_previous = False
+        self.has_next = False
+        import pandas as pd
+        self.df = pd.DataFrame(columns=list(columns))
+        super().__init__(df=self.df, columns=list(columns), column_types=column_types)
+
+    def process_request(self):
+        if request.method == 'GET' or 'filters' not in session:
+            self.initialize_session()
+        else:
+            self.load_session()
+            if 'add_filter' in request.form:
+                self.add_filter()
+                self.reset_page()
+            elif 'apply' in request.form:
+                # The filters are not editable as text, an empty queries field clears them.
+                if not re.sub(r'<[^>]*>|&nbsp;|\s', '', self.form.queries.data or ''):
+                    self.filtering_inputs = []
+                    session['filters'] = self.filtering_inputs
+                self.reset_page()
+            elif 'sort_column' in request.form and 'sort_direction' in request.form:
+                if request.form.get('sort_column') in self.columns:
+                    self.sort_column = request.form.get('sort_column')
+                    session['sort_column'] = self.sort_column
+                    self.sort_direction = request.form.get('sort_direction')
+                    session['sort_direction'] = self.sort_direction
+                self.reset_page()
+            elif request.form.get('page') in ('next', 'previous'):
+                self.turn_page(request.form.get('page'))
+
+        self.form.queries.data = self.describe_filters()
+        self.table = self.apply_filters()
+
+    def initialize_session(self):
+        self.sort_column = self.columns[0]
+        session['sort_column'] = self.sort_column
+        self.filtering_inputs = []
+        session['filters'] = self.filtering_inputs
+        self.sort_direction = 'asc'
+        session['sort_direction'] = self.sort_direction
+        self.reset_page()
+
+    def load_session(self):
+        # The session is shared by all the tables, ignore whatever belongs to other columns.
+        self.filtering_inputs = [
+            query_filter for query_filter in session.get('filters', [])
+            if query_filter['column'] in self.columns
+        ]
+        self.sort_column = session.get('sort_column')
+        if self.sort_column not in self.columns:
+            self.sort_column = self.columns[0]
+        self.sort_direction = session.get('sort_direction', 'asc')
+        self.page_cursor = session.get('page_cursor')
+        if self.page_cursor and self.page_cursor['sort_column'] != self.sort_column:
+            self.page_cursor = None
+
+    def add_filter(self):
+        column = self.form.column.data
+        condition = self.form.condition.data
+        input_data = self.form.input.data
+        logical_operator = self.form.logical_operator.data
+        column_type = self.column_types[self.columns.index(column)]
+
+        if not input_data:
+            flash("Can't add an empty input.")
+            return
+
+        if condition == 'contains':
+            value = input_data
+        else:
+            try:
+                value = column_type(input_data)  # Try to convert input_data to the column_type
+            except ValueError:
+                flash(f'The input type is not correct, it should be {column_type} type.')
+                return
+
+        query_filter = {
+            'column': column,
+            'condition': condition,
+            'value': value,
+            'logical_operator': logical_operator
+        }
+        if query_filter in self.filtering_inputs:
+            flash('That filter is already considered.')
+        else:
+            self.filtering_inputs.append(query_filter)
+            session['filters'] = self.filtering_inputs
+
+    def describe_filters(self):
+        description = ''
+        for query_filter in self.filtering_inputs:
+            if description:
+                description += f" {LOGICAL_OPERATOR_LABELS[query_filter['logical_operator']]} "
+            description += f"{query_filter['column']} {query_filter['condition']} {query_filter['value']!r}"
+        return description
+
+    def compile_condition(self, query_filter):
+        column = self.column_expressions[query_filter['column']]
+        if query_filter['condition'] == 'contains':
+            return cast(column, String).contains(str(query_filter['value']), autoescape=True)
+        return SQL_CONDITIONS[query_filter['condition']](column, query_filter['value'])
+
+    def compile_filters(self):
+        # "and" binds tighter than "or", as it did with the pandas expressions.
+        groups = [[]]
+        for query_filter in self.filtering_inputs:
+            if groups[-1] and query_filter['logical_operator'] == '|':
+                groups.append([])
+            groups[-1].append(self.compile_condition(query_filter))
+        return or_(*[and_(*group) for group in groups])
+
+    # Keyset pagination:
+    # Rows are kept in a total order (nulls first, sort column, key) and each page is sought from the
+    # (sort value, key) of the first or last row of the current page, so no page needs an OFFSET.
+    def reset_page(self):
+        self.page_cursor = None
+        session['page_cursor'] = None
+
+    def turn_page(self, page):
+        page_keys = session.get('page_keys')
+        if not page_keys or page_keys['sort_column'] != self.sort_column:
+            self.reset_page()
+            return
+
+        if page == 'next':
+            self.page_cursor = {'sort_column': self.sort_column, 'key': page_keys['last'], 'forward': True}
+        else:
+            self.page_cursor = {'sort_column': self.sort_column, 'key': page_keys['first'], 'forward': False}
+        session['page_cursor'] = self.page_cursor
+
+    def order_by(self, ascending):
+        sort_expression = self.column_expressions[self.sort_column]
+        null_order = case((sort_expression.is_(None), 0), else_=1)
+        if ascending:
+            return [null_order.asc(), sort_expression.asc(), self.key.asc()]
+        return [null_order.desc(), sort_expression.desc(), self.key.desc()]
+
+    def seek_condition(self, sort_value, key_value, greater):
+        # Rows after (greater) or before the (sort_value, key_value) row in the ascending total order.
+        sort_expression = self.column_expressions[self.sort_column]
+        if greater:
+            if sort_value is None:
+                return or_(and_(sort_expression.is_(None), self.key > key_value), sort_expression.isnot(None))
+            return and_(
+                sort_expression.isnot(None),
+                or_(sort_expression > sort_value, and_(sort_expression == sort_value, self.key > key_value))
+            )
+        if sort_value is None:
+            return and_(sort_expression.is_(None), self.key < key_value)
+        return or_(
+            sort_expression.is_(None),
+            sort_expression < sort_value,
+            and_(sort_expression == sort_value, self.key < key_value)
+        )
+
+    def fetch_page(self, query):
+        ascending = self.sort_direction == 'asc'
+        forward = True
+        if self.page_cursor:
+            forward = self.page_cursor['forward']
+            sort_value, key_value = self.page_cursor['key']
+            query = query.filter(self.seek_condition(sort_value, key_value, greater=(ascending == forward)))
+
+        # One extra row tells if there is another page in the direction we are reading.
+        rows = query.order_by(*self.order_by(ascending == forward)).limit(self.page_size + 1).all()
+        more_rows = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if forward:
+            self.has_previous = self.page_cursor is not None
+            self.has_next = more_rows
+        else:
+            rows.reverse()
+            self.has_previous = more_rows
+            self.has_next = True
+        return rows
+
+    def apply_filters(self):
+        query = self.query.add_columns(self.key)
+        if self.filtering_inputs:
+            query = query.filter(self.compile_filters())
+
+        rows = self.fetch_page(query)
+        if self.page_cursor and (not rows or not (self.page_cursor['forward'] or self.has_previous)):
+            # Went back to the first page, or the rows of the page are gone
+            self.reset_page()
+            rows = self.fetch_page(query)
+
+        sort_index = self.columns.index(self.sort_column)
+        if rows:
+            session['page_keys'] = {
+                'sort_column': self.sort_column,
+                'first': [rows[0][sort_index], rows[0][-1]],
+                'last': [rows[-1][sort_index], rows[-1][-1]],
+            }
+        else:
+            session['page_keys'] = None
+
+        import pandas as pd
+        self.df = pd.DataFrame([tuple(row)[:-1] for row in rows], columns=self.columns)
+        return self.df
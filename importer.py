@@ -0,0 +1,352 @@
+import codecs
+import csv
+import io
+import os
+import zipfile
+from datetime import date, datetime
+from itertools import islice
+from sqlalchemy import inspect, select, insert, update, func, Integer, Float, String, Date, DateTime, Boolean
+from prices import record_price_changes, mark_stale_prices
+from models import db, Unit, Phase, Concept, ConceptCost, Material, Job, Machinery, Tool, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, VarianceReport, CATALOG_GENERATORS
+
+
+IMPORT_CHUNK_SIZE = 1000
+# Bytes of a CSV file decoded at a time when its encoding is checked
+CHECK_BLOCK_SIZE = 1024 * 1024
+
+# Tables that can be imported: model, natural key the existing rows are matched with to be updated, and the
+# foreign keys that can be given by reference instead of by id: {column: file column}.
+IMPORT_TABLES = {
+    'materials': (Material, ('name',), {'unit_id': 'unit'}),
+    'jobs': (Job, ('name',), {'unit_id': 'unit'}),
+    'machineries': (Machinery, ('name',), {'unit_id': 'unit'}),
+    'tools': (Tool, ('name',), {'unit_id': 'unit'}),
+    'concepts': (Concept, ('phase_id', 'code'), {'unit_id': 'unit', 'phase_id': 'phase'}),
+    'mat_generators': (MatGenerator, ('concept_id', 'material_id'), {'unit_id': 'unit', 'concept_id': 'concept', 'material_id': 'material'}),
+    'mo_generators': (MoGenerator, ('concept_id', 'job_id'), {'unit_id': 'unit', 'concept_id': 'concept', 'job_id': 'job'}),
+    'maq_generators': (MaqGenerator, ('concept_id', 'machinery_id'), {'unit_id': 'unit', 'concept_id': 'concept', 'machinery_id': 'machinery'}),
+    'her_generators': (HerGenerator, ('concept_id', 'tool_id'), {'unit_id': 'unit', 'concept_id': 'concept', 'tool_id': 'tool'}),
+}
+
+# Columns filled in by the importer when the file doesn't have them
+GENERATED_COLUMNS = {'last_update', 'code'}
+
+
+def catalog_names(model):
+    return lambda stage_id: dict(db.session.query(model.name, model.id).all())
+
+
+# Lookup maps of the references, {file value: id}. Phases and concepts are looked up by code in the stage imported.
+REFERENCE_LOOKUPS = {
+    'unit': catalog_names(Unit),
+    'material': catalog_names(Material),
+    'job': catalog_names(Job),
+    'machinery': catalog_names(Machinery),
+    'tool': catalog_names(Tool),
+    'phase': lambda stage_id: dict(db.session.query(Phase.code, Phase.id).filter(Phase.stage_id == stage_id).all()),
+    'concept': lambda stage_id: dict(
+        db.session.query(Concept.code, Concept.id).join(Phase, Phase.id == Concept.phase_id).filter(Phase.stage_id == stage_id).all()
+    ),
+}
+
+
+class ImportFileError(Exception):
+    # The file can't be imported at all: unknown table or extension, unknown or missing columns, not UTF-8 text or
+    # not a workbook
+    pass
+
+
+def read_csv_rows(stream):
+    reader = csv.DictReader(stream)
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except csv.Error as error:
+        raise ImportFileError(f'Line {reader.line_num} can not be read: {error}')
+
+
+def decode_csv(stream):
+    # Checks that the whole file is UTF-8 before anything is saved, a block at a time, and reads it again as text
+    # from the start. Streams that can't seek are read into memory first.
+    if not stream.seekable():
+        stream = io.BytesIO(stream.read())
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    position = 0
+    try:
+        for block in iter(lambda: stream.read(CHECK_BLOCK_SIZE), b''):
+            decoder.decode(block)
+            position += len(block)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError as error:
+        raise ImportFileError(f'The file is not UTF-8 text, save it as CSV UTF-8: byte {position + error.start} can not be read')
+    stream.seek(0)
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+
+def open_workbook(stream):
+    # Loads the workbook before anything is saved, a corrupt file or one that isn't a workbook is rejected whole
+    import openpyxl
+    from openpyxl.utils.exceptions import InvalidFileException
+    try:
+        return openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, ValueError, OSError) as error:
+        raise ImportFileError(f'The file is not an Excel workbook or it is damaged: {error}')
+
+
+def read_excel_rows(workbook):
+    # Yields (row number, {column: value}) of the first sheet of a workbook, read in streaming mode
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(column).strip() if column is not None else '' for column in next(rows, [])]
+        for number, values in enumerate(rows, start=2):
+            if all(value is None for value in values):
+                continue
+            yield number, dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+def read_rows(stream, filename):
+    # Rows of an uploaded or local file by its extension, CSV streams can be binary or text
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        return read_excel_rows(open_workbook(stream))
+    if extension == '.csv':
+        if not isinstance(stream, io.TextIOBase):
+            stream = decode_csv(stream)
+        return read_csv_rows(stream)
+    raise ImportFileError(f'Only .csv and .xlsx files can be imported, not {extension or filename}')
+
+
+def convert_value(column, value):
+    # Value of a file cell as the python type of the column, raises ValueError when it doesn't fit
+    if isinstance(value, str):
+        value = value.strip()
+    if value is None or value == '':
+        return None
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('1', 'true', 'yes', 'si', 'sí'):
+            return True
+        if str(value).lower() in ('0', 'false', 'no'):
+            return False
+        raise ValueError(f'{value!r} is not a boolean')
+    if isinstance(column_type, Integer):
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(f'{value!r} is not an integer')
+        return int(number)
+    if isinstance(column_type, Float):
+        return float(value)
+    if isinstance(column_type, DateTime):
+        return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+    if isinstance(column_type, Date):
+        if isinstance(value, datetime):
+            return value.date()
+        return value if isinstance(value, date) else date.fromisoformat(str(value))
+    if isinstance(column_type, String):
+        value = str(value)
+        if column_type.length and len(value) > column_type.length:
+            raise ValueError(f'longer than {column_type.length} characters')
+        return value
+    return value
+
+
+class TableImport:
+    # Imports the rows of a file into a table in chunks of IMPORT_CHUNK_SIZE, each in its own transaction. Every
+    # row is validated against the columns of the model, its references are resolved with lookup maps loaded once,
+    # and the rows whose natural key exists are updated in bulk while the new ones are inserted in bulk. The rows
+    # with errors, unknown ids or a natural key already seen in the file are skipped and reported:
+    # [{'row': line, 'column': ..., 'error': ...}].
+    def __init__(self, table_name, stage_id=None, chunk_size=IMPORT_CHUNK_SIZE):
+        if table_name not in IMPORT_TABLES:
+            raise ImportFileError(f'{table_name} can not be imported, only {", ".join(IMPORT_TABLES)}')
+        self.table_name = table_name
+        self.model, self.natural_key, self.references = IMPORT_TABLES[table_name]
+        if self.model not in CATALOG_GENERATORS and stage_id is None:
+            raise ImportFileError(f'{table_name} are imported into a stage, its phases and concepts are looked up by code')
+        self.stage_id = stage_id
+        self.chunk_size = chunk_size
+        self.columns = {column.key: column for column in inspect(self.model).columns if not column.primary_key}
+        self.required_columns = [
+            key for key, column in self.columns.items()
+            if not column.nullable and column.default is None and key not in GENERATED_COLUMNS
+        ]
+        self.lookups = {reference: REFERENCE_LOOKUPS[reference](stage_id) for reference in self.references.values()}
+        self.reference_ids = {reference: set(lookup.values()) for reference, lookup in self.lookups.items()}
+        self.file_keys = {}
+        self.existing = self.existing_keys()
+        self.next_concept_number = {}
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []
+
+    def existing_keys(self):
+        # {natural key: id} of the rows already in the table, in the stage for concepts and generators
+        key_columns = [getattr(self.model, column) for column in self.natural_key]
+        query = db.session.query(self.model.id, *key_columns)
+        if self.model is Concept:
+            query = query.join(Phase, Phase.id == Concept.phase_id).filter(Phase.stage_id == self.stage_id)
+        elif 'concept_id' in self.natural_key:
+            query = query.join(Concept, Concept.id == self.model.concept_id).join(Phase, Phase.id == Concept.phase_id).filter(Phase.stage_id == self.stage_id)
+        return {tuple(key): row_id for row_id, *key in query.all()}
+
+    def check_header(self, header):
+        known = set(self.columns) | set(self.references.values())
+        unknown = [column for column in header if column and column not in known]
+        if unknown:
+            raise ImportFileError(f'Unknown columns for {self.table_name}: {", ".join(unknown)}')
+        missing = [
+            column for column in self.required_columns
+            if column not in header and self.references.get(column) not in header
+        ]
+        if missing:
+            raise ImportFileError(f'Missing columns for {self.table_name}: {", ".join(missing)}')
+
+    def validate(self, line, row):
+        # The row as {column: value} ready to be saved, or None after reporting its errors
+        values = {}
+        errors = []
+        for key, column in self.columns.items():
+            reference = self.references.get(key)
+            if reference and row.get(reference) not in (None, ''):
+                reference_value = str(row[reference]).strip()
+                if reference_value not in self.lookups[reference]:
+                    errors.append({'row': line, 'column': reference, 'error': f'{reference_value!r} not found'})
+                    continue
+                values[key] = self.lookups[reference][reference_value]
+            elif key in row:
+                try:
+                    values[key] = convert_value(column, row[key])
+                except ValueError as error:
+                    errors.append({'row': line, 'column': key, 'error': str(error)})
+                    continue
+                # Ids given directly are checked against the same lookup, the database would reject them mid import
+                if reference and values[key] is not None and values[key] not in self.reference_ids[reference]:
+                    errors.append({'row': line, 'column': key, 'error': f'{values[key]} not found'})
+                    continue
+            if values.get(key) is None and key in self.required_columns:
+                errors.append({'row': line, 'column': reference or key, 'error': 'is required'})
+
+        if errors:
+            self.errors.extend(errors)
+            return None
+
+        # A natural key can only appear once in a file, whatever the chunk its rows fall in
+        natural_key = tuple(values.get(column) for column in self.natural_key)
+        if None not in natural_key:
+            if natural_key in self.file_keys:
+                self.errors.append({'row': line, 'column': ', '.join(self.references.get(column, column) for column in self.natural_key), 'error': f'repeats row {self.file_keys[natural_key]}'})
+                return None
+            self.file_keys[natural_key] = line
+
+        values = {key: value for key, value in values.items() if value is not None}
+        if 'last_update' in self.columns and 'last_update' not in values:
+            values['last_update'] = date.today()
+        if self.model is Concept and not values.get('code'):
+            values['code'] = self.concept_code(values['phase_id'])
+        return values
+
+    def concept_code(self, phase_id):
+        # Next code of the phase, as the Concept constructor gives them: A-1, A-2...
+        if phase_id not in self.next_concept_number:
+            phase_code, concepts = db.session.query(
+                Phase.code,
+                func.count(Concept.id)
+            ).outerjoin(
+                Concept, Concept.phase_id == Phase.id
+            ).filter(
+                Phase.id == phase_id
+            ).group_by(
+                Phase.code
+            ).one()
+            self.next_concept_number[phase_id] = [phase_code, concepts]
+        self.next_concept_number[phase_id][1] += 1
+        phase_code, number = self.next_concept_number[phase_id]
+        return f'{phase_code}-{number}'
+
+    def save_chunk(self, rows):
+        # One transaction per chunk: a bulk UPDATE by primary key and a bulk INSERT .. RETURNING of the new ids
+        updates = {}
+        inserts = {}
+        for values in rows:
+            key = tuple(values.get(column) for column in self.natural_key)
+            if key in self.existing:
+                updates[self.existing[key]] = {'id': self.existing[key], **values}
+            else:
+                inserts[key] = values
+
+        repriced = []
+        if updates and self.model in CATALOG_GENERATORS:
+            repriced = record_price_changes(self.table_name, {item_id: values['price'] for item_id, values in updates.items() if 'price' in values})
+        if updates:
+            for columns, rows_with_columns in group_by_columns(updates.values()).items():
+                db.session.execute(update(self.model), rows_with_columns)
+        if inserts:
+            for columns, rows_with_columns in group_by_columns(inserts.values()).items():
+                ids = db.session.scalars(
+                    insert(self.model).returning(self.model.id, sort_by_parameter_order=True),
+                    rows_with_columns
+                ).all()
+                for values, row_id in zip(rows_with_columns, ids):
+                    self.existing[tuple(values.get(column) for column in self.natural_key)] = row_id
+        self.mark_stale_costs(list(updates), list(self.existing[key] for key in inserts), repriced)
+        db.session.commit()
+
+        self.updated += len(updates)
+        self.inserted += len(inserts)
+
+    def mark_stale_costs(self, updated_ids, inserted_ids, repriced_ids):
+        # The bulk statements skip the ORM events that mark the cached concept costs and variance reports stale
+        if self.model in CATALOG_GENERATORS:
+            if repriced_ids:
+                mark_stale_prices(self.model, repriced_ids)
+            return
+
+        if self.model is Concept:
+            stale_concepts = updated_ids
+        else:
+            stale_concepts = select(self.model.concept_id).where(self.model.id.in_(updated_ids + inserted_ids))
+        db.session.execute(update(ConceptCost.__table__).where(ConceptCost.concept_id.in_(stale_concepts)).values(is_stale=True))
+        db.session.execute(update(VarianceReport.__table__).where(VarianceReport.stage_id == self.stage_id).values(is_stale=True))
+
+    def run(self, rows):
+        # rows: iterable of (line number, {column: value}), read lazily one chunk at a time
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return self.report()
+        self.check_header(list(first[1].keys()))
+
+        pending = [first]
+        while pending:
+            pending.extend(islice(rows, self.chunk_size - len(pending)))
+            valid = [values for values in (self.validate(line, row) for line, row in pending) if values is not None]
+            if valid:
+                self.save_chunk(valid)
+            pending = list(islice(rows, 1))
+        return self.report()
+
+    def report(self):
+        return {'table': self.table_name, 'inserted': self.inserted, 'updated': self.updated, 'errors': self.errors}
+
+
+def group_by_columns(rows):
+    # Bulk statements take rows with the same columns, rows with empty cells are grouped apart
+    groups = {}
+    for values in rows:
+        groups.setdefault(tuple(sorted(values)), []).append(values)
+    return groups
+
+
+def import_table(table_name, stream, filename, stage_id=None, chunk_size=IMPORT_CHUNK_SIZE):
+    # Imports a CSV or Excel file into a table, returns {'inserted': n, 'updated': n, 'errors': [...]}
+    return TableImport(table_name, stage_id=stage_id, chunk_size=chunk_size).run(read_rows(stream, filename))
+
+
+def write_error_report(errors, stream):
+    writer = csv.DictWriter(stream, fieldnames=['row', 'column', 'error'])
+    writer.writeheader()
+    writer.writerows(errors)
@@ -0,0 +1,138 @@
+from datetime import date, timedelta
+from sqlalchemy import event, func, insert, delete, select
+from sqlalchemy.orm import Session
+from models import db, InventorySnapshot, InventorySnapshotBalance
+from stock_ledger import INVENTORY_FAMILIES, stock_from_movements, attribute_value, keep_previous_value
+
+
+def month_end(day):
+    next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+def previous_month_end(day):
+    return day.replace(day=1) - timedelta(days=1)
+
+
+def nearest_snapshot(as_of_date):
+    # Latest snapshot taken at or before the date
+    return InventorySnapshot.query.filter(
+        InventorySnapshot.snapshot_date <= as_of_date
+    ).order_by(
+        InventorySnapshot.snapshot_date.desc()
+    ).first()
+
+
+def snapshot_balances(snapshot, family, location_id=None):
+    query = db.session.query(
+        InventorySnapshotBalance.item_id,
+        InventorySnapshotBalance.location_id,
+        InventorySnapshotBalance.quantity
+    ).filter(
+        InventorySnapshotBalance.snapshot_id == snapshot.id,
+        InventorySnapshotBalance.family == family
+    )
+    if location_id is not None:
+        query = query.filter(InventorySnapshotBalance.location_id == location_id)
+    return {(item_id, location_id): quantity for item_id, location_id, quantity in query.all()}
+
+
+def stock_as_of(family, as_of_date, location_id=None):
+    # {(item_id, location_id): quantity} at the end of a date: the nearest snapshot before it plus the movements after
+    # the snapshot, so only the deltas of a month at most are replayed when snapshots are taken monthly.
+    snapshot = nearest_snapshot(as_of_date)
+    criteria = [lambda movement_date: movement_date <= as_of_date]
+    stock = {}
+    if snapshot is not None:
+        criteria.append(lambda movement_date: movement_date > snapshot.snapshot_date)
+        stock = snapshot_balances(snapshot, family, location_id)
+
+    for key, quantity in stock_from_movements(family, *criteria, location_id=location_id).items():
+        stock[key] = stock.get(key, 0) + quantity
+    return {key: quantity for key, quantity in stock.items() if abs(quantity) > 1e-9}
+
+
+def take_snapshot(snapshot_date):
+    # Saves the stock of every family at the end of the date, built from the previous snapshot.
+    snapshot = InventorySnapshot.query.filter_by(snapshot_date=snapshot_date).first()
+    if snapshot is not None:
+        return snapshot
+
+    balances = {family: stock_as_of(family, snapshot_date) for family in INVENTORY_FAMILIES}
+    snapshot = InventorySnapshot(snapshot_date=snapshot_date)
+    db.session.add(snapshot)
+    db.session.flush()
+
+    rows = [
+        {'snapshot_id': snapshot.id, 'family': family, 'item_id': item_id, 'location_id': location_id, 'quantity': quantity}
+        for family, stock in balances.items()
+        for (item_id, location_id), quantity in stock.items()
+    ]
+    if rows:
+        db.session.execute(insert(InventorySnapshotBalance), rows)
+    db.session.commit()
+    return snapshot
+
+
+def first_movement_date():
+    dates = []
+    for item_column, movements in INVENTORY_FAMILIES.values():
+        for model, (date_column, locations) in movements.items():
+            dates.append(db.session.query(func.min(getattr(model, date_column))).scalar())
+    dates = [movement_date for movement_date in dates if movement_date is not None]
+    return min(dates) if dates else None
+
+
+def take_monthly_snapshots(until=None):
+    # Snapshots of every month end since the first movement until the last closed month, the missing ones are
+    # taken in order so each one only replays the movements of its month. Returns the dates taken.
+    until = until or previous_month_end(date.today())
+    first_date = first_movement_date()
+    if first_date is None:
+        return []
+
+    existing_dates = {snapshot_date for snapshot_date, in db.session.query(InventorySnapshot.snapshot_date).all()}
+    taken = []
+    snapshot_date = month_end(first_date)
+    while snapshot_date <= until:
+        if snapshot_date not in existing_dates:
+            take_snapshot(snapshot_date)
+            taken.append(snapshot_date)
+        snapshot_date = month_end(snapshot_date + timedelta(days=1))
+    return taken
+
+
+def delete_snapshots_from(first_date):
+    # Snapshots at or after a backdated movement no longer match the history, they are taken again later
+    stale_snapshots = select(InventorySnapshot.id).where(InventorySnapshot.snapshot_date >= first_date)
+    return [
+        delete(InventorySnapshotBalance.__table__).where(InventorySnapshotBalance.snapshot_id.in_(stale_snapshots)),
+        delete(InventorySnapshot.__table__).where(InventorySnapshot.snapshot_date >= first_date),
+    ]
+
+
+def watch_backdated_movements():
+    # Drops the snapshots a movement added, changed or deleted in the past makes wrong, in the movement's transaction.
+    date_columns = {}
+    for item_column, movements in INVENTORY_FAMILIES.values():
+        for model, (date_column, locations) in movements.items():
+            date_columns[model] = date_column
+            for key in [item_column, 'quantity', date_column] + [location_column for sign, location_column in locations]:
+                event.listen(getattr(model, key), 'set', keep_previous_value, active_history=True)
+
+    @event.listens_for(Session, 'after_flush')
+    def delete_stale_snapshots(session, flush_context):
+        dates = []
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            date_column = date_columns.get(type(instance))
+            if date_column is None or instance in session.dirty and not session.is_modified(instance):
+                continue
+            if instance not in session.new:
+                dates.append(attribute_value(instance, date_column, previous=True))
+            if instance not in session.deleted:
+                dates.append(attribute_value(instance, date_column, previous=False))
+
+        dates = [movement_date for movement_date in dates if movement_date is not None]
+        if dates:
+            for statement in delete_snapshots_from(min(dates)):
+                session.connection().execute(statement)
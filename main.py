@@ -1,5 +1,5 @@
 from datetime import date, time
-from flask import Flask, abort, render_template, redirect, url_for, flash, request, session
+from flask import Flask, Blueprint, current_app, abort, render_template, redirect, url_for, flash, request, session, jsonify, send_from_directory
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
 from flask_gravatar import Gravatar
@@ -7,15 +7,33 @@ from flask_login import UserMixin, login_user, LoginManager, current_user, logou
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import pandas as pd
 import os
 import shutil
-from sqlalchemy import inspect
+from sqlalchemy import inspect, func
 from wtforms import SelectField
 # Import your forms and database models.
-from forms import CreateProjectForm, CreateStageForm, RegisterForm, LoginForm, create_filtering_form, SelfFilteringTable, EditUserForm, create_new_record_form, SelectModelForm, CreatePhaseForm, ConceptCatalogSelector, CreateConceptForm
+from forms import CreateProjectForm, CreateStageForm, RegisterForm, LoginForm, create_filtering_form, SelfFilteringTable, QueryFilteringTable, EditUserForm, create_new_record_form, SelectModelForm, CreatePhaseForm, ConceptCatalogSelector, CreateConceptForm
+from user_cache import UserCache, watch_user_changes
+from query_monitor import QueryMonitor
+from route_metrics import RouteMetrics
+from request_profiler import RequestProfiler
+from migrations import upgrade_database
+from database import engine_options, sqlite_pragmas, apply_sqlite_pragmas
+from replicas import ReplicaRouter, replica_binds, replica_reads
+from synthetic_data import seed_synthetic_data, SYNTHETIC_VOLUMES
+from stock_ledger import INVENTORY_FAMILIES, watch_stock_movements, reconcile_material_stock, location_stock, stage_stock
+from inventory_snapshots import watch_backdated_movements, stock_as_of, take_snapshot, take_monthly_snapshots
+from tool_custody import watch_tool_custody, reconcile_tool_custody, tools_at_location, tools_at_stage, tools_held_by, tool_whereabouts
+from valuation import watch_valuation, revalue_stale_items, inventory_values
+from variance import watch_variance_sources, stage_variance_report, concept_actual_vs_budget, variance_dataframe, VARIANCE_COLUMN_TYPES
+from importer import import_table, write_error_report, ImportFileError, IMPORT_TABLES
+from prices import watch_price_changes, reprice, RepriceError, PRICE_CATALOGS
+from simulator import StageCostMatrix, ScenarioError, validate_scenarios
+from project_tree import find_project, find_stage, load_project_tree, project_tree_dict
+from costs import stage_concept_costs_query, concept_cost_columns, budget_totals, budget_total, phase_budgets_subquery, CATALOG_COLUMN_TYPES
 from models import db, Unit, Project, Stage, Phase, Concept, Tool, Job, Machinery, Material, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, Locations, MaterialEntry, MaterialMove, MaterialExit, ToolEntry, ToolMove, ToolExit, Providor, MaqRental, Investor, jobs_history_employees, Employee, JobsHistory, Specialty, NewUser, User, Position, File
 import string
+import click
 from sqlalchemy.exc import IntegrityError
 
 
@@ -23,52 +41,242 @@ COMPANY = 'Vive RAMZSA'
 COMPANY_SLOGAN = 'Lujo, sostenibilidad e innovacion, juntos en cada proyecto.'
 DATE = date.today()
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get("FLASK_KEY")
-ckeditor = CKEditor(app)
-Bootstrap5(app)
+ckeditor = CKEditor()
+bootstrap = Bootstrap5()
 
 #CONFIGURE LOGIN MANAGER
 login_manager = LoginManager()
-login_manager.init_app(app)
+
+replica_router = ReplicaRouter(db)
+query_monitor = QueryMonitor()
+route_metrics = RouteMetrics()
+request_profiler = RequestProfiler()
+
+# Pages, JSON endpoints and CLI commands, registered on every app made by create_app.
+# The commands stay at the top level: flask --app main init-db
+views = Blueprint('views', __name__, cli_group=None)
+
+# The session listeners are on the Session class, shared by every app of the process
+watching_models = False
+
+
+def watch_models():
+    global watching_models
+    if watching_models:
+        return
+    # Stock on hand per material and location, updated with every material movement
+    watch_stock_movements()
+    watch_backdated_movements()
+    watch_tool_custody()
+    watch_valuation()
+    watch_variance_sources()
+    watch_price_changes()
+    watch_user_changes()
+    watching_models = True
+
+
+# Builds the app from the environment. Nothing here touches the database, so workers boot
+# without DDL checks; the tables and the creator user are created once with init-db.
+def create_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get("FLASK_KEY")
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", 'sqlite:///viveramzsa.db')
+    # Pool of Postgres and pragmas of SQLite, from the DB_POOL_* and SQLITE_* variables
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLITE_PRAGMAS'] = sqlite_pragmas()
+    # Comma separated URIs of read replicas for the GET requests of the views marked with replica_reads
+    replica_uris = [uri.strip() for uri in os.environ.get("DB_REPLICA_URIS", '').split(',') if uri.strip()]
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(replica_uris, engine_options)
+    app.config['REPLICA_LAG_WINDOW'] = int(os.environ.get("REPLICA_LAG_WINDOW", 5))
+    app.config['USER_CACHE_SIZE'] = int(os.environ.get("USER_CACHE_SIZE", 256))
+    app.config['USER_CACHE_TTL'] = int(os.environ.get("USER_CACHE_TTL", 300))
+    # Queries per request, over QUERY_BUDGET a warning is logged with the most repeated statement
+    app.config['QUERY_BUDGET'] = int(os.environ.get("QUERY_BUDGET", 50))
+    # Cost of the material and tool exits: 'average' (weighted average) or 'fifo'
+    app.config['VALUATION_METHOD'] = os.environ.get("VALUATION_METHOD", 'average').lower()
+    # Latency, errors and requests in flight per route at /metrics, shared by the workers through METRICS_DIR
+    app.config['METRICS_DIR'] = os.environ.get("METRICS_DIR", os.path.join(app.instance_path, 'metrics'))
+    # Bearer token the scraper sends to read /metrics, without it /metrics isn't served
+    app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+    # Admins can profile a single request adding ?profile=1 to its URL, the profiles are listed at /profiles
+    app.config['PROFILES_DIR'] = os.environ.get("PROFILES_DIR", os.path.join(app.instance_path, 'profiles'))
+    os.makedirs(app.instance_path, exist_ok=True)
+
+    ckeditor.init_app(app)
+    bootstrap.init_app(app)
+    login_manager.init_app(app)
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            apply_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+    replica_router.init_app(app)
+    # Flask-Login keeps the loaded user for the rest of the request, so views and
+    # templates read current_user instead of querying the user again. Between requests
+    # the users are kept in an in-process cache, invalidated whenever a user is changed.
+    UserCache().init_app(app)
+    query_monitor.init_app(app)
+    route_metrics.init_app(app)
+    request_profiler.init_app(app, is_allowed=lambda: current_user.is_authenticated and bool(current_user.is_admin))
+
+    watch_models()
+    app.register_blueprint(views)
+
+    return app
+
 
 #USER LOGIN CALLBACK
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return current_app.extensions['user_cache'].load_user(int(user_id))
+
+
+# Variables shared by every template
+@views.app_context_processor
+def inject_layout():
+    return dict(
+        company=COMPANY,
+        slogan=COMPANY_SLOGAN,
+        date=DATE,
+        logged_in=current_user.is_authenticated,
+        is_admin=current_user.is_authenticated and bool(current_user.is_admin),
+        user=current_user
+    )
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", 'sqlite:///viveramzsa.db')
-db.init_app(app)
-with app.app_context():
-    db.create_all()
-    db.session.commit()
 
+def seed_creator():
+    # Only an empty database gets the Creator, checked with EXISTS instead of loading every user
+    if db.session.query(User.query.exists()).scalar():
+        return False
 
-with app.app_context():
-    # Check if there are no users in the database
-    if not User.query.all():
-        # Add the Creator's position
-        creator_position = Position(
-            name='The Creator',
-            description="The creator's position is 'The Creator'."
-        )
-        db.session.add(creator_position)
-        db.session.commit()
+    # Add the Creator's position
+    creator_position = Position(
+        name='The Creator',
+        description="The creator's position is 'The Creator'."
+    )
 
-        # Retrieve the created position
-        created_position = Position.query.filter_by(name='The Creator').first()
-
-        # Add the Creator user
-        creator = User(
-            email=os.environ.get("CREATOR_USER"),
-            password=generate_password_hash(os.environ.get("CREATOR_PASSWORD"), method='pbkdf2:sha256', salt_length=8),
-            name='RAZS',
-            gram='RAZS',
-            is_admin=True,
-            position=created_position  # Use the created position
-        )
-        db.session.add(creator)
-        db.session.commit()
+    # Add the Creator user
+    creator = User(
+        email=os.environ.get("CREATOR_USER"),
+        password=generate_password_hash(os.environ.get("CREATOR_PASSWORD"), method='pbkdf2:sha256', salt_length=8),
+        name='RAZS',
+        gram='RAZS',
+        is_admin=True,
+        position=creator_position
+    )
+    db.session.add_all([creator_position, creator])
+    db.session.commit()
+    return True
+
+
+# Creates the tables, the indexes and the creator user, once per database and deploy:
+# flask --app main init-db
+@views.cli.command('init-db')
+def init_db():
+    for created in upgrade_database(db.engine):
+        print(f'Created {created}')
+    if seed_creator():
+        print('Created the creator user')
+
+
+# Creates the tables, columns and indexes missing in an existing database:
+# flask --app main upgrade-db
+@views.cli.command('upgrade-db')
+def upgrade_db():
+    for created in upgrade_database(db.engine):
+        print(f'Created {created}')
+
+
+# Rebuilds the stock on hand from the movement history, reporting the balances that were off:
+# flask --app main reconcile-stock
+@views.cli.command('reconcile-stock')
+def reconcile_stock():
+    mismatches = reconcile_material_stock()
+    for (material_id, location_id), (ledger_quantity, history_quantity) in sorted(mismatches.items()):
+        print(f'Material {material_id} in location {location_id}: {ledger_quantity} in the ledger, {history_quantity} in the history')
+    print(f'{len(mismatches)} balances corrected')
+
+    mismatches = reconcile_tool_custody()
+    for (tool_id, location_id), ((ledger_quantity, ledger_holder), (history_quantity, history_holder)) in sorted(mismatches.items()):
+        print(f'Tool {tool_id} in location {location_id}: {ledger_quantity} held by {ledger_holder} in the ledger, {history_quantity} held by {history_holder} in the history')
+    print(f'{len(mismatches)} tool custodies corrected')
+
+
+# Saves the inventory at the end of a date, or of every closed month missing, for the "as of" queries:
+# flask --app main snapshot-inventory --monthly
+@views.cli.command('snapshot-inventory')
+@click.option('--date', 'snapshot_date', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--monthly', is_flag=True, help='Snapshots of every month end missing until the last closed month')
+def snapshot_inventory(snapshot_date, monthly):
+    if monthly:
+        snapshot_dates = take_monthly_snapshots()
+    else:
+        snapshot_dates = [take_snapshot(snapshot_date.date() if snapshot_date else DATE).snapshot_date]
+    for taken_date in snapshot_dates:
+        print(f'Inventory snapshot of {taken_date}')
+
+
+# Values the inventory on hand at the end of a date, revaluing first the items valued with another method, e.g.
+# after VALUATION_METHOD changes, or every item with --all: flask --app main value-inventory --date 2024-01-31
+@views.cli.command('value-inventory')
+@click.option('--date', 'as_of_date', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--all', 'everything', is_flag=True, help='Revalue every item from its whole history')
+def value_inventory(as_of_date, everything):
+    print(f'{revalue_stale_items(everything=everything)} items revalued')
+    for family in INVENTORY_FAMILIES:
+        values = inventory_values(family, as_of_date.date() if as_of_date else None)
+        print(f'{family}: {sum(values.values()):,.2f} in {len(values)} balances')
+
+
+# Imports a supplier price list or a budget catalog, the rows with errors are skipped and reported:
+# flask --app main import-table materials prices.csv --errors errors.csv
+# flask --app main import-table mat_generators budget.xlsx --stage-id 3
+@views.cli.command('import-table')
+@click.argument('table_name', type=click.Choice(list(IMPORT_TABLES)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--stage-id', type=int, help='Stage whose phases and concepts the codes of the file refer to')
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), help='CSV file for the rows with errors')
+def import_table_command(table_name, path, stage_id, errors_path):
+    try:
+        with open(path, 'rb') as stream:
+            report = import_table(table_name, stream, path, stage_id=stage_id)
+    except ImportFileError as error:
+        raise click.ClickException(str(error))
+
+    print(f"{report['inserted']} rows inserted, {report['updated']} updated, {len(report['errors'])} errors")
+    if errors_path:
+        with open(errors_path, 'w', newline='') as stream:
+            write_error_report(report['errors'], stream)
+    else:
+        for error in report['errors'][:20]:
+            print(f"Row {error['row']}, {error['column']}: {error['error']}")
+
+
+# Changes the prices of a catalog by a percentage or an amount, saving the previous ones in the price history:
+# flask --app main reprice materials --percent 4.5 --unit m3 --name 'cemento%'
+@views.cli.command('reprice')
+@click.argument('catalog_name', type=click.Choice(list(PRICE_CATALOGS)))
+@click.option('--percent', type=float)
+@click.option('--amount', type=float)
+@click.option('--unit', help='Only the items with this unit')
+@click.option('--name', 'name_pattern', help='Only the items whose name is like this SQL pattern')
+@click.option('--date', 'effective_date', type=click.DateTime(formats=['%Y-%m-%d']))
+def reprice_command(catalog_name, percent, amount, unit, name_pattern, effective_date):
+    try:
+        changed = reprice(catalog_name, percent=percent, amount=amount, unit=unit, name_pattern=name_pattern,
+                          effective_date=effective_date.date() if effective_date else None)
+    except RepriceError as error:
+        raise click.ClickException(str(error))
+    print(f'{changed} prices changed')
+
+
+# Adds a synthetic dataset, for benchmarks and load tests:
+# flask --app main seed-synthetic --size medium --seed 1
+@views.cli.command('seed-synthetic')
+@click.option('--size', type=click.Choice(list(SYNTHETIC_VOLUMES)), default='small')
+@click.option('--seed', type=int, default=0)
+def seed_synthetic(size, seed):
+    for table_name, rows in seed_synthetic_data(SYNTHETIC_VOLUMES[size], seed=seed).items():
+        print(f'{table_name}: {rows} rows')
 
 
 # Decorator function to require admin access for a view function.
@@ -77,7 +285,7 @@ def login_required(view_func):
     def decorated_view(*args, **kwargs):
         if not current_user.is_authenticated:
             # Redirect to login page if the user is not logged in
-            return redirect(url_for('login'))
+            return redirect(url_for('views.login'))
         # Call the original view function if the user is logged in and is an admin
         return view_func(*args, **kwargs)
     return decorated_view
@@ -88,11 +296,10 @@ def admin_required(view_func):
     def decorated_view(*args, **kwargs):
         if not current_user.is_authenticated:
             # Redirect to login page if the user is not logged in
-            return redirect(url_for('login'))
+            return redirect(url_for('views.login'))
 
         # Check if the user is an admin
-        user = User.query.get(current_user.get_id())
-        if not user.is_admin:
+        if not current_user.is_admin:
             # Redirect to a forbidden page or show an error message
             return "Forbidden: You must be an admin to access this page."
 
@@ -102,32 +309,19 @@ def admin_required(view_func):
     return decorated_view
 
 
-@app.route("/profile/<int:user_id>")
+@views.route("/profile/<int:user_id>")
 @login_required
 def show_profile(user_id):
     requested_user = User.query.get(user_id) 
 
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
-
     return render_template(
         "profile.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         requested_user=requested_user,
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         route="/profile"
         )
 
 
-@app.route("/edit_profile/<int:user_id>", methods=['GET', 'POST'])
+@views.route("/edit_profile/<int:user_id>", methods=['GET', 'POST'])
 @login_required
 def edit_profile(user_id):
     user_to_edit = User.query.get(user_id)
@@ -152,17 +346,17 @@ def edit_profile(user_id):
             # Handle image upload
             user_name = user_to_edit.name.replace(' ', '_').lower()
             user_path = os.path.join('static', 'assets', 'users', user_name)
-            app.config['USER_PP_UPLOAD_PATH'] = os.path.join(user_path, 'profile_picture')
-            app.config['USER_PP_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
+            current_app.config['USER_PP_UPLOAD_PATH'] = os.path.join(user_path, 'profile_picture')
+            current_app.config['USER_PP_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
             file = request.files['profile_picture']
             if file:
                 filename = secure_filename(file.filename)
                 file_ext = os.path.splitext(filename)[1]
-                if file_ext not in app.config['USER_PP_UPLOAD_EXTENSIONS']:
+                if file_ext not in current_app.config['USER_PP_UPLOAD_EXTENSIONS']:
                     abort(400)
                 else:
                     filename = secure_filename(f"{user_to_edit.gram.lower()}_pp{file_ext}")
-                    file.save(os.path.join(app.config['USER_PP_UPLOAD_PATH'], filename))
+                    file.save(os.path.join(current_app.config['USER_PP_UPLOAD_PATH'], filename))
                     img_path = os.path.join('..', 'static', 'assets', 'users', user_name, 'profile_picture', filename)
             else:
                 img_path = "../static/assets/img/default-profile.jpg"
@@ -170,26 +364,13 @@ def edit_profile(user_id):
             user_to_edit.profile_picture = img_path
 
             db.session.commit()
-            return redirect(url_for("show_profile", user_id=user_to_edit.id))
+            return redirect(url_for("views.show_profile", user_id=user_to_edit.id))
         else:
             print(form.errors)
 
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
-
     return render_template(
         "profile.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         requested_user=user_to_edit,
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         route="/edit_profile",
         form=form
         )
@@ -198,7 +379,7 @@ def edit_profile(user_id):
 
 # Esta parte del codigo esta bien rara, probablemente nos desahagmos de esto, 
 # pero por ahora nos sirve para completar algunos flujos.
-@app.route("/create_new_record", methods=["GET", "POST"])
+@views.route("/create_new_record", methods=["GET", "POST"])
 @login_required
 def create_new_record():
     models_list = [Unit, Project, Stage, Phase, Concept, Tool, Job, Machinery, Material, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, Locations, MaterialEntry, MaterialMove, MaterialExit, ToolEntry, ToolMove, ToolExit, Providor, Investor, Employee, JobsHistory, Specialty, Position, File]
@@ -237,10 +418,10 @@ def create_new_record():
                                 if file:
                                     filename = str(eval(f'create_form.{field_name}.data')).lower()
                                     file_ext = os.path.splitext(filename)[1]
-                                    if file_ext not in app.config['IMG_UPLOAD_EXTENSIONS']:
+                                    if file_ext not in current_app.config['IMG_UPLOAD_EXTENSIONS']:
                                         abort(400)
                                     else:
-                                        file.save(os.path.join(app.config['IMG_UPLOAD_PATH'], filename))
+                                        file.save(os.path.join(current_app.config['IMG_UPLOAD_PATH'], filename))
                                         field_data = repr(os.path.join('/static/assets/img', filename))
                             elif 'profile_picture' in field_name.lower():
                                 # Handle file upload
@@ -248,10 +429,10 @@ def create_new_record():
                                 if file:
                                     filename = eval(f'create_form.{field_name}.data')
                                     file_ext = os.path.splitext(filename)[1]
-                                    if file_ext not in app.config['PP_UPLOAD_EXTENSIONS']:
+                                    if file_ext not in current_app.config['PP_UPLOAD_EXTENSIONS']:
                                         abort(400)
                                     else:
-                                        file.save(os.path.join(app.config['PP_UPLOAD_PATH'], filename))
+                                        file.save(os.path.join(current_app.config['PP_UPLOAD_PATH'], filename))
                                         field_data = repr(os.path.join('/static/assets/profile_pictures', filename))
                             elif 'file_path' in field_name.lower():
                                 # Handle file upload
@@ -260,28 +441,28 @@ def create_new_record():
                                     filename = eval(f'create_form.{field_name}.data')
                                     file_ext = os.path.splitext(filename)[1]
                                     if 'render' in f'{model}'.lower():
-                                        if file_ext not in app.config['RENDER_UPLOAD_EXTENSIONS']:
+                                        if file_ext not in current_app.config['RENDER_UPLOAD_EXTENSIONS']:
                                             abort(400)
                                         else:
-                                            file.save(os.path.join(app.config['RENDER_UPLOAD_PATH'], filename))
+                                            file.save(os.path.join(current_app.config['RENDER_UPLOAD_PATH'], filename))
                                             field_data = repr(os.path.join('/static/assets/renders', filename))
                                     elif 'plan' in f'{model}'.lower():
-                                        if file_ext not in app.config['PLAN_UPLOAD_EXTENSIONS']:
+                                        if file_ext not in current_app.config['PLAN_UPLOAD_EXTENSIONS']:
                                             abort(400)
                                         else:
-                                            file.save(os.path.join(app.config['PLAN_UPLOAD_PATH'], filename))
+                                            file.save(os.path.join(current_app.config['PLAN_UPLOAD_PATH'], filename))
                                             field_data = repr(os.path.join('/static/assets/plans', filename))
                                     elif 'diagram' in f'{model}'.lower():
-                                        if file_ext not in app.config['DIAGRAM_UPLOAD_EXTENSIONS']:
+                                        if file_ext not in current_app.config['DIAGRAM_UPLOAD_EXTENSIONS']:
                                             abort(400)
                                         else:
-                                            file.save(os.path.join(app.config['DIAGRAM_UPLOAD_PATH'], filename))
+                                            file.save(os.path.join(current_app.config['DIAGRAM_UPLOAD_PATH'], filename))
                                             field_data = repr(os.path.join('/static/assets/diagrams', filename))
                                     elif 'video' in f'{model}'.lower():
-                                        if file_ext not in app.config['VIDEO_UPLOAD_EXTENSIONS']:
+                                        if file_ext not in current_app.config['VIDEO_UPLOAD_EXTENSIONS']:
                                             abort(400)
                                         else:
-                                            file.save(os.path.join(app.config['VIDEO_UPLOAD_PATH'], filename))
+                                            file.save(os.path.join(current_app.config['VIDEO_UPLOAD_PATH'], filename))
                                             field_data = repr(os.path.join('/static/assets/videos', filename))
                             else:
                                 field_data = repr(field.data)
@@ -293,197 +474,122 @@ def create_new_record():
                 db.session.add(new_record)
                 db.session.commit()
                 flash('New record succesfully created!')
-                return redirect(url_for("create_new_record"))
+                return redirect(url_for("views.create_new_record"))
             
     if create_form == None:
         form = select_form
     else:
         form= create_form
 
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
-
     return render_template(
         "new_record_x.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form,
         selected_model = f'{model}'.replace("<class 'models.",'').replace("'>",''),
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user
     )
 
 
 
-@app.route('/positions', methods=['GET', 'POST'])
+@views.route('/positions', methods=['GET', 'POST'])
+@replica_reads
 @login_required
 def get_positions():
     page_title = 'Positions'
 
     # Definning the table:
-    # Query the SQLAlchemy table
-    query_results = db.session.query(Position).all()
-
-    # Convert the query result to a list of dictionaries
-    data = []
-    for query in query_results:
-        query_dict = {
-            'id': query.id,
-            'name': query.name,
-            'description': query.description
-        }
-        data.append(query_dict)
-
-    # Convert the list of dictionaries to a Pandas DataFrame
-    users_table = pd.DataFrame(data)
-
-    self_filtering_table = SelfFilteringTable(
-        df=users_table, 
-        columns=['id', 'name', 'description'],
+    # The filters, sorting and limit are applied by the database
+    self_filtering_table = QueryFilteringTable(
+        query=db.session.query(Position.id, Position.name, Position.description),
+        columns={'id': Position.id, 'name': Position.name, 'description': Position.description},
         column_types=[int, str, str]
         )
     
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "tables.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         page_title=page_title, 
         filtering_form=self_filtering_table.form, 
         table=self_filtering_table.table, 
+        table_body=self_filtering_table.body, 
         filters_applied=len(self_filtering_table.filtering_inputs)>0, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, user=current_user, 
         sort_column=self_filtering_table.sort_column, 
         sort_direction=self_filtering_table.sort_direction, 
         columns=self_filtering_table.columns,
+        has_previous=self_filtering_table.has_previous,
+        has_next=self_filtering_table.has_next,
         col_span=self_filtering_table.df.shape[1]
         )
 
 
-@app.route('/users', methods=['GET', 'POST'])
+@views.route('/users', methods=['GET', 'POST'])
+@replica_reads
 @login_required
 def get_users():
     page_title = 'Users'
 
     # Definning the table:
-    # Query the SQLAlchemy table
-    users_query = db.session.query(User).all()
-
-    # Convert the query result to a list of dictionaries
-    users_data = []
-    for user in users_query:
-        user_dict = {
-            'id': user.id,
-            'name': user.name,
-            'email': user.email,
-            'position': user.position.name if user.position else None
-        }
-        users_data.append(user_dict)
-
-    # Convert the list of dictionaries to a Pandas DataFrame
-    users_table = pd.DataFrame(users_data)
-
-    self_filtering_table = SelfFilteringTable(
-        df=users_table, 
-        columns=['id', 'name', 'email', 'position'],
+    # The filters, sorting and limit are applied by the database
+    users_query = db.session.query(
+        User.id, User.name, User.email, Position.name
+    ).outerjoin(
+        Position, Position.id == User.position_id
+    )
+
+    self_filtering_table = QueryFilteringTable(
+        query=users_query,
+        columns={'id': User.id, 'name': User.name, 'email': User.email, 'position': Position.name},
         column_types=[int, str, str, str]
         )
     
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "users.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         page_title=page_title, 
         filtering_form=self_filtering_table.form, 
         table=self_filtering_table.table, 
+        rows=self_filtering_table.rows, 
         filters_applied=len(self_filtering_table.filtering_inputs)>0, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, user=current_user, 
         sort_column=self_filtering_table.sort_column, 
         sort_direction=self_filtering_table.sort_direction, 
         columns=self_filtering_table.columns,
+        has_previous=self_filtering_table.has_previous,
+        has_next=self_filtering_table.has_next,
         col_span=self_filtering_table.df.shape[1]
         )
 
 
-@app.route('/new_users', methods=['GET', 'POST'])
+@views.route('/new_users', methods=['GET', 'POST'])
 @login_required
 def new_users():
     page_title = 'New Users'
     
     # Definning the table:
-    # Query the SQLAlchemy table
-    users_query = db.session.query(NewUser).all()
-
-    # Convert the query result to a list of dictionaries
-    users_data = []
-    for user in users_query:
-        user_dict = {
-            'id': user.id,
-            'name': user.name,
-            'email': user.email,
-            'status': user.status
-        }
-        users_data.append(user_dict)
-
-    # Convert the list of dictionaries to a Pandas DataFrame
-    users_table = pd.DataFrame(users_data)
-
-    self_filtering_table = SelfFilteringTable(
-        df=users_table, 
-        columns=['id', 'name', 'email', 'status'],
+    # The filters, sorting and limit are applied by the database
+    self_filtering_table = QueryFilteringTable(
+        query=db.session.query(NewUser.id, NewUser.name, NewUser.email, NewUser.status),
+        columns={'id': NewUser.id, 'name': NewUser.name, 'email': NewUser.email, 'status': NewUser.status},
         column_types=[int, str, str, str]
         )
 
     positions = Position.query.all()
 
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
-
     return render_template(
         "new_users.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         page_title=page_title, 
         filtering_form=self_filtering_table.form, 
         table=self_filtering_table.table, 
+        rows=self_filtering_table.rows, 
         filters_applied=len(self_filtering_table.filtering_inputs)>0, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, user=current_user, 
         sort_column=self_filtering_table.sort_column, 
         sort_direction=self_filtering_table.sort_direction, 
         columns=self_filtering_table.columns,
+        has_previous=self_filtering_table.has_previous,
+        has_next=self_filtering_table.has_next,
         positions = positions,
         col_span=self_filtering_table.df.shape[1] + 3
         )
 
 
-@app.route("/create_new_user/<int:new_user_id>", methods=['POST'])
+@views.route("/create_new_user/<int:new_user_id>", methods=['POST'])
 @admin_required  # Require admin access in addition to login
 def create_new_user(new_user_id):
     new_user = db.get_or_404(NewUser, new_user_id)
@@ -506,7 +612,7 @@ def create_new_user(new_user_id):
             
         except OSError as e:
             flash(f'Error creating user directories: {e}', 'danger')
-            return redirect(url_for("new_user"))
+            return redirect(url_for("views.new_user"))
 
         # Check if the 'is_admin' checkbox is checked
         is_admin = request.form.get("is_admin") == 'True'
@@ -528,17 +634,38 @@ def create_new_user(new_user_id):
         new_user.status = 'Denied'
         db.session.commit()
     
-    return redirect(url_for('new_users'))
+    return redirect(url_for('views.new_users'))
+
+
+@views.route('/profiles')
+@admin_required
+def get_request_profiles():
+    return render_template("request_profiles.html", page_title='Request Profiles', reports=request_profiler.recent_reports())
 
 
-@app.route('/register', methods = ['GET', 'POST'])
+@views.route('/profiles/<profile_name>')
+@admin_required
+def show_request_profile(profile_name):
+    report = request_profiler.load_report(profile_name)
+    if report is None:
+        abort(404)
+    return render_template("request_profile.html", page_title=report['path'], report=report)
+
+
+@views.route('/profiles/<profile_name>/download')
+@admin_required
+def download_request_profile(profile_name):
+    return send_from_directory(current_app.config['PROFILES_DIR'], f'{profile_name}.prof', as_attachment=True)
+
+
+@views.route('/register', methods = ['GET', 'POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         new_user = NewUser.query.filter_by(email=form.email.data).first()
         if user:
-            flash("You've already signed PU with that email, <a href='" + url_for('login') + "'>log in</a> instead!")
+            flash("You've already signed PU with that email, <a href='" + url_for('views.login') + "'>log in</a> instead!")
         elif new_user:
             flash("Your account has already been registered but it has not been aproved yet. You will be notified when it does.")
         else:
@@ -550,28 +677,16 @@ def register():
             )
             db.session.add(new_user)
             db.session.commit()
-            return redirect(url_for('get_all_projects'))
+            return redirect(url_for('views.get_all_projects'))
         
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "register.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user
         )
 
 
-@app.route('/login', methods = ['POST', 'GET'])
+@views.route('/login', methods = ['POST', 'GET'])
 def login():
     form=LoginForm()
     if form.validate_on_submit():
@@ -581,59 +696,37 @@ def login():
             # Check stored password hash against entered password hashed.
             if check_password_hash(user.password, form.password.data):
                 login_user(user)
-                return redirect(url_for('get_all_projects'))
+                return redirect(url_for('views.get_all_projects'))
             else:
                 flash('Password incorrect, please try again.')
         elif new_user:
             flash("Your account has not been aproved yet. You will be notified when it does.")
         else:
-            flash('That email does not exist, please <a href="' + url_for('register') + '">register</a> or try again.')
-
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
+            flash('That email does not exist, please <a href="' + url_for('views.register') + '">register</a> or try again.')
 
     return render_template(
         "login.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user
         )
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('get_all_projects'))
+    return redirect(url_for('views.get_all_projects'))
 
 
-@app.route('/')
+@views.route('/')
 def get_all_projects():
     projects = Project.query.all()
 
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
+    # Budgets are only shown to logged in users
+    budgets = budget_totals('project') if current_user.is_authenticated else {}
 
     return render_template(
         "index.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         all_projects=projects, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user)
+        budgets=budgets)
 
 
 
@@ -653,34 +746,28 @@ SUBDIRECTORIES = [
 ]
 
 # PROJECTS MANAGEMENT
-@app.route("/project/<project_name>", methods=['GET', 'POST'])
+@views.route("/project/<project_name>", methods=['GET', 'POST'])
+@replica_reads
 def show_project(project_name):
-    requested_project = Project.query.filter_by(name=project_name.replace('_', ' ').title()).first()
-    #requested_project = Project.query.get(project_id)
-    stages = Stage.query.filter_by(project_id=requested_project.id).all()
-
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
+    requested_project = find_project(project_name)
+    if not requested_project:
+        abort(404)
+    stages = sorted(requested_project.stages, key=lambda stage: stage.id)
+
+    # Budgets are only shown to logged in users
+    budgets = budget_totals('stage', Stage.project_id == requested_project.id) if current_user.is_authenticated else {}
 
     return render_template(
         "project.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         project=requested_project, 
         stages=stages, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user
+        budgets=budgets,
+        project_budget=budget_total(budgets),
         )
 
 
 
-@app.route("/new_project", methods=["GET", "POST"])
+@views.route("/new_project", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def add_new_project():
     record_type = "project"
@@ -708,20 +795,20 @@ def add_new_project():
 
             except OSError as e:
                 flash(f'Error creating project directories: {e}', 'danger')
-                return redirect(url_for("add_new_project"))
+                return redirect(url_for("views.add_new_project"))
             
             # Handle image upload
-            app.config['PROJECT_IMG_UPLOAD_PATH'] = os.path.join(new_project_path, 'img')
-            app.config['PROJECT_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
+            current_app.config['PROJECT_IMG_UPLOAD_PATH'] = os.path.join(new_project_path, 'img')
+            current_app.config['PROJECT_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
             file = request.files['img']
             if file:
                 filename = secure_filename(file.filename)
                 file_ext = os.path.splitext(filename)[1]
-                if file_ext not in app.config['PROJECT_IMG_UPLOAD_EXTENSIONS']:
+                if file_ext not in current_app.config['PROJECT_IMG_UPLOAD_EXTENSIONS']:
                     abort(400)
                 else:
                     filename = secure_filename(f"main_project_image{file_ext}")
-                    file.save(os.path.join(app.config['PROJECT_IMG_UPLOAD_PATH'], filename))
+                    file.save(os.path.join(current_app.config['PROJECT_IMG_UPLOAD_PATH'], filename))
                     img_path = os.path.join('/static', 'assets', 'projects', project_name, 'img', filename)
             else:
                 img_path = "/static/assets/img/I.1.png"
@@ -738,27 +825,17 @@ def add_new_project():
             db.session.add(new_project)
             db.session.commit()
             
-            return redirect(url_for("get_all_projects"))
+            return redirect(url_for("views.get_all_projects"))
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         record_type = record_type
     )
 
 
-@app.route("/edit_project/<int:project_id>", methods=["GET", "POST"])
+@views.route("/edit_project/<int:project_id>", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def edit_project(project_id):
     record_type = "project"
@@ -787,17 +864,17 @@ def edit_project(project_id):
                 
 
                 # Handle image upload
-                app.config['PROJECT_IMG_UPLOAD_PATH'] = os.path.join(project_path, 'img')
-                app.config['PROJECT_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
+                current_app.config['PROJECT_IMG_UPLOAD_PATH'] = os.path.join(project_path, 'img')
+                current_app.config['PROJECT_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
                 file = request.files['img']
                 if file:
                     filename = secure_filename(file.filename)
                     file_ext = os.path.splitext(filename)[1]
-                    if file_ext not in app.config['PROJECT_IMG_UPLOAD_EXTENSIONS']:
+                    if file_ext not in current_app.config['PROJECT_IMG_UPLOAD_EXTENSIONS']:
                         abort(400)
                     else:
                         filename = secure_filename(f"main_project_image{file_ext}")
-                        file.save(os.path.join(app.config['PROJECT_IMG_UPLOAD_PATH'], filename))
+                        file.save(os.path.join(current_app.config['PROJECT_IMG_UPLOAD_PATH'], filename))
                         img_path = os.path.join('/static', 'assets', 'projects', project_name, 'img', filename)
                 else:
                     img_path = os.path.join(project_path, 'img', project_to_edit.img.split('/')[-1])
@@ -813,32 +890,22 @@ def edit_project(project_id):
                 
                 db.session.commit()
                 
-                return redirect(url_for('show_project', project_name=project_to_edit.name.lower().replace(' ', '_')))
+                return redirect(url_for('views.show_project', project_name=project_to_edit.name.lower().replace(' ', '_')))
             
             except OSError as e:
                 flash(f'Error editing project: {e}', 'danger')
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         is_edit=True,
         project = project_to_edit,
         record_type = record_type
     )
 
 
-@app.route("/delete/<int:project_id>")
+@views.route("/delete/<int:project_id>")
 @admin_required  # Require admin access in addition to login
 def delete_project(project_id):
     project_to_delete = db.get_or_404(Project, project_id)
@@ -856,75 +923,61 @@ def delete_project(project_id):
     
     db.session.delete(project_to_delete)
     db.session.commit()
-    return redirect(url_for('get_all_projects'))
+    return redirect(url_for('views.get_all_projects'))
 
 
 
 
 # STAGES MANAGEMENT
-@app.route("/project/<project_name>/stage/<stage_name>", methods=['GET', 'POST'])
+@views.route("/project/<project_name>/stage/<stage_name>", methods=['GET', 'POST'])
+@replica_reads
 def show_stage(project_name, stage_name):
-    project_name_title = project_name.replace('_', ' ').title()
-    stage_name_title = stage_name.replace('_', ' ').title()
-    
     # Query the project and the stage
-    requested_project = Project.query.filter_by(name=project_name_title).first()
-    requested_stage = Stage.query.filter_by(project_id=requested_project.id, name=stage_name_title).first()
-    
-    if not requested_project or not requested_stage:
+    requested_project, requested_stage = find_stage(project_name, stage_name)
+    if not requested_stage:
         abort(404)
     
-    phases = Phase.query.filter_by(stage_id=requested_stage.id).all()
-    
-    # Convert the phases to a list of dictionaries
-    data = []
-    for phase in phases:
-        phase_dict = {
-            'id': phase.id,
-            'code': phase.code,
-            'name': phase.name,
-            'description': phase.description
-        }
-        data.append(phase_dict)
-    
-    # Convert the list of dictionaries to a Pandas DataFrame
-    phases_table = pd.DataFrame(data)
+    # Budgets are only shown to logged in users, anonymous visits don't refresh the cached costs
+    budgets = budget_totals('phase', Phase.stage_id == requested_stage.id) if current_user.is_authenticated else {}
+
+    # The filters, sorting and limit are applied by the database
+    phase_budgets = phase_budgets_subquery()
+    phase_direct_cost = func.coalesce(phase_budgets.c.direct_cost, 0)
+    phases_query = db.session.query(
+        Phase.id, Phase.code, Phase.name, Phase.description, phase_direct_cost
+    ).outerjoin(
+        phase_budgets, phase_budgets.c.phase_id == Phase.id
+    ).filter(
+        Phase.stage_id == requested_stage.id
+    )
     
-    self_filtering_table = SelfFilteringTable(
-        df=phases_table,
-        columns=['id', 'code', 'name', 'description'],
-        column_types=[int, str, str, str]
+    self_filtering_table = QueryFilteringTable(
+        query=phases_query,
+        columns={'id': Phase.id, 'code': Phase.code, 'name': Phase.name, 'description': Phase.description, 'direct cost': phase_direct_cost},
+        column_types=[int, str, str, str, float]
     )
     
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "stage.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         project=requested_project, 
         stage=requested_stage, 
+        stage_budget=budget_total(budgets),
         filtering_form=self_filtering_table.form,
         table=self_filtering_table.table, 
+        rows=self_filtering_table.rows, 
         filters_applied=len(self_filtering_table.filtering_inputs) > 0, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user, 
         sort_column=self_filtering_table.sort_column, 
         sort_direction=self_filtering_table.sort_direction, 
         columns=self_filtering_table.columns,
+        has_previous=self_filtering_table.has_previous,
+        has_next=self_filtering_table.has_next,
         col_span=self_filtering_table.df.shape[1]
     )
 
 
 
-@app.route("/new_stage/<int:project_id>", methods=["GET", "POST"])
+@views.route("/new_stage/<int:project_id>", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def add_new_stage(project_id):
     record_type = "stage"
@@ -953,20 +1006,20 @@ def add_new_stage(project_id):
             
             except OSError as e:
                 flash(f'Error creating stage directories: {e}', 'danger')
-                return redirect(url_for("add_new_stage", project_id=project_id))
+                return redirect(url_for("views.add_new_stage", project_id=project_id))
             
             # Handle image upload
-            app.config['STAGE_IMG_UPLOAD_PATH'] = os.path.join(new_stage_path, 'img')
-            app.config['STAGE_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
+            current_app.config['STAGE_IMG_UPLOAD_PATH'] = os.path.join(new_stage_path, 'img')
+            current_app.config['STAGE_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
             file = request.files['img']
             if file:
                 filename = secure_filename(file.filename)
                 file_ext = os.path.splitext(filename)[1]
-                if file_ext not in app.config['STAGE_IMG_UPLOAD_EXTENSIONS']:
+                if file_ext not in current_app.config['STAGE_IMG_UPLOAD_EXTENSIONS']:
                     abort(400)
                 else:
                     filename = secure_filename(f"main_stage_image{file_ext}")
-                    file.save(os.path.join(app.config['STAGE_IMG_UPLOAD_PATH'], filename))
+                    file.save(os.path.join(current_app.config['STAGE_IMG_UPLOAD_PATH'], filename))
                     img_path = os.path.join('/static', 'assets', 'projects', project_name, 'stages', stage_name, 'img', filename)
             else:
                 img_path = "/static/assets/img/I.1.png"
@@ -984,29 +1037,19 @@ def add_new_stage(project_id):
             db.session.add(new_stage)
             db.session.commit()
             
-            return redirect(url_for("show_project", project_name=project_name))
+            return redirect(url_for("views.show_project", project_name=project_name))
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         project=project,
         record_type = record_type
     )
 
 
 
-@app.route("/edit_stage/<int:stage_id>", methods=["GET", "POST"])
+@views.route("/edit_stage/<int:stage_id>", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def edit_stage(stage_id):
     record_type = "stage"
@@ -1037,17 +1080,17 @@ def edit_stage(stage_id):
                 
 
                 # Handle image upload
-                app.config['STAGE_IMG_UPLOAD_PATH'] = os.path.join(stage_path, 'img')
-                app.config['STAGE_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
+                current_app.config['STAGE_IMG_UPLOAD_PATH'] = os.path.join(stage_path, 'img')
+                current_app.config['STAGE_IMG_UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.svg', '.webp', '.ico']
                 file = request.files['img']
                 if file:
                     filename = secure_filename(file.filename)
                     file_ext = os.path.splitext(filename)[1]
-                    if file_ext not in app.config['STAGE_IMG_UPLOAD_EXTENSIONS']:
+                    if file_ext not in current_app.config['STAGE_IMG_UPLOAD_EXTENSIONS']:
                         abort(400)
                     else:
                         filename = secure_filename(f"main_stage_image{file_ext}")
-                        file.save(os.path.join(app.config['STAGE_IMG_UPLOAD_PATH'], filename))
+                        file.save(os.path.join(current_app.config['STAGE_IMG_UPLOAD_PATH'], filename))
                         img_path = os.path.join('/static', 'assets', 'projects', project_name, 'stages', stage_name, 'img', filename)
                 else:
                     img_path = os.path.join(stage_path, 'img', stage_to_edit.img.split('/')[-1])
@@ -1062,25 +1105,15 @@ def edit_stage(stage_id):
                 
                 db.session.commit()
                 
-                return redirect(url_for('show_stage', project_name=project_name, stage_name=stage_name))
+                return redirect(url_for('views.show_stage', project_name=project_name, stage_name=stage_name))
             
             except OSError as e:
                 flash(f'Error editing stage: {e}', 'danger')
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         is_edit=True,
         stage=stage_to_edit,
         record_type=record_type
@@ -1088,7 +1121,7 @@ def edit_stage(stage_id):
 
 
 
-@app.route("/delete_stage/<int:stage_id>")
+@views.route("/delete_stage/<int:stage_id>")
 @admin_required  # Require admin access in addition to login
 def delete_stage(stage_id):
     stage_to_delete = db.get_or_404(Stage, stage_id)
@@ -1103,12 +1136,12 @@ def delete_stage(stage_id):
     
     db.session.delete(stage_to_delete)
     db.session.commit()
-    return redirect(url_for('show_project', project_name=project_name))
+    return redirect(url_for('views.show_project', project_name=project_name))
 
 
 
 # PHASES MANAGEMENT
-@app.route("/new_phase/<int:stage_id>", methods=["GET", "POST"])
+@views.route("/new_phase/<int:stage_id>", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def add_new_phase(stage_id):
     record_type = "phase"
@@ -1139,29 +1172,19 @@ def add_new_phase(stage_id):
             db.session.add(new_phase)
             db.session.commit()
             
-            return redirect(url_for("show_stage", project_name=project.name.lower().replace(' ', '_'), stage_name=stage.name.lower().replace(' ', '_')))
+            return redirect(url_for("views.show_stage", project_name=project.name.lower().replace(' ', '_'), stage_name=stage.name.lower().replace(' ', '_')))
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         project=project,
         record_type=record_type
     )
 
 
 
-@app.route("/edit_phase/<int:phase_id>", methods=["GET", "POST"])
+@views.route("/edit_phase/<int:phase_id>", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def edit_phase(phase_id):
     record_type = "phase"
@@ -1185,25 +1208,15 @@ def edit_phase(phase_id):
                 
                 db.session.commit()
                 
-                return redirect(url_for('show_stage', project_name=project.name, stage_name=stage.name))
+                return redirect(url_for('views.show_stage', project_name=project.name, stage_name=stage.name))
             
             except OSError as e:
                 flash(f'Error editing stage: {e}', 'danger')
     
-    is_admin = False
-    if current_user.is_authenticated:
-        user = User.query.get(current_user.get_id())
-        is_admin = user.is_admin
     
     return render_template(
         "new_record.html",
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         form=form, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         project=project,
         phase=phase_to_edit,
         is_edit=True,
@@ -1212,7 +1225,7 @@ def edit_phase(phase_id):
 
 
 
-@app.route("/delete_phase/<int:phase_id>")
+@views.route("/delete_phase/<int:phase_id>")
 @admin_required  # Require admin access in addition to login
 def delete_phase(phase_id):
     phase_to_delete = db.get_or_404(Phase, phase_id)
@@ -1230,143 +1243,90 @@ def delete_phase(phase_id):
     except IntegrityError:
         flash("Cannot delete this phase as it is associated with existing concepts.", "danger")
 
-    return redirect(url_for('show_stage', project_name=project_name, stage_name=stage_name))
+    return redirect(url_for('views.show_stage', project_name=project_name, stage_name=stage_name))
 
 
 
 # CONCEPTS MANAGEMENT
-@app.route("/project/<project_name>/stage/<stage_name>/concepts_catalog", methods=["GET", "POST"])
+@views.route("/project/<project_name>/stage/<stage_name>/concepts_catalog", methods=["GET", "POST"])
+@replica_reads
 @admin_required  # Require admin access in addition to login
 def show_concepts(project_name, stage_name):
     page_title = "Concepts Catalog" 
 
-    project_name_title = project_name.replace('_', ' ').title()
-    stage_name_title = stage_name.replace('_', ' ').title()
-    
     # Query the project and the stage
-    requested_project = Project.query.filter_by(name=project_name_title).first()
-    requested_stage = Stage.query.filter_by(project_id=requested_project.id, name=stage_name_title).first()
-
-    phases = Phase.query.filter_by(stage_id=requested_stage.id).all()
+    requested_project, requested_stage = find_stage(project_name, stage_name)
+    if not requested_stage:
+        abort(404)
 
-    data = []
-    for phase in phases:
-        concepts = Concept.query.filter_by(phase_id=phase.id).all()
-        for concept in concepts:
-
-            concept_mat_import = 0
-            mat_gens = MatGenerator.query.filter_by(concept_id=concept.id).all()
-            for mat_gen in mat_gens:
-                material = Material.query.filter_by(id=mat_gen.material_id).first()
-                amount = mat_gen.quantity * material.price
-                concept_mat_import = concept_mat_import + amount
-
-            concept_maq_import = 0
-            maq_gens = MaqGenerator.query.filter_by(concept_id=concept.id).all()
-            for maq_gen in maq_gens:
-                machinery = Machinery.query.filter_by(id=maq_gen.machinery_id).first()
-                amount = maq_gen.quantity * machinery.price
-                concept_maq_import = concept_maq_import + amount
-
-            concept_mo_import = 0
-            mo_gens = MoGenerator.query.filter_by(concept_id=concept.id).all()
-            for mo_gen in mo_gens:
-                job = Job.query.filter_by(id=mo_gen.job_id).first()
-                amount = mo_gen.quantity * job.price
-                concept_mo_import = concept_mo_import + amount
-
-            concept_her_import = 0.03 * concept_mo_import
-
-            direct_cost = concept_her_import + concept_maq_import + concept_mat_import + concept_mo_import
-
-            if concept.quantity != 0:
-                concepts_dict = {
-                    'phase': phase.code,
-                    'code': concept.code,
-                    'name': concept.name,
-                    'quantity': concept.quantity,
-                    'unit': concept.unit.name,
-                    'material unit price': concept_mat_import/concept.quantity,
-                    'material total': concept_mat_import,
-                    'machinery unit price': concept_mat_import/concept.quantity,
-                    'machinery total': concept_mat_import,
-                    'labour unit price': concept_mat_import/concept.quantity,
-                    'labour total': concept_mat_import,
-                    'tools unit price': concept_mat_import/concept.quantity,
-                    'tools total': concept_mat_import,
-                    'unit price': direct_cost/concept.quantity,
-                    'direct cost': direct_cost,
-                }
-            else:
-                concepts_dict = {
-                    'phase': phase.code,
-                    'code': concept.code,
-                    'name': concept.name,
-                    'quantity': concept.quantity,
-                    'unit': concept.unit.name,
-                    'material unit price': 0,
-                    'material total': 0,
-                    'machinery unit price': 0,
-                    'machinery total': 0,
-                    'labour unit price': 0,
-                    'labour total': 0,
-                    'tools unit price': 0,
-                    'tools total': 0,
-                    'unit price': 0,
-                    'direct cost': 0,
-                }
-            data.append(concepts_dict)
-    
-    
-    # Convert the list of dictionaries to a Pandas DataFrame
-    concepts_table = pd.DataFrame(data)
-    
-    self_filtering_table = SelfFilteringTable(
-        df=concepts_table, 
-        columns=concepts_table.columns.tolist(),
-        column_types=[str, str, str, float, str, float, float, float, float, float, float, float, float, float, float]
+    # The concepts costs are read from the cache, the filters, sorting and pagination are applied by the database
+    columns = concept_cost_columns()
+    self_filtering_table = QueryFilteringTable(
+        query=stage_concept_costs_query(requested_stage.id, columns),
+        columns=columns,
+        column_types=CATALOG_COLUMN_TYPES,
+        key=Concept.id
     )
     
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "concepts_catalog.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         page_title=page_title, 
         project=requested_project, 
         stage=requested_stage, 
         filtering_form=self_filtering_table.form,
         table=self_filtering_table.table, 
+        table_body=self_filtering_table.body, 
         filters_applied=len(self_filtering_table.filtering_inputs) > 0, 
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user, 
         sort_column=self_filtering_table.sort_column, 
         sort_direction=self_filtering_table.sort_direction, 
         columns=self_filtering_table.columns,
+        has_previous=self_filtering_table.has_previous,
+        has_next=self_filtering_table.has_next,
         col_span=self_filtering_table.df.shape[1]
     )
 
 
 
-@app.route("/project/<project_name>/stage/<stage_name>/create_new_concept", methods=["GET", "POST"])
+@views.route("/project/<project_name>/stage/<stage_name>/variance", methods=["GET", "POST"])
+@login_required
+def show_stage_variance(project_name, stage_name):
+    page_title = "Actual vs Budget"
+
+    requested_project, requested_stage = find_stage(project_name, stage_name)
+    if not requested_stage:
+        abort(404)
+
+    # The report is read from the cache of the stage, it is built again only when its budget or actuals changed
+    report = stage_variance_report(requested_stage.id)
+    df = variance_dataframe(report)
+    self_filtering_table = SelfFilteringTable(df, list(df.columns), VARIANCE_COLUMN_TYPES)
+
+    return render_template(
+        "tables.html",
+        page_title=f'{page_title}: {requested_project.name} {requested_stage.name}',
+        filtering_form=self_filtering_table.form,
+        table=self_filtering_table.table,
+        table_body=self_filtering_table.body,
+        filters_applied=len(self_filtering_table.filtering_inputs) > 0,
+        sort_column=self_filtering_table.sort_column,
+        sort_direction=self_filtering_table.sort_direction,
+        columns=self_filtering_table.columns,
+        has_previous=False,
+        has_next=False,
+        col_span=df.shape[1]
+    )
+
+
+@views.route("/project/<project_name>/stage/<stage_name>/create_new_concept", methods=["GET", "POST"])
 @admin_required  # Require admin access in addition to login
 def new_concept(project_name, stage_name):
     record_type = "concept"
 
-    project_name_title = project_name.replace('_', ' ').title()
-    stage_name_title = stage_name.replace('_', ' ').title()
-    
     # Query the project and the stage
-    requested_project = Project.query.filter_by(name=project_name_title).first()
-    requested_stage = Stage.query.filter_by(project_id=requested_project.id, name=stage_name_title).first()
+    requested_project, requested_stage = find_stage(project_name, stage_name)
+    if not requested_stage:
+        abort(404)
 
     phases = Phase.query.filter_by(stage_id=requested_stage.id).all()
     units = Unit.query.all()
@@ -1397,51 +1357,164 @@ def new_concept(project_name, stage_name):
         db.session.add(new_concept)
         db.session.commit()
             
-        return redirect(url_for("show_concepts", project_name=requested_project.name.lower().replace(' ', '_'), stage_name=requested_stage.name.lower().replace(' ', '_')))
+        return redirect(url_for("views.show_concepts", project_name=requested_project.name.lower().replace(' ', '_'), stage_name=requested_stage.name.lower().replace(' ', '_')))
     
-    is_admin = False
-    if current_user.is_authenticated:
-        # Get the user from the database using the user ID stored in current_user
-        user = User.query.get(current_user.get_id())
-        # Check if the user is an admin
-        is_admin = user.is_admin
 
     return render_template(
         "new_record.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
         project=requested_project, 
         stage=requested_stage, 
         form=form,
-        logged_in=current_user.is_authenticated, 
-        is_admin=is_admin, 
-        user=current_user,
         record_type = record_type
     )
 
 
+# PROJECT TREE
+# Whole project hierarchy, for the navigation and the stage pages to render from one prefetch
+@views.route("/api/project/<project_name>/tree")
+@login_required
+def get_project_tree(project_name):
+    requested_project = load_project_tree(project_name)
+    if not requested_project:
+        abort(404)
+
+    return jsonify(project_tree_dict(requested_project))
+
+
+# INVENTORY
+# Stock on hand of a location or of all the locations of a stage: {material_id: quantity}
+@views.route("/api/locations/<int:location_id>/stock")
+@login_required
+def get_location_stock(location_id):
+    db.get_or_404(Locations, location_id)
+
+    # ?as_of=2024-01-31&family=tool gives the stock at the end of a past date
+    if 'as_of' in request.args:
+        family = request.args.get('family', 'material')
+        try:
+            as_of_date = date.fromisoformat(request.args['as_of'])
+        except ValueError:
+            abort(400)
+        if family not in INVENTORY_FAMILIES:
+            abort(400)
+        stock = stock_as_of(family, as_of_date, location_id=location_id)
+        return jsonify({item_id: quantity for (item_id, stock_location_id), quantity in stock.items()})
+
+    return jsonify(location_stock(location_id))
+
+
+@views.route("/api/stages/<int:stage_id>/stock")
+@login_required
+def get_stage_stock(stage_id):
+    db.get_or_404(Stage, stage_id)
+    return jsonify(stage_stock(stage_id))
+
+
+@views.route("/api/stages/<int:stage_id>/consumption")
+@login_required
+def get_stage_consumption(stage_id):
+    db.get_or_404(Stage, stage_id)
+    return jsonify(concept_actual_vs_budget(stage_id))
+
+
+@views.route("/api/stages/<int:stage_id>/variance")
+@login_required
+def get_stage_variance(stage_id):
+    db.get_or_404(Stage, stage_id)
+    return jsonify(stage_variance_report(stage_id))
+
+
+@views.route("/api/import/<table_name>", methods=["POST"])
+@admin_required
+def import_table_file(table_name):
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        abort(400)
+    try:
+        report = import_table(table_name, file.stream, file.filename, stage_id=request.form.get('stage_id', type=int))
+    except ImportFileError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify(report)
+
+
+@views.route("/api/catalogs/<catalog_name>/reprice", methods=["POST"])
+@admin_required
+def reprice_catalog(catalog_name):
+    if catalog_name not in PRICE_CATALOGS:
+        abort(404)
+    change = request.get_json(silent=True)
+    if not isinstance(change, dict):
+        return jsonify({'error': 'the body must be a JSON object with the change'}), 400
+    try:
+        effective_date = date.fromisoformat(change['date']) if change.get('date') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'the date must be given as YYYY-MM-DD'}), 400
+    try:
+        changed = reprice(catalog_name, percent=change.get('percent'), amount=change.get('amount'), unit=change.get('unit'),
+                          name_pattern=change.get('name'), effective_date=effective_date)
+    except RepriceError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify({'changed': changed})
+
+
+# What-if repricing: {"scenarios": [{"name": "Cement +12%, labour +5%", "changes": [{"catalog": "materials",
+# "name": "cemento%", "percent": 12}, {"catalog": "jobs", "percent": 5}]}], "concepts": true}
+@views.route("/api/stages/<int:stage_id>/simulate", methods=["POST"])
+@login_required
+def simulate_stage_prices(stage_id):
+    db.get_or_404(Stage, stage_id)
+    simulation = request.get_json(silent=True)
+    if not isinstance(simulation, dict):
+        return jsonify({'error': 'the body must be a JSON object with the scenarios'}), 400
+    try:
+        validate_scenarios(simulation.get('scenarios'))
+        result = StageCostMatrix(stage_id).simulate(simulation['scenarios'], include_concepts=bool(simulation.get('concepts', True)))
+    except ScenarioError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify(result)
+
+
+@views.route("/api/locations/<int:location_id>/tools")
+@login_required
+def get_location_tools(location_id):
+    db.get_or_404(Locations, location_id)
+    return jsonify(tools_at_location(location_id))
+
+
+@views.route("/api/stages/<int:stage_id>/tools")
+@login_required
+def get_stage_tools(stage_id):
+    db.get_or_404(Stage, stage_id)
+    return jsonify(tools_at_stage(stage_id))
+
+
+@views.route("/api/employees/<int:employee_id>/tools")
+@login_required
+def get_employee_tools(employee_id):
+    db.get_or_404(Employee, employee_id)
+    return jsonify(tools_held_by(employee_id))
+
+
+@views.route("/api/tools/<int:tool_id>/custody")
+@login_required
+def get_tool_custody(tool_id):
+    db.get_or_404(Tool, tool_id)
+    return jsonify(tool_whereabouts(tool_id))
+
+
 # GENERAL PAGES
-@app.route("/about")
+@views.route("/about")
 def about():
-    return render_template(
-        "about.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
-        logged_in=current_user.is_authenticated, 
-        user=current_user)
+    return render_template("about.html")
 
 
-@app.route("/contact")
+@views.route("/contact")
 def contact():
-    return render_template(
-        "contact.html", 
-        company=COMPANY, 
-        slogan=COMPANY_SLOGAN, 
-        date=DATE, 
-        logged_in=current_user.is_authenticated, 
-        user=current_user)
+    return render_template("contact.html")
+
+
+# The app of gunicorn main:app and flask --app main, made after every view is on the blueprint
+app = create_app()
 
 
 if __name__ == "__main__":
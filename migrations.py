@@ -0,0 +1,60 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex, CreateColumn
+from models import db
+
+
+# db.create_all() only creates the tables that don't exist yet, the columns added
+# to existing tables have to be created here. Only nullable columns can be added.
+def create_missing_columns(engine):
+    inspector = inspect(engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            column_definition = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column_definition}'))
+            created.append(f'{table.name}.{column.name}')
+
+    return created
+
+
+# The same for the indexes added to existing tables, e.g. the (date, item) indexes of the six material and tool
+# movement tables the inventory snapshots replay from: ix_material_entries_date_material_id and the like.
+def create_missing_indexes(engine):
+    inspector = inspect(engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing_indexes:
+                continue
+
+            if engine.dialect.name == 'postgresql':
+                # Build the index without locking the table for writes, it can't run inside a transaction
+                statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+                statement = statement.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1)
+                with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    connection.execute(text(statement))
+            else:
+                index.create(bind=engine)
+            created.append(index.name)
+
+    return created
+
+
+def upgrade_database(engine):
+    # Creates the missing tables, columns and indexes of an existing database, returns the columns and indexes created.
+    db.metadata.create_all(bind=engine)
+    return create_missing_columns(engine) + create_missing_indexes(engine)
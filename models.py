@@ -1,13 +1,14 @@
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, column_property
-from sqlalchemy import Integer, String, Boolean, ForeignKey, Float, Date, CheckConstraint, DateTime, Table, Column
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, column_property, Session
+from sqlalchemy import Integer, String, Text, Boolean, ForeignKey, Float, Date, CheckConstraint, DateTime, Table, Column, Index, event, inspect, select, update, delete, or_
 from datetime import datetime, time
+from replicas import RoutingSession
 
 # CREATE DATABASE
 class Base(DeclarativeBase):
     pass
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 
 # CONFIGURE TABLES
@@ -17,8 +18,8 @@ user_project_stages = Table(
     'user_project_stages',
     Base.metadata,
     Column('id', Integer, primary_key=True),
-    Column('project_stage_id', Integer, ForeignKey('stages.id')),
-    Column('employee_id', Integer, ForeignKey('users.id'))
+    Column('project_stage_id', Integer, ForeignKey('stages.id'), index=True),
+    Column('employee_id', Integer, ForeignKey('users.id'), index=True)
 )
 
 # Many-to-many relationship between Employees and JobsHistory
@@ -26,8 +27,8 @@ jobs_history_employees = Table(
     'jobs_history_employees',
     Base.metadata,
     Column('id', Integer, primary_key=True),
-    Column('job_history_id', Integer, ForeignKey('jobs_history.id')),
-    Column('employee_id', Integer, ForeignKey('employees.id'))
+    Column('job_history_id', Integer, ForeignKey('jobs_history.id'), index=True),
+    Column('employee_id', Integer, ForeignKey('employees.id'), index=True)
 )
 
 
@@ -65,6 +66,11 @@ class Stage(db.Model):
     phases = relationship('Phase', backref='stage_relation', lazy=True)
     user_entries = relationship('User', secondary=user_project_stages, backref='stages')
 
+    # Stages are looked up by project and name
+    __table_args__ = (
+        Index('ix_stages_project_id_name', 'project_id', 'name'),
+    )
+
 class Phase(db.Model):
     __tablename__ = "phases"
     id = mapped_column(Integer, primary_key=True)
@@ -75,6 +81,11 @@ class Phase(db.Model):
     concepts_relation = relationship('Concept', backref='phase_relation', lazy=True)
     code = mapped_column(String(5))
 
+    # Phases are looked up by stage and name
+    __table_args__ = (
+        Index('ix_phases_stage_id_name', 'stage_id', 'name'),
+    )
+
 class Concept(db.Model):
     __tablename__ = "concepts"
     id = mapped_column(Integer, primary_key=True)
@@ -83,7 +94,7 @@ class Concept(db.Model):
     quantity = mapped_column(Float(250))
     unit_id = mapped_column(Integer, ForeignKey('units.id'), nullable=False)
     unit = relationship('Unit')
-    phase_id = mapped_column(Integer, ForeignKey('phases.id'), nullable=False)
+    phase_id = mapped_column(Integer, ForeignKey('phases.id'), nullable=False, index=True)
     phase = relationship('Phase')
     code = mapped_column(String(20))
 
@@ -101,6 +112,27 @@ class Concept(db.Model):
             position = len(self.phase.concepts)
             self.code = f"{phase_code}-{position+1}"
 
+# Precomputed direct cost of a concept, it is marked as stale whenever its generators,
+# its quantity or the catalog prices it depends on change, and recomputed when it is read.
+class ConceptCost(db.Model):
+    __tablename__ = "concept_costs"
+    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), primary_key=True)
+    material_total = mapped_column(Float, nullable=False, default=0)
+    machinery_total = mapped_column(Float, nullable=False, default=0)
+    labour_total = mapped_column(Float, nullable=False, default=0)
+    tools_total = mapped_column(Float, nullable=False, default=0)
+    direct_cost = mapped_column(Float, nullable=False, default=0)
+    unit_price = mapped_column(Float, nullable=False, default=0)
+    is_stale = mapped_column(Boolean, nullable=False, default=True)
+
+# Actual versus budget report of a stage as JSON, built by variance.py and marked stale when its budget or actuals change
+class VarianceReport(db.Model):
+    __tablename__ = "variance_reports"
+    stage_id = mapped_column(Integer, ForeignKey('stages.id'), primary_key=True)
+    report = mapped_column(Text, nullable=False)
+    created_at = mapped_column(DateTime, nullable=False, default=datetime.now)
+    is_stale = mapped_column(Boolean, nullable=False, default=False)
+
 
 # Assets:
 class Tool(db.Model):
@@ -139,47 +171,63 @@ class Material(db.Model):
     price = mapped_column(Float, nullable=False)
     last_update = mapped_column(Date, nullable=False)
 
+# Previous prices of the catalogs, saved by prices.py every time a price is replaced
+class PriceHistory(db.Model):
+    __tablename__ = "price_history"
+    id = mapped_column(Integer, primary_key=True)
+    catalog = mapped_column(String(20), nullable=False)  # 'materials', 'jobs', 'machineries' or 'tools'
+    item_id = mapped_column(Integer, nullable=False)
+    price = mapped_column(Float, nullable=False)
+    valid_from = mapped_column(Date)  # last_update of the price
+    valid_until = mapped_column(Date, nullable=False)  # Day it was replaced
+    changed_at = mapped_column(DateTime, nullable=False, default=datetime.now)
+
+    # Prices are looked up by item and date
+    __table_args__ = (
+        Index('ix_price_history_catalog_item_id_valid_until', 'catalog', 'item_id', 'valid_until'),
+    )
+
 
 # Generator tables:
 class MatGenerator(db.Model):
     __tablename__ = "mat_generators"
     id = mapped_column(Integer, primary_key=True)
-    material_id = mapped_column(Integer, ForeignKey('materials.id'), nullable=False)
+    material_id = mapped_column(Integer, ForeignKey('materials.id'), nullable=False, index=True)
     name = relationship('Material', foreign_keys=[material_id], backref='mat_generators')
     quantity = mapped_column(Float(250), nullable=False)
     unit_id = mapped_column(Integer, ForeignKey('units.id'), nullable=False)
     unit = relationship('Unit')
-    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False)
+    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False, index=True)
 
 class MoGenerator(db.Model):
     __tablename__ = "mo_generators"
     id = mapped_column(Integer, primary_key=True)
-    job_id = mapped_column(Integer, ForeignKey('jobs.id'), nullable=False)
+    job_id = mapped_column(Integer, ForeignKey('jobs.id'), nullable=False, index=True)
     name = relationship('Job', foreign_keys=[job_id], backref='mo_generators')
     quantity = mapped_column(Float(250), nullable=False)
     unit_id = mapped_column(Integer, ForeignKey('units.id'), nullable=False)
     unit = relationship('Unit')
-    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False)
+    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False, index=True)
 
 class MaqGenerator(db.Model):
     __tablename__ = "maq_generators"
     id = mapped_column(Integer, primary_key=True)
-    machinery_id = mapped_column(Integer, ForeignKey('machineries.id'), nullable=False)
+    machinery_id = mapped_column(Integer, ForeignKey('machineries.id'), nullable=False, index=True)
     name = relationship('Machinery', foreign_keys=[machinery_id], backref='maq_generators')
     quantity = mapped_column(Float(250), nullable=False)
     unit_id = mapped_column(Integer, ForeignKey('units.id'), nullable=False)
     unit = relationship('Unit')
-    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False)
+    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False, index=True)
 
 class HerGenerator(db.Model):
     __tablename__ = "her_generators"
     id = mapped_column(Integer, primary_key=True)
-    tool_id = mapped_column(Integer, ForeignKey('tools.id'), nullable=False)
+    tool_id = mapped_column(Integer, ForeignKey('tools.id'), nullable=False, index=True)
     name = relationship('Tool', foreign_keys=[tool_id], backref='her_generators')
     quantity = mapped_column(Float(250), nullable=False)
     unit_id = mapped_column(Integer, ForeignKey('units.id'), nullable=False)
     unit = relationship('Unit')
-    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False)
+    concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False, index=True)
 
 
 # Inventory:
@@ -187,7 +235,7 @@ class Locations(db.Model):
     __tablename__ = "locations"
     id = mapped_column(Integer, primary_key=True)
     name = mapped_column(String(250), nullable=False, unique=True)
-    stage_id = mapped_column(Integer, ForeignKey('stages.id'), nullable=False)  # Foreign key to Stages table
+    stage_id = mapped_column(Integer, ForeignKey('stages.id'), nullable=False, index=True)  # Foreign key to Stages table
     stage = relationship('Stage')  # Relationship to Stages table
 
 # Materials Inventory:
@@ -207,6 +255,14 @@ class MaterialEntry(db.Model):
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
 
+    # Stock is looked up by material and location, and movements by date: the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_material_entries_material_id_location_id_date', 'material_id', 'destination_location_id', 'entry_date'),
+        Index('ix_material_entries_destination_location_id', 'destination_location_id'),
+        Index('ix_material_entries_employee_id', 'employee_id'),
+        Index('ix_material_entries_date_material_id', 'entry_date', 'material_id'),
+    )
+
 class MaterialMove(db.Model):
     __tablename__ = "material_moves"
     id = mapped_column(Integer, primary_key=True)
@@ -222,6 +278,16 @@ class MaterialMove(db.Model):
     destination_location = relationship('Locations', foreign_keys=[destination_location_id])
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
+    # Cost of the quantity taken from the source location, set by valuation.py
+    cost = mapped_column(Float)
+
+    # Stock is looked up by material and location, and movements by date: the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_material_moves_material_id_source_id_date', 'material_id', 'source_location_id', 'move_date'),
+        Index('ix_material_moves_material_id_destination_id_date', 'material_id', 'destination_location_id', 'move_date'),
+        Index('ix_material_moves_employee_id', 'employee_id'),
+        Index('ix_material_moves_date_material_id', 'move_date', 'material_id'),
+    )
 
 class MaterialExit(db.Model):
     __tablename__ = "material_exits"
@@ -236,6 +302,75 @@ class MaterialExit(db.Model):
     concept = relationship('Concept')
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
+    # Cost of the quantity taken from the source location, set by valuation.py
+    cost = mapped_column(Float)
+    # Location the material is taken from, exits without one are not discounted from any location's stock
+    source_location_id = mapped_column(Integer, ForeignKey('locations.id'))
+    source_location = relationship('Locations')
+
+    # Consumption is looked up by material and by concept, and the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_material_exits_material_id_date', 'material_id', 'exit_date'),
+        Index('ix_material_exits_concept_id', 'concept_id'),
+        Index('ix_material_exits_employee_id', 'employee_id'),
+        Index('ix_material_exits_source_location_id', 'source_location_id'),
+        Index('ix_material_exits_date_material_id', 'exit_date', 'material_id'),
+    )
+
+# Stock on hand of every material per location, updated in the same transaction as the movements by stock_ledger.py
+class MaterialStock(db.Model):
+    __tablename__ = "material_stock"
+    material_id = mapped_column(Integer, ForeignKey('materials.id'), primary_key=True)
+    location_id = mapped_column(Integer, ForeignKey('locations.id'), primary_key=True, index=True)
+    quantity = mapped_column(Float, nullable=False, default=0)
+
+# Cost layers of every material and tool per location: the quantity still on hand of each receipt and its unit
+# cost for FIFO, or a single layer at the weighted average cost. Exits and moves consume them in valuation.py
+class CostLayer(db.Model):
+    __tablename__ = "cost_layers"
+    id = mapped_column(Integer, primary_key=True)
+    family = mapped_column(String(20), nullable=False)  # 'material' or 'tool'
+    item_id = mapped_column(Integer, nullable=False)
+    location_id = mapped_column(Integer, ForeignKey('locations.id'), nullable=False)
+    layer_date = mapped_column(Date, nullable=False)
+    quantity = mapped_column(Float, nullable=False)
+    unit_cost = mapped_column(Float, nullable=False)
+
+    # Layers are consumed oldest first per item and location
+    __table_args__ = (
+        Index('ix_cost_layers_family_item_id_location_id_date', 'family', 'item_id', 'location_id', 'layer_date'),
+    )
+
+# Valuation state of every material and tool: the method and last date its layers were built with. Movements
+# backdated, changed or deleted have its layers and costs built again in their flush, items valued with another
+# method are stale until the value-inventory command revalues them.
+class ItemValuation(db.Model):
+    __tablename__ = "item_valuations"
+    family = mapped_column(String(20), primary_key=True)
+    item_id = mapped_column(Integer, primary_key=True)
+    method = mapped_column(String(20), nullable=False)
+    valued_until = mapped_column(Date)
+    is_stale = mapped_column(Boolean, nullable=False, default=False)
+
+# Stock of every material and tool per location at the end of a date, "as of" queries replay the movements after it
+class InventorySnapshot(db.Model):
+    __tablename__ = "inventory_snapshots"
+    id = mapped_column(Integer, primary_key=True)
+    snapshot_date = mapped_column(Date, nullable=False, unique=True)
+    created_at = mapped_column(DateTime, nullable=False, default=datetime.now)
+
+class InventorySnapshotBalance(db.Model):
+    __tablename__ = "inventory_snapshot_balances"
+    snapshot_id = mapped_column(Integer, ForeignKey('inventory_snapshots.id'), primary_key=True)
+    family = mapped_column(String(20), primary_key=True)  # 'material' or 'tool'
+    item_id = mapped_column(Integer, primary_key=True)
+    location_id = mapped_column(Integer, ForeignKey('locations.id'), primary_key=True)
+    quantity = mapped_column(Float, nullable=False)
+
+    # Balances are also read per location
+    __table_args__ = (
+        Index('ix_inventory_snapshot_balances_snapshot_id_location_id', 'snapshot_id', 'location_id'),
+    )
 
 # Tools Inventory:
 class ToolEntry(db.Model):
@@ -254,6 +389,14 @@ class ToolEntry(db.Model):
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
 
+    # Stock is looked up by tool and location, and movements by date: the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_tool_entries_tool_id_location_id_date', 'tool_id', 'destination_location_id', 'entry_date'),
+        Index('ix_tool_entries_destination_location_id', 'destination_location_id'),
+        Index('ix_tool_entries_employee_id', 'employee_id'),
+        Index('ix_tool_entries_date_tool_id', 'entry_date', 'tool_id'),
+    )
+
 class ToolMove(db.Model):
     __tablename__ = "tool_moves"
     id = mapped_column(Integer, primary_key=True)
@@ -269,6 +412,16 @@ class ToolMove(db.Model):
     destination_location = relationship('Locations', foreign_keys=[destination_location_id])
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
+    # Cost of the quantity taken from the source location, set by valuation.py
+    cost = mapped_column(Float)
+
+    # Stock is looked up by tool and location, and movements by date: the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_tool_moves_tool_id_source_id_date', 'tool_id', 'source_location_id', 'move_date'),
+        Index('ix_tool_moves_tool_id_destination_id_date', 'tool_id', 'destination_location_id', 'move_date'),
+        Index('ix_tool_moves_employee_id', 'employee_id'),
+        Index('ix_tool_moves_date_tool_id', 'move_date', 'tool_id'),
+    )
 
 class ToolExit(db.Model):
     __tablename__ = "tool_exits"
@@ -283,6 +436,33 @@ class ToolExit(db.Model):
     concept = relationship('Concept')
     employee_id = mapped_column(Integer, ForeignKey('employees.id'), nullable=False)
     responsible_employee = relationship('Employee')
+    # Cost of the quantity taken from the source location, set by valuation.py
+    cost = mapped_column(Float)
+    # Location the tool is taken from, as in MaterialExit
+    source_location_id = mapped_column(Integer, ForeignKey('locations.id'))
+    source_location = relationship('Locations')
+
+    # Consumption is looked up by tool and by concept, and the inventory snapshots replay a date range
+    __table_args__ = (
+        Index('ix_tool_exits_tool_id_date', 'tool_id', 'exit_date'),
+        Index('ix_tool_exits_concept_id', 'concept_id'),
+        Index('ix_tool_exits_employee_id', 'employee_id'),
+        Index('ix_tool_exits_source_location_id', 'source_location_id'),
+        Index('ix_tool_exits_date_tool_id', 'exit_date', 'tool_id'),
+    )
+
+# Tools on hand per location and the employee responsible for them, the one of the last movement that brought
+# them there. Updated in the same transaction as the movements by tool_custody.py
+class ToolCustody(db.Model):
+    __tablename__ = "tool_custody"
+    tool_id = mapped_column(Integer, ForeignKey('tools.id'), primary_key=True)
+    tool = relationship('Tool')
+    location_id = mapped_column(Integer, ForeignKey('locations.id'), primary_key=True, index=True)
+    location = relationship('Locations')
+    quantity = mapped_column(Float, nullable=False, default=0)
+    employee_id = mapped_column(Integer, ForeignKey('employees.id'), index=True)
+    employee = relationship('Employee')
+    since = mapped_column(Date)  # Date of the movement that gave the custody to the employee
 
 
 # Purchase:
@@ -309,6 +489,12 @@ class MaqRental(db.Model):
     concept_id = mapped_column(Integer, ForeignKey('concepts.id'), nullable=False)
     concept = relationship('Concept')
 
+    # Rentals are looked up by concept and by machinery
+    __table_args__ = (
+        Index('ix_machinery_rentals_concept_id', 'concept_id'),
+        Index('ix_machinery_rentals_machinery_id', 'machinery_id'),
+    )
+
 # Sale:
 class Client(db.Model):
     __tablename__ = "clients"
@@ -339,6 +525,11 @@ class Attendance(db.Model):
     exit_hour = Column(DateTime, nullable=False, default=datetime.combine(datetime.today(), time(18, 0)))
     employee = relationship('Employee', back_populates='attendances')
 
+    # Attendance is looked up by employee and date
+    __table_args__ = (
+        Index('ix_attendance_employee_id_entry_hour', 'employee_id', 'entry_hour'),
+    )
+
 class Employee(db.Model):
     __tablename__ = "employees"
     id = Column(Integer, primary_key=True)
@@ -374,6 +565,12 @@ class JobsHistory(db.Model):
     end_date = Column(DateTime, nullable=False)
     employee_entries = relationship('Employee', secondary=jobs_history_employees, backref='jobs_history')
 
+    # Jobs are looked up by concept and by job
+    __table_args__ = (
+        Index('ix_jobs_history_concept_id', 'concept_id'),
+        Index('ix_jobs_history_job_id', 'job_id'),
+    )
+
 class Specialty(db.Model):
     __tablename__ = "specialties"
     id = mapped_column(Integer, primary_key=True)
@@ -399,7 +596,7 @@ class User(UserMixin, db.Model):
     profile_picture: Mapped[str] = mapped_column(String(255), default="../static/assets/img/default-profile.jpg")  # Adjust the length as needed
     is_admin: Mapped[bool] = mapped_column(Boolean)
     about: Mapped[str] = mapped_column(String(255), default='')
-    position_id = Column(Integer, ForeignKey('positions.id'), nullable=False)
+    position_id = Column(Integer, ForeignKey('positions.id'), nullable=False, index=True)
     position = relationship('Position')
     project_stage_entries = relationship('Stage', secondary=user_project_stages, backref='users')
 
@@ -457,3 +654,57 @@ class File(db.Model):
     maqrental_id = Column(Integer, ForeignKey('machinery_rentals.id'))
     maqrental = relationship('MaqRental')
 
+
+# CONCEPT COSTS INVALIDATION
+# Generator tables and the catalog column they are priced with.
+GENERATOR_CATALOGS = {
+    MatGenerator: ('material_id', Material),
+    MoGenerator: ('job_id', Job),
+    MaqGenerator: ('machinery_id', Machinery),
+    HerGenerator: ('tool_id', Tool),
+}
+CATALOG_GENERATORS = {catalog: (generator, column) for generator, (column, catalog) in GENERATOR_CATALOGS.items()}
+
+
+def attribute_changed(instance, attribute):
+    return inspect(instance).attrs[attribute].history.has_changes()
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_stale_concept_costs(session, flush_context, instances):
+    stale_concepts = session.info.setdefault('stale_concepts', set())
+    stale_prices = session.info.setdefault('stale_prices', {})
+
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if type(instance) in GENERATOR_CATALOGS:
+            # Both the current and the previous concept if the generator was moved
+            concept_history = inspect(instance).attrs['concept_id'].history
+            stale_concepts.update(concept_id for concept_id in concept_history.sum() if concept_id is not None)
+        elif isinstance(instance, Concept) and instance in session.dirty and attribute_changed(instance, 'quantity'):
+            stale_concepts.add(instance.id)
+        elif isinstance(instance, Concept) and instance in session.deleted:
+            # The cached cost has to go before the concept it references
+            session.connection().execute(
+                delete(ConceptCost.__table__).where(ConceptCost.concept_id == instance.id)
+            )
+        elif type(instance) in CATALOG_GENERATORS and instance in session.dirty and attribute_changed(instance, 'price'):
+            stale_prices.setdefault(type(instance), set()).add(instance.id)
+
+
+@event.listens_for(Session, 'after_flush')
+def mark_stale_concept_costs(session, flush_context):
+    stale_concepts = session.info.pop('stale_concepts', set())
+    stale_prices = session.info.pop('stale_prices', {})
+
+    conditions = []
+    if stale_concepts:
+        conditions.append(ConceptCost.concept_id.in_(stale_concepts))
+    for catalog, catalog_ids in stale_prices.items():
+        generator, column = CATALOG_GENERATORS[catalog]
+        affected_concepts = select(generator.concept_id).where(getattr(generator, column).in_(catalog_ids))
+        conditions.append(ConceptCost.concept_id.in_(affected_concepts))
+
+    if conditions:
+        session.connection().execute(
+            update(ConceptCost.__table__).where(or_(*conditions)).values(is_stale=True)
+        )
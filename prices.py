@@ -0,0 +1,161 @@
+import math
+from datetime import date, datetime
+from sqlalchemy import event, inspect, select, insert, update, literal, cast, func, or_, Numeric
+from sqlalchemy.orm import Session
+from models import db, Unit, ConceptCost, Material, Job, Machinery, Tool, PriceHistory, CATALOG_GENERATORS
+from stock_ledger import attribute_value, keep_previous_value
+from variance import mark_variance_reports_stale
+
+
+# Catalogs with prices, by the name their history is saved with
+PRICE_CATALOGS = {
+    'materials': Material,
+    'jobs': Job,
+    'machineries': Machinery,
+    'tools': Tool,
+}
+CATALOG_NAMES = {model: name for name, model in PRICE_CATALOGS.items()}
+
+
+class RepriceError(ValueError):
+    # A repricing that can't be applied: no change or two, not a number, or negative prices
+    pass
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def validate_reprice(percent=None, amount=None, unit=None, name_pattern=None):
+    if (percent is None) == (amount is None):
+        raise RepriceError('Give either a percentage or an amount')
+    if not is_number(percent if percent is not None else amount):
+        raise RepriceError('The percentage or amount must be a number')
+    for name, value in [('unit', unit), ('name pattern', name_pattern)]:
+        if value is not None and not isinstance(value, str):
+            raise RepriceError(f'The {name} must be a string')
+
+
+def mark_stale_prices(model, item_ids):
+    # Marks stale the cached costs of the concepts that use the items, item_ids can be a list or a SELECT of the ids.
+    # Every variance report is marked stale as well, as the ORM listener does for a price change: the rentals, jobs
+    # and exits without a cost are priced at the catalog, whatever the generators of their stage.
+    generator, column = CATALOG_GENERATORS[model]
+    stale_concepts = select(generator.concept_id).where(getattr(generator, column).in_(item_ids))
+    db.session.execute(
+        update(ConceptCost.__table__).where(ConceptCost.concept_id.in_(stale_concepts)).values(is_stale=True)
+    )
+    mark_variance_reports_stale(db.session.connection())
+
+
+def record_price_changes(catalog_name, new_prices, changed_on=None):
+    # Saves the price being replaced of every item whose price changes, new_prices: {item_id: price}.
+    # Returns the ids of the items whose price changes.
+    model = PRICE_CATALOGS[catalog_name]
+    rows = db.session.query(
+        model.id,
+        model.price,
+        model.last_update
+    ).filter(
+        model.id.in_(new_prices)
+    ).all()
+    history = [
+        {'catalog': catalog_name, 'item_id': item_id, 'price': price, 'valid_from': last_update, 'valid_until': changed_on or date.today()}
+        for item_id, price, last_update in rows if price != new_prices[item_id]
+    ]
+    if history:
+        db.session.execute(insert(PriceHistory), history)
+    return [row['item_id'] for row in history]
+
+
+def repricing_criteria(model, unit=None, name_pattern=None):
+    criteria = []
+    if unit:
+        criteria.append(model.unit_id.in_(select(Unit.id).where(Unit.name == unit)))
+    if name_pattern:
+        # SQL LIKE pattern, case insensitive: 'cemento%'
+        criteria.append(model.name.ilike(name_pattern))
+    return criteria
+
+
+def reprice(catalog_name, percent=None, amount=None, unit=None, name_pattern=None, effective_date=None, decimals=2):
+    # Changes the prices of the items of a catalog by a percentage or an amount, filtered by unit name and name
+    # pattern. Set based: the costs of the affected concepts are marked stale, the prices being replaced are saved
+    # with one INSERT .. SELECT and the prices changed with one UPDATE, in one transaction. Returns the items changed.
+    validate_reprice(percent, amount, unit, name_pattern)
+    model = PRICE_CATALOGS[catalog_name]
+    effective_date = effective_date or date.today()
+
+    new_price = model.price * (1 + percent / 100) if percent is not None else model.price + amount
+    new_price = func.round(cast(new_price, Numeric(18, 6)), decimals)
+    criteria = repricing_criteria(model, unit, name_pattern) + [new_price != model.price]
+
+    if db.session.query(model.id).filter(*criteria, new_price < 0).first() is not None:
+        raise RepriceError('The change would leave negative prices')
+
+    mark_stale_prices(model, select(model.id).where(*criteria))
+    db.session.execute(
+        insert(PriceHistory.__table__).from_select(
+            ['catalog', 'item_id', 'price', 'valid_from', 'valid_until', 'changed_at'],
+            select(
+                literal(catalog_name),
+                model.id,
+                model.price,
+                model.last_update,
+                literal(effective_date),
+                literal(datetime.now())
+            ).where(*criteria)
+        )
+    )
+    changed = db.session.execute(
+        update(model.__table__).where(*criteria).values(price=new_price, last_update=effective_date)
+    ).rowcount
+    db.session.commit()
+    return changed
+
+
+def prices_as_of(catalog_name, as_of_date):
+    # {item_id: price} of a catalog at a date: the price replaced after it, or the current one
+    model = PRICE_CATALOGS[catalog_name]
+    prices = dict(db.session.query(model.id, model.price).all())
+    replaced = db.session.query(
+        PriceHistory.item_id,
+        PriceHistory.price
+    ).filter(
+        PriceHistory.catalog == catalog_name,
+        PriceHistory.valid_until > as_of_date,
+        or_(PriceHistory.valid_from.is_(None), PriceHistory.valid_from <= as_of_date)
+    ).order_by(
+        PriceHistory.valid_until.desc(),
+        PriceHistory.id.desc()
+    ).all()
+    # The earliest replacement after the date had the price of the date
+    for item_id, price in replaced:
+        prices[item_id] = price
+    return prices
+
+
+def watch_price_changes():
+    # Saves the previous price of the catalog items changed through the ORM, in the transaction of the flush
+    for model in PRICE_CATALOGS.values():
+        for key in ['price', 'last_update']:
+            event.listen(getattr(model, key), 'set', keep_previous_value, active_history=True)
+
+    @event.listens_for(Session, 'before_flush')
+    def save_replaced_prices(session, flush_context, instances):
+        history = []
+        for instance in session.dirty:
+            if type(instance) in CATALOG_NAMES and inspect(instance).attrs['price'].history.has_changes():
+                previous_price = attribute_value(instance, 'price', previous=True)
+                if previous_price is None or previous_price == instance.price:
+                    continue
+                history.append({
+                    'catalog': CATALOG_NAMES[type(instance)],
+                    'item_id': instance.id,
+                    'price': previous_price,
+                    'valid_from': attribute_value(instance, 'last_update', previous=True),
+                    'valid_until': instance.last_update if inspect(instance).attrs['last_update'].history.has_changes() else date.today(),
+                    'changed_at': datetime.now(),
+                })
+        if history:
+            session.connection().execute(insert(PriceHistory.__table__), history)
@@ -0,0 +1,84 @@
+from sqlalchemy.orm import selectinload
+from models import db, Project, Stage, Phase, Concept
+
+
+# Projects and stages are addressed in the urls by their lower case names with underscores.
+def title_from_url(url_name):
+    return url_name.replace('_', ' ').title()
+
+
+def url_from_name(name):
+    return name.lower().replace(' ', '_')
+
+
+def find_project(project_name):
+    # Resolves the project of a url together with its stages.
+    return Project.query.options(
+        selectinload(Project.stages)
+    ).filter_by(
+        name=title_from_url(project_name)
+    ).first()
+
+
+def find_stage(project_name, stage_name):
+    # Resolves the project and the stage of a url in a single query, (None, None) if any of them doesn't exist.
+    result = db.session.query(
+        Project, Stage
+    ).join(
+        Stage, Stage.project_id == Project.id
+    ).filter(
+        Project.name == title_from_url(project_name),
+        Stage.name == title_from_url(stage_name)
+    ).first()
+
+    if result is None:
+        return None, None
+    return result
+
+
+def load_project_tree(project_name):
+    # Loads a project with all its stages, phases and concepts in a fixed number of queries,
+    # one per level, instead of lazy loading each relationship per parent.
+    return Project.query.options(
+        selectinload(Project.stages)
+        .selectinload(Stage.phases)
+        .selectinload(Phase.concepts_relation)
+        .selectinload(Concept.unit)
+    ).filter_by(
+        name=title_from_url(project_name)
+    ).first()
+
+
+def project_tree_dict(project):
+    # Serializable version of a project loaded with load_project_tree.
+    return {
+        'id': project.id,
+        'name': project.name,
+        'url_name': url_from_name(project.name),
+        'stages': [
+            {
+                'id': stage.id,
+                'name': stage.name,
+                'url_name': url_from_name(stage.name),
+                'phases': [
+                    {
+                        'id': phase.id,
+                        'code': phase.code,
+                        'name': phase.name,
+                        'concepts': [
+                            {
+                                'id': concept.id,
+                                'code': concept.code,
+                                'name': concept.name,
+                                'quantity': concept.quantity,
+                                'unit': concept.unit.name,
+                            }
+                            for concept in sorted(phase.concepts_relation, key=lambda concept: concept.id)
+                        ],
+                    }
+                    for phase in sorted(stage.phases, key=lambda phase: phase.id)
+                ],
+            }
+            for stage in sorted(project.stages, key=lambda stage: stage.id)
+        ],
+    }
@@ -0,0 +1,101 @@
+import time
+from collections import Counter
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(budget):
+    # Decorator to give a view its own query budget instead of the QUERY_BUDGET of the app.
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+    return decorator
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0
+        self.statements = []
+        self.repeated = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        self.statements.append((statement, duration))
+        self.repeated[statement] += 1
+
+    def most_repeated(self):
+        if not self.repeated:
+            return None, 0
+        return self.repeated.most_common(1)[0]
+
+
+def current_query_stats():
+    # Stats of the queries run so far by the current request, None outside of a request.
+    if has_app_context():
+        return g.get('query_stats')
+    return None
+
+
+class QueryMonitor:
+    # Counts the queries and the database time of every request, and warns when a route exceeds
+    # its query budget, which usually means an N+1 pattern. When the app is testing it raises
+    # QueryBudgetExceeded instead, and in debug mode the numbers are sent in the response headers.
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_BUDGET', 50)
+
+        # The cursor events are global, registered once for every app of the monitor
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start_time'].pop()
+        stats = current_query_stats()
+        if stats is not None:
+            stats.record(statement, duration)
+
+    def start_request(self):
+        g.query_stats = QueryStats()
+
+    def view_budget(self):
+        view_func = current_app.view_functions.get(request.endpoint)
+        return getattr(view_func, 'query_budget', current_app.config['QUERY_BUDGET'])
+
+    def finish_request(self, response):
+        stats = current_query_stats()
+        if stats is None:
+            return response
+
+        statement, repetitions = stats.most_repeated()
+        if current_app.debug:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time-Ms'] = f'{stats.total_time * 1000:.1f}'
+            response.headers['X-Query-Most-Repeated'] = str(repetitions)
+
+        budget = self.view_budget()
+        if budget is not None and stats.count > budget:
+            message = (
+                f'{request.method} {request.path} ran {stats.count} queries in {stats.total_time * 1000:.1f} ms, '
+                f'over its budget of {budget}. Most repeated ({repetitions} times): {statement}'
+            )
+            if current_app.testing:
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+
+        return response
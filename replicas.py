@@ -0,0 +1,71 @@
+import random
+import time
+from flask import request, session, current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select, CompoundSelect
+
+
+# Bind keys of the replicas in SQLALCHEMY_BINDS: replica_0, replica_1...
+REPLICA_BIND_PREFIX = 'replica_'
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_binds(replica_uris, engine_options):
+    # SQLALCHEMY_BINDS of the replicas, each with the engine options of its database
+    return {
+        f'{REPLICA_BIND_PREFIX}{number}': {'url': uri, **engine_options(uri)}
+        for number, uri in enumerate(replica_uris)
+    }
+
+
+def replica_reads(view_func):
+    # Decorator for the read-only views whose GET requests can be served by a replica.
+    view_func.replica_reads = True
+    return view_func
+
+
+class RoutingSession(Session):
+    # Sends the SELECTs of the requests routed to a replica to that replica. Flushes, bulk writes, raw SQL and
+    # every statement after the first write of the session go to the primary, so reads after writes see them.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or not isinstance(clause, (Select, CompoundSelect)):
+                self.info['wrote'] = True
+            elif self.info.get('replica_bind') and not self.info.get('wrote'):
+                return self._db.engines[self.info['replica_bind']]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    # Picks a replica for the GET requests of the views decorated with replica_reads. Users that wrote in the
+    # last REPLICA_LAG_WINDOW seconds keep reading from the primary, until the replicas have caught up.
+    def __init__(self, db, app=None):
+        self.db = db
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REPLICA_LAG_WINDOW', 5)
+
+        app.before_request(self.route_request)
+        app.after_request(self.remember_writes)
+
+    @property
+    def replicas(self):
+        # Bind keys of the replicas of the app serving the request
+        return [key for key in current_app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith(REPLICA_BIND_PREFIX)]
+
+    def route_request(self):
+        if not self.replicas or request.method not in READ_METHODS:
+            return
+        view_func = current_app.view_functions.get(request.endpoint)
+        if not getattr(view_func, 'replica_reads', False):
+            return
+        if session.get('primary_reads_until', 0) > time.time():
+            return
+        self.db.session.info['replica_bind'] = random.choice(self.replicas)
+
+    def remember_writes(self, response):
+        if self.replicas and self.db.session.info.get('wrote'):
+            session['primary_reads_until'] = time.time() + current_app.config['REPLICA_LAG_WINDOW']
+        return response
@@ -0,0 +1,118 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from datetime import datetime
+from flask import g, request, current_app
+from werkzeug.security import safe_join
+from query_monitor import current_query_stats
+
+
+# Query string argument that asks for the request to be profiled: /some/page?profile=1
+PROFILE_ARGUMENT = 'profile'
+# Functions listed in the report, by cumulative time.
+PROFILE_TOP_FUNCTIONS = 40
+
+
+class RequestProfiler:
+    # Runs a single request under cProfile when an allowed user adds ?profile=1 to its URL. The profile is saved
+    # in PROFILES_DIR next to a JSON report with the slowest functions and the SQL statements of the request.
+    def __init__(self, app=None, is_allowed=None):
+        if app is not None:
+            self.init_app(app, is_allowed)
+
+    def init_app(self, app, is_allowed):
+        app.config.setdefault('PROFILES_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PROFILES_KEEP', 50)
+        self.is_allowed = is_allowed
+
+        app.before_request(self.start_profile)
+        app.after_request(self.record_status)
+        app.teardown_request(self.finish_profile)
+
+    @property
+    def directory(self):
+        return current_app.config['PROFILES_DIR']
+
+    def start_profile(self):
+        if PROFILE_ARGUMENT not in request.args or not self.is_allowed():
+            return
+        profiler = cProfile.Profile()
+        g.profile_start = (profiler, time.perf_counter(), datetime.now())
+        profiler.enable()
+
+    def record_status(self, response):
+        if 'profile_start' in g:
+            g.profile_status = response.status_code
+        return response
+
+    def finish_profile(self, exception):
+        started = g.pop('profile_start', None)
+        if started is None:
+            return
+        profiler, start_time, started_at = started
+        profiler.disable()
+        duration = time.perf_counter() - start_time
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+
+        stats = current_query_stats()
+        statements = stats.statements if stats is not None else []
+        report = {
+            'name': f'{started_at:%Y%m%d-%H%M%S-%f}-{request.endpoint}',
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': g.get('profile_status', 500),
+            'exception': repr(exception) if exception is not None else None,
+            'duration_ms': duration * 1000,
+            'query_count': len(statements),
+            'query_time_ms': sum(statement_time for statement, statement_time in statements) * 1000,
+            'queries': [
+                {'statement': statement, 'duration_ms': statement_time * 1000}
+                for statement, statement_time in statements
+            ],
+            'functions': summary.getvalue(),
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.directory, f'{report["name"]}.prof'))
+        with open(os.path.join(self.directory, f'{report["name"]}.json'), 'w') as file:
+            json.dump(report, file)
+        self.remove_old_profiles()
+
+    def profile_names(self):
+        # Newest first, the names start with the time of the request
+        if not os.path.isdir(self.directory):
+            return []
+        names = [file_name[:-len('.json')] for file_name in os.listdir(self.directory) if file_name.endswith('.json')]
+        return sorted(names, reverse=True)
+
+    def remove_old_profiles(self):
+        for name in self.profile_names()[current_app.config['PROFILES_KEEP']:]:
+            for extension in ('.json', '.prof'):
+                path = os.path.join(self.directory, f'{name}{extension}')
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def load_report(self, name):
+        path = safe_join(self.directory, f'{name}.json')
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def recent_reports(self):
+        # The reports without their queries and functions, for the list of profiles
+        reports = []
+        for name in self.profile_names():
+            report = self.load_report(name)
+            if report is not None:
+                report.pop('queries')
+                report.pop('functions')
+                reports.append(report)
+        return reports
@@ -0,0 +1,173 @@
+import hmac
+import mmap
+import os
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from flask import g, request, current_app, abort, Response
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10, float('inf'))
+HTTP_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS')
+# Requests that didn't match any route (404 and 405) are counted under this endpoint.
+UNMATCHED_ENDPOINT = 'unmatched'
+
+# Slots of every (endpoint, method) series: one per bucket, then the latency sum, the errors and the requests in flight.
+SUM_SLOT = len(LATENCY_BUCKETS)
+ERRORS_SLOT = SUM_SLOT + 1
+IN_FLIGHT_SLOT = SUM_SLOT + 2
+SERIES_SLOTS = SUM_SLOT + 3
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class RouteMetrics:
+    # Latency histograms, error counts and requests in flight by endpoint and method, served at /metrics
+    # in the Prometheus text format. Every gunicorn worker keeps its values in its own mmap'ed file of
+    # METRICS_DIR and /metrics adds up the files of all of them, so the directory should be emptied on deploy.
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        app.before_request(self.start_request)
+        app.after_request(self.record_status)
+        app.teardown_request(self.finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def open_store(self):
+        # Same layout in every worker: the endpoints of the app in order, then the methods.
+        endpoints = sorted(current_app.view_functions) + [UNMATCHED_ENDPOINT]
+        self.series = {}
+        for endpoint in endpoints:
+            for method in HTTP_METHODS:
+                self.series[(endpoint, method)] = 1 + len(self.series) * SERIES_SLOTS
+        self.size = 1 + len(self.series) * SERIES_SLOTS
+        # Files written with another layout, e.g. by a previous deploy, are skipped when reading.
+        self.signature = zlib.crc32(repr((list(self.series), LATENCY_BUCKETS)).encode())
+
+        directory = current_app.config['METRICS_DIR']
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'{os.getpid()}.metrics'), 'w+b') as file:
+            file.truncate(self.size * 8)
+            self.store = mmap.mmap(file.fileno(), self.size * 8)
+        self.values = memoryview(self.store).cast('d')
+        self.values[0] = self.signature
+        self.pid = os.getpid()
+
+    def series_offset(self):
+        # Workers forked after the app was loaded open their own file on their first request
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.open_store()
+        return self.series.get((request.endpoint or UNMATCHED_ENDPOINT, request.method))
+
+    def start_request(self):
+        offset = self.series_offset()
+        if offset is None:
+            return
+        g.metrics_start = (time.perf_counter(), offset)
+        with self.lock:
+            self.values[offset + IN_FLIGHT_SLOT] += 1
+
+    def record_status(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def finish_request(self, exception):
+        started = g.pop('metrics_start', None)
+        if started is None:
+            return
+        start_time, offset = started
+        duration = time.perf_counter() - start_time
+        failed = exception is not None or g.get('metrics_status', 500) >= 500
+
+        with self.lock:
+            self.values[offset + bisect_left(LATENCY_BUCKETS, duration)] += 1
+            self.values[offset + SUM_SLOT] += duration
+            self.values[offset + IN_FLIGHT_SLOT] -= 1
+            if failed:
+                self.values[offset + ERRORS_SLOT] += 1
+
+    def collect(self):
+        # Adds up the values of every worker, the requests in flight only of the workers still running.
+        totals = [0.0] * self.size
+        directory = current_app.config['METRICS_DIR']
+        for file_name in os.listdir(directory):
+            name, extension = os.path.splitext(file_name)
+            if extension != '.metrics' or not name.isdigit():
+                continue
+            with open(os.path.join(directory, file_name), 'rb') as file:
+                data = file.read()
+            if len(data) != self.size * 8:
+                continue
+            values = memoryview(data).cast('d')
+            if values[0] != self.signature:
+                continue
+
+            alive = process_alive(int(name))
+            for offset in self.series.values():
+                for slot in range(SERIES_SLOTS):
+                    if slot != IN_FLIGHT_SLOT or alive:
+                        totals[offset + slot] += values[offset + slot]
+        return totals
+
+    def exposition(self):
+        totals = self.collect()
+        histograms = [
+            '# HELP http_request_duration_seconds Request latency by endpoint and method.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        errors = [
+            '# HELP http_request_errors_total Requests that ended in an exception or a 5xx response.',
+            '# TYPE http_request_errors_total counter',
+        ]
+        in_flight = [
+            '# HELP http_requests_in_flight Requests being served.',
+            '# TYPE http_requests_in_flight gauge',
+        ]
+
+        for (endpoint, method), offset in self.series.items():
+            count = sum(totals[offset:offset + SUM_SLOT])
+            if not count and not totals[offset + IN_FLIGHT_SLOT]:
+                continue
+            labels = f'endpoint="{endpoint}",method="{method}"'
+            cumulative = 0
+            for slot, bound in enumerate(LATENCY_BUCKETS):
+                cumulative += totals[offset + slot]
+                histograms.append(f'http_request_duration_seconds_bucket{{{labels},le="{format_bound(bound)}"}} {cumulative!r}')
+            histograms.append(f'http_request_duration_seconds_sum{{{labels}}} {totals[offset + SUM_SLOT]!r}')
+            histograms.append(f'http_request_duration_seconds_count{{{labels}}} {count!r}')
+            errors.append(f'http_request_errors_total{{{labels}}} {totals[offset + ERRORS_SLOT]!r}')
+            in_flight.append(f'http_requests_in_flight{{{labels}}} {totals[offset + IN_FLIGHT_SLOT]!r}')
+
+        return '\n'.join(histograms + errors + in_flight) + '\n'
+
+    def metrics_view(self):
+        # Only for the scraper, which sends METRICS_TOKEN as a bearer token. Without a token set nobody can read it.
+        token = current_app.config['METRICS_TOKEN']
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if not token:
+            abort(404)
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.strip().encode(), token.encode()):
+            abort(403)
+        return Response(self.exposition(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,228 @@
+import re
+from sqlalchemy import func
+from models import db, Unit, Phase, Concept
+from costs import COST_FAMILIES, TOOLS_LABOUR_RATE, concept_cost_columns
+from prices import is_number
+
+
+# Catalog names the scenarios change prices by, as in prices.py
+SCENARIO_CATALOGS = {
+    'materials': 'material',
+    'machineries': 'machinery',
+    'jobs': 'labour',
+}
+
+# Numeric columns of the concepts catalog, the ones a scenario changes
+TOTAL_COLUMNS = ['material total', 'machinery total', 'labour total', 'tools total', 'direct cost']
+CONCEPT_COLUMNS = list(concept_cost_columns())
+
+
+# Keys a change of a scenario can have
+CHANGE_KEYS = {'catalog', 'name', 'unit', 'percent', 'amount'}
+
+
+class ScenarioError(ValueError):
+    # The scenarios of a simulation are not well formed
+    pass
+
+
+def validate_scenarios(scenarios):
+    # Checks the shape of the scenarios before any of them is evaluated, raises ScenarioError telling which is wrong
+    if not isinstance(scenarios, list) or not scenarios:
+        raise ScenarioError('scenarios must be a non empty list of objects')
+    for position, scenario in enumerate(scenarios, start=1):
+        if not isinstance(scenario, dict):
+            raise ScenarioError(f'scenario {position} must be an object')
+        if not isinstance(scenario.get('name', ''), str):
+            raise ScenarioError(f'the name of scenario {position} must be a string')
+        changes = scenario.get('changes', [])
+        if not isinstance(changes, list):
+            raise ScenarioError(f'the changes of scenario {position} must be a list of objects')
+        for number, change in enumerate(changes, start=1):
+            where = f'change {number} of scenario {position}'
+            if not isinstance(change, dict):
+                raise ScenarioError(f'{where} must be an object')
+            if change.keys() - CHANGE_KEYS:
+                raise ScenarioError(f'{where} has unknown keys: {", ".join(sorted(change.keys() - CHANGE_KEYS))}')
+            if change.get('catalog') not in SCENARIO_CATALOGS:
+                raise ScenarioError(f'the catalog of {where} must be one of {", ".join(SCENARIO_CATALOGS)}')
+            for key in ('name', 'unit'):
+                if not isinstance(change.get(key, ''), str):
+                    raise ScenarioError(f'the {key} of {where} must be a string')
+            if ('percent' in change) == ('amount' in change):
+                raise ScenarioError(f'{where} must have either a percent or an amount')
+            if not is_number(change.get('percent', change.get('amount'))):
+                raise ScenarioError(f'the percent or amount of {where} must be a number')
+
+
+def like_pattern(pattern):
+    # SQL LIKE pattern as a case insensitive regular expression: 'cemento%'
+    expression = ''.join('.*' if character == '%' else '.' if character == '_' else re.escape(character) for character in pattern)
+    return re.compile(f'^{expression}$', re.IGNORECASE)
+
+
+class StageCostMatrix:
+    # Generator quantities of a stage as concept x item matrices, one per cost family, and the catalog prices as
+    # vectors. Price scenarios are evaluated against them with matrix products, without touching the database:
+    # the direct cost of every concept under S scenarios is P (S x items) @ Q.T (items x concepts) per family.
+    def __init__(self, stage_id):
+        import numpy as np
+
+        self.stage_id = stage_id
+        concepts = db.session.query(
+            Concept.id,
+            Phase.code,
+            Concept.code,
+            Concept.name,
+            Concept.quantity,
+            Unit.name
+        ).join(
+            Phase, Phase.id == Concept.phase_id
+        ).join(
+            Unit, Unit.id == Concept.unit_id
+        ).filter(
+            Phase.stage_id == stage_id
+        ).order_by(
+            Phase.id,
+            Concept.id
+        ).all()
+        self.concepts = [
+            {'phase': phase, 'code': code, 'name': name, 'quantity': quantity, 'unit': unit}
+            for concept_id, phase, code, name, quantity, unit in concepts
+        ]
+        concept_index = {row[0]: position for position, row in enumerate(concepts)}
+        self.quantities = np.array([row[4] or 0 for row in concepts], dtype=float)
+        # concepts x phases, to add up the concepts of every phase with a matrix product
+        self.phase_codes = list(dict.fromkeys(row[1] for row in concepts))
+        self.phase_membership = np.zeros((len(concepts), len(self.phase_codes)))
+        for position, row in enumerate(concepts):
+            self.phase_membership[position, self.phase_codes.index(row[1])] = 1
+
+        # Per family: items (names and units), base prices and the quantities matrix
+        self.families = {}
+        for family, (generator, catalog, catalog_fk) in COST_FAMILIES.items():
+            rows = db.session.query(
+                generator.concept_id,
+                catalog.id,
+                catalog.name,
+                Unit.name,
+                catalog.price,
+                func.sum(generator.quantity)
+            ).join(
+                catalog, catalog.id == catalog_fk
+            ).join(
+                Unit, Unit.id == catalog.unit_id
+            ).join(
+                Concept, Concept.id == generator.concept_id
+            ).join(
+                Phase, Phase.id == Concept.phase_id
+            ).filter(
+                Phase.stage_id == stage_id
+            ).group_by(
+                generator.concept_id,
+                catalog.id,
+                catalog.name,
+                Unit.name,
+                catalog.price
+            ).all()
+
+            items = {}
+            for concept_id, item_id, name, unit, price, quantity in rows:
+                items.setdefault(item_id, (name, unit, price))
+            item_index = {item_id: position for position, item_id in enumerate(items)}
+            matrix = np.zeros((len(concepts), len(items)))
+            for concept_id, item_id, name, unit, price, quantity in rows:
+                matrix[concept_index[concept_id], item_index[item_id]] += quantity or 0
+
+            self.families[family] = {
+                'names': [name for name, unit, price in items.values()],
+                'units': np.array([unit for name, unit, price in items.values()], dtype=object),
+                'prices': np.array([price for name, unit, price in items.values()], dtype=float),
+                'matrix': matrix,
+            }
+
+    def scenario_prices(self, family, scenarios):
+        # Prices of a family under every scenario: S x items. Every change of a scenario is applied in order to the
+        # items it selects: {'catalog': 'materials', 'name': 'cemento%', 'unit': 'kg', 'percent': 12} or 'amount'.
+        import numpy as np
+
+        data = self.families[family]
+        prices = np.tile(data['prices'], (len(scenarios), 1))
+        for position, scenario in enumerate(scenarios):
+            for change in scenario.get('changes', []):
+                if SCENARIO_CATALOGS.get(change.get('catalog')) != family:
+                    continue
+                selected = np.ones(len(data['names']), dtype=bool)
+                if change.get('name'):
+                    pattern = like_pattern(change['name'])
+                    selected &= np.array([bool(pattern.match(name)) for name in data['names']], dtype=bool)
+                if change.get('unit'):
+                    selected &= data['units'] == change['unit']
+                if change.get('percent') is not None:
+                    prices[position, selected] *= 1 + float(change['percent']) / 100
+                elif change.get('amount') is not None:
+                    prices[position, selected] += float(change['amount'])
+        return prices
+
+    def totals(self, scenarios):
+        # {column: S x concepts} of the total columns under every scenario, as costs.concept_totals computes them
+        import numpy as np
+
+        totals = {}
+        for family, column in [('material', 'material total'), ('machinery', 'machinery total'), ('labour', 'labour total')]:
+            totals[column] = self.scenario_prices(family, scenarios) @ self.families[family]['matrix'].T
+        totals['tools total'] = TOOLS_LABOUR_RATE * totals['labour total']
+        totals['direct cost'] = totals['material total'] + totals['machinery total'] + totals['labour total'] + totals['tools total']
+
+        # Concepts without a quantity yet are shown in zeros
+        priced = self.quantities != 0
+        for column in totals:
+            totals[column] = np.where(priced, totals[column], 0)
+        return totals
+
+    def concept_rows(self, totals, scenario):
+        # Rows of one scenario in the shape of the concepts catalog, unit prices included
+        import numpy as np
+
+        divisor = np.where(self.quantities != 0, self.quantities, 1)
+        values = {column: totals[column][scenario] for column in TOTAL_COLUMNS}
+        for family in ['material', 'machinery', 'labour', 'tools']:
+            values[f'{family} unit price'] = values[f'{family} total'] / divisor
+        values['unit price'] = values['direct cost'] / divisor
+        values = {column: array.tolist() for column, array in values.items()}
+
+        return [
+            {column: concept[column] if column in concept else values[column][position] for column in CONCEPT_COLUMNS}
+            for position, concept in enumerate(self.concepts)
+        ]
+
+    def simulate(self, scenarios, include_concepts=True):
+        # Evaluates the scenarios against the current prices: the direct cost of the stage under every scenario and
+        # its per phase and, optionally, per concept deltas in the shape of the concepts catalog.
+        validate_scenarios(scenarios)
+        base = self.totals([{}])
+        simulated = self.totals(scenarios)
+        deltas = {column: simulated[column] - base[column] for column in TOTAL_COLUMNS}
+
+        phase_deltas = {column: (deltas[column] @ self.phase_membership).tolist() for column in TOTAL_COLUMNS}
+        direct_costs = simulated['direct cost'].sum(axis=1).tolist()
+        direct_cost_deltas = deltas['direct cost'].sum(axis=1).tolist()
+
+        base_direct_cost = float(base['direct cost'].sum())
+        results = []
+        for position, scenario in enumerate(scenarios):
+            result = {
+                'name': scenario.get('name', f'Scenario {position + 1}'),
+                'direct cost': direct_costs[position],
+                'direct cost delta': direct_cost_deltas[position],
+                'direct cost delta percent': direct_cost_deltas[position] / base_direct_cost * 100 if base_direct_cost else 0,
+                'phases': [
+                    {'phase': phase, **{column: phase_deltas[column][position][phase_position] for column in TOTAL_COLUMNS}}
+                    for phase_position, phase in enumerate(self.phase_codes)
+                ],
+            }
+            if include_concepts:
+                result['concepts'] = self.concept_rows(deltas, position)
+            results.append(result)
+
+        return {'stage_id': self.stage_id, 'direct cost': base_direct_cost, 'scenarios': results}
@@ -0,0 +1,203 @@
+from collections import defaultdict
+from sqlalchemy import event, inspect, select, delete, func, literal, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from models import db, Locations, MaterialEntry, MaterialMove, MaterialExit, MaterialStock, ToolEntry, ToolMove, ToolExit
+
+
+# Inventory movements of every family: item column and {movement model: (date column, [(sign, location column)])}
+INVENTORY_FAMILIES = {
+    'material': ('material_id', {
+        MaterialEntry: ('entry_date', [(1, 'destination_location_id')]),
+        MaterialMove: ('move_date', [(-1, 'source_location_id'), (1, 'destination_location_id')]),
+        MaterialExit: ('exit_date', [(-1, 'source_location_id')]),
+    }),
+    'tool': ('tool_id', {
+        ToolEntry: ('entry_date', [(1, 'destination_location_id')]),
+        ToolMove: ('move_date', [(-1, 'source_location_id'), (1, 'destination_location_id')]),
+        ToolExit: ('exit_date', [(-1, 'source_location_id')]),
+    }),
+}
+# How every material movement changes the stock of the ledger: (sign, location column)
+MATERIAL_MOVEMENTS = {model: locations for model, (date_column, locations) in INVENTORY_FAMILIES['material'][1].items()}
+
+DIALECT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def attribute_value(instance, key, previous):
+    # Value of an attribute before (previous) or after the flush
+    history = inspect(instance).attrs[key].history
+    if previous and history.deleted:
+        return history.deleted[0]
+    if not previous and history.added:
+        return history.added[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(instance, key)
+
+
+def movement_deltas(instance, sign, deltas, previous=False):
+    # Adds the stock changes of a movement to deltas: {(material_id, location_id): quantity}
+    material_id = attribute_value(instance, 'material_id', previous)
+    quantity = attribute_value(instance, 'quantity', previous) or 0
+    for movement_sign, location_column in MATERIAL_MOVEMENTS[type(instance)]:
+        location_id = attribute_value(instance, location_column, previous)
+        if material_id is not None and location_id is not None:
+            deltas[(material_id, location_id)] += sign * movement_sign * quantity
+
+
+def apply_stock_deltas(connection, deltas):
+    # One upsert per changed balance: INSERT .. ON CONFLICT (material_id, location_id) DO UPDATE quantity = quantity + delta
+    rows = [
+        {'material_id': material_id, 'location_id': location_id, 'quantity': quantity}
+        for (material_id, location_id), quantity in deltas.items() if quantity
+    ]
+    if not rows:
+        return
+
+    statement = DIALECT_INSERTS[connection.dialect.name](MaterialStock.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['material_id', 'location_id'],
+        set_={'quantity': MaterialStock.__table__.c.quantity + statement.excluded.quantity}
+    )
+    connection.execute(statement, rows)
+
+
+def keep_previous_value(target, value, previous_value, initiator):
+    return value
+
+
+def watch_stock_movements():
+    # Keeps material_stock up to date with every material movement added, changed or deleted through the ORM.
+    # The balances are written on the connection of the flush, so they are committed or rolled back with it.
+    for model, locations in MATERIAL_MOVEMENTS.items():
+        for key in ['material_id', 'quantity'] + [location_column for sign, location_column in locations]:
+            # Loads the previous value when an expired attribute is changed, its stock has to be reverted
+            event.listen(getattr(model, key), 'set', keep_previous_value, active_history=True)
+
+    @event.listens_for(Session, 'after_flush')
+    def update_material_stock(session, flush_context):
+        deltas = defaultdict(float)
+        for instance in session.new:
+            if type(instance) in MATERIAL_MOVEMENTS:
+                movement_deltas(instance, 1, deltas)
+        for instance in session.dirty:
+            if type(instance) in MATERIAL_MOVEMENTS and session.is_modified(instance):
+                movement_deltas(instance, -1, deltas, previous=True)
+                movement_deltas(instance, 1, deltas)
+        for instance in session.deleted:
+            if type(instance) in MATERIAL_MOVEMENTS:
+                movement_deltas(instance, -1, deltas, previous=True)
+
+        if deltas:
+            apply_stock_deltas(session.connection(), deltas)
+
+
+def inventory_movements(family, *criteria_by_date):
+    # Every movement of a family as (item_id, location_id, movement_date, quantity) rows, one per location it
+    # changes. criteria_by_date are functions of the date column, e.g. lambda date: date <= cutoff.
+    item_column, movements = INVENTORY_FAMILIES[family]
+    selects = []
+    for model, (date_column, locations) in movements.items():
+        movement_date = getattr(model, date_column)
+        for sign, location_column in locations:
+            location_id = getattr(model, location_column)
+            selects.append(
+                select(
+                    getattr(model, item_column).label('item_id'),
+                    location_id.label('location_id'),
+                    movement_date.label('movement_date'),
+                    (literal(sign) * model.quantity).label('quantity')
+                ).where(
+                    location_id.isnot(None),
+                    *[criterion(movement_date) for criterion in criteria_by_date]
+                )
+            )
+    return union_all(*selects).subquery()
+
+
+def stock_from_movements(family, *criteria_by_date, location_id=None):
+    # {(item_id, location_id): quantity} adding up the movements of a family in one grouped query
+    movements = inventory_movements(family, *criteria_by_date)
+    query = db.session.query(
+        movements.c.item_id,
+        movements.c.location_id,
+        func.sum(movements.c.quantity)
+    )
+    if location_id is not None:
+        query = query.filter(movements.c.location_id == location_id)
+    rows = query.group_by(
+        movements.c.item_id,
+        movements.c.location_id
+    ).all()
+    return {(item_id, location_id): quantity or 0 for item_id, location_id, quantity in rows}
+
+
+def reconcile_material_stock():
+    # Rebuilds material_stock from the movement history, returns the balances that didn't match:
+    # {(material_id, location_id): (ledger quantity, history quantity)}
+    ledger = {
+        (material_id, location_id): quantity
+        for material_id, location_id, quantity in db.session.query(
+            MaterialStock.material_id,
+            MaterialStock.location_id,
+            MaterialStock.quantity
+        ).all()
+    }
+    history = stock_from_movements('material')
+
+    mismatches = {}
+    for key in ledger.keys() | history.keys():
+        if abs(ledger.get(key, 0) - history.get(key, 0)) > 1e-9:
+            mismatches[key] = (ledger.get(key, 0), history.get(key, 0))
+
+    db.session.execute(delete(MaterialStock.__table__))
+    rows = [
+        {'material_id': material_id, 'location_id': location_id, 'quantity': quantity}
+        for (material_id, location_id), quantity in history.items()
+    ]
+    if rows:
+        db.session.execute(MaterialStock.__table__.insert(), rows)
+    db.session.commit()
+    return mismatches
+
+
+def material_stock(material_id, location_id):
+    # Stock of a material in a location, one primary key lookup
+    quantity = db.session.query(
+        MaterialStock.quantity
+    ).filter(
+        MaterialStock.material_id == material_id,
+        MaterialStock.location_id == location_id
+    ).scalar()
+    return quantity or 0
+
+
+def location_stock(location_id):
+    # {material_id: quantity} of a location
+    rows = db.session.query(
+        MaterialStock.material_id,
+        MaterialStock.quantity
+    ).filter(
+        MaterialStock.location_id == location_id,
+        MaterialStock.quantity != 0
+    ).all()
+    return dict(rows)
+
+
+def stage_stock(stage_id):
+    # {material_id: quantity} adding up the locations of a stage
+    rows = db.session.query(
+        MaterialStock.material_id,
+        func.sum(MaterialStock.quantity)
+    ).join(
+        Locations, Locations.id == MaterialStock.location_id
+    ).filter(
+        Locations.stage_id == stage_id
+    ).group_by(
+        MaterialStock.material_id
+    ).all()
+    return {material_id: quantity for material_id, quantity in rows if quantity}
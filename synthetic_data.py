@@ -0,0 +1,220 @@
+import random
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert, inspect
+from werkzeug.security import generate_password_hash
+from stock_ledger import reconcile_material_stock
+from tool_custody import reconcile_tool_custody
+from valuation import revalue_stale_items
+from models import db, Unit, Project, Stage, Phase, Concept, Tool, Job, Machinery, Material, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, Locations, MaterialEntry, MaterialMove, MaterialExit, ToolEntry, ToolMove, ToolExit, Employee, Attendance, Specialty, Position, User, NewUser
+
+
+# Volumes of the synthetic datasets. Stages are per project, phases per stage, concepts per phase,
+# generators per concept and family, locations per stage and attendance days per employee.
+SYNTHETIC_VOLUMES = {
+    'small': {
+        'projects': 2, 'stages': 2, 'phases': 4, 'concepts': 10, 'generators': 3, 'catalog_items': 50,
+        'locations': 2, 'movements': 500, 'employees': 20, 'attendance_days': 20, 'users': 20,
+    },
+    'medium': {
+        'projects': 5, 'stages': 3, 'phases': 8, 'concepts': 25, 'generators': 4, 'catalog_items': 300,
+        'locations': 3, 'movements': 5000, 'employees': 100, 'attendance_days': 60, 'users': 100,
+    },
+    'large': {
+        'projects': 10, 'stages': 4, 'phases': 12, 'concepts': 50, 'generators': 5, 'catalog_items': 1000,
+        'locations': 4, 'movements': 50000, 'employees': 300, 'attendance_days': 120, 'users': 500,
+    },
+}
+
+UNIT_NAMES = ['m', 'm2', 'm3', 'kg', 'ton', 'pza', 'lt', 'jor', 'hr', 'lote']
+PHASE_NAMES = ['Preliminares', 'Cimentacion', 'Estructura', 'Albanileria', 'Instalaciones', 'Acabados', 'Herreria', 'Carpinteria', 'Jardineria', 'Limpieza']
+# Catalog model, name prefix and price range of every cost family
+CATALOGS = {
+    'material': (Material, 'Material', (5, 5000)),
+    'machinery': (Machinery, 'Maquinaria', (200, 20000)),
+    'labour': (Job, 'Mano de obra', (100, 2000)),
+    'tools': (Tool, 'Herramienta', (10, 3000)),
+}
+GENERATORS = {
+    'material': (MatGenerator, 'material_id'),
+    'machinery': (MaqGenerator, 'machinery_id'),
+    'labour': (MoGenerator, 'job_id'),
+    'tools': (HerGenerator, 'tool_id'),
+}
+
+
+def bulk_insert(model, rows):
+    # Inserts the rows in one batched INSERT .. RETURNING, returns their ids in the order of the rows.
+    if not rows:
+        return []
+    return list(db.session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows))
+
+
+def seed_synthetic_data(volumes, seed=0, password='synthetic'):
+    # Adds a synthetic dataset of the given volumes to the database, returns the rows added per table.
+    # Names get a suffix of the seed, so datasets of different seeds can live in the same database.
+    generator = random.Random(seed)
+    today = date.today()
+    suffix = f'S{seed}'
+
+    def random_date(days):
+        return today - timedelta(days=generator.randrange(days))
+
+    unit_ids = bulk_insert(Unit, [{'name': f'{name} {suffix}', 'description': name} for name in UNIT_NAMES])
+
+    catalog_ids = {}
+    for family, (catalog, prefix, (low, high)) in CATALOGS.items():
+        catalog_ids[family] = bulk_insert(catalog, [
+            {
+                'name': f'{prefix} {number} {suffix}',
+                'unit_id': generator.choice(unit_ids),
+                'price': round(generator.uniform(low, high), 2),
+                'last_update': random_date(365),
+            }
+            for number in range(volumes['catalog_items'])
+        ])
+
+    project_ids = bulk_insert(Project, [
+        {
+            'name': f'Proyecto {number} {suffix}',
+            'slogan': f'Proyecto sintetico {number}',
+            'description': 'Datos sinteticos',
+            'start_date': random_date(720),
+            'end_date': today + timedelta(days=generator.randrange(720)),
+        }
+        for number in range(volumes['projects'])
+    ])
+    stage_ids = bulk_insert(Stage, [
+        {
+            'name': f'Etapa {number}',
+            'project_id': project_id,
+            'start_date': random_date(720),
+            'end_date': today + timedelta(days=generator.randrange(720)),
+        }
+        for project_id in project_ids for number in range(volumes['stages'])
+    ])
+    phase_rows = [
+        {
+            'name': f'{PHASE_NAMES[number % len(PHASE_NAMES)]} {number}',
+            'code': f'{chr(ord("A") + number % 26)}{number // 26 or ""}',
+            'stage_id': stage_id,
+        }
+        for stage_id in stage_ids for number in range(volumes['phases'])
+    ]
+    phase_ids = bulk_insert(Phase, phase_rows)
+    concept_rows = [
+        {
+            'name': f'Concepto {number} de {phase["name"]}',
+            'code': f'{phase["code"]}-{number + 1}',
+            'quantity': round(generator.uniform(1, 1000), 2),
+            'unit_id': generator.choice(unit_ids),
+            'phase_id': phase_id,
+        }
+        for phase_id, phase in zip(phase_ids, phase_rows) for number in range(volumes['concepts'])
+    ]
+    concept_ids = bulk_insert(Concept, concept_rows)
+
+    counts = {'units': len(unit_ids), 'projects': len(project_ids), 'stages': len(stage_ids), 'phases': len(phase_ids), 'concepts': len(concept_ids)}
+    for family, (generator_model, catalog_fk) in GENERATORS.items():
+        counts[generator_model.__tablename__] = len(bulk_insert(generator_model, [
+            {
+                catalog_fk: generator.choice(catalog_ids[family]),
+                'quantity': round(generator.uniform(0.1, 50), 3),
+                'unit_id': generator.choice(unit_ids),
+                'concept_id': concept_id,
+            }
+            for concept_id in concept_ids for number in range(volumes['generators'])
+        ]))
+    for family, ids in catalog_ids.items():
+        counts[CATALOGS[family][0].__tablename__] = len(ids)
+
+    # People
+    specialty_ids = bulk_insert(Specialty, [{'name': name, 'description': f'Especialidad de {name}'} for name in PHASE_NAMES])
+    employee_ids = bulk_insert(Employee, [
+        {
+            'name': f'Empleado {number} {suffix}',
+            'email': f'empleado{number}.{suffix}@example.com',
+            'phone': f'{suffix}-{number:06d}',
+            'rank': generator.choice(['Maestro', 'Chalan']),
+            'specialty_id': generator.choice(specialty_ids),
+            'base_salary': round(generator.uniform(300, 1500), 2),
+            'last_update': random_date(365),
+        }
+        for number in range(volumes['employees'])
+    ])
+    attendance_rows = []
+    for employee_id in employee_ids:
+        for day in range(volumes['attendance_days']):
+            entry_hour = datetime.combine(today - timedelta(days=day), datetime.min.time()) + timedelta(hours=generator.choice([7, 8, 9]))
+            attendance_rows.append({'employee_id': employee_id, 'entry_hour': entry_hour, 'exit_hour': entry_hour + timedelta(hours=9)})
+    counts['attendance'] = len(bulk_insert(Attendance, attendance_rows))
+
+    position_ids = bulk_insert(Position, [{'name': f'{name} {suffix}', 'description': f'Puesto de {name}'} for name in ['Residente', 'Almacenista', 'Compras', 'Supervisor']])
+    password_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+    counts['users'] = len(bulk_insert(User, [
+        {
+            'email': f'usuario{number}.{suffix}@example.com',
+            'password': password_hash,
+            'name': f'Usuario {number} {suffix}',
+            'gram': f'U{number}{suffix}',
+            'is_admin': False,
+            'position_id': generator.choice(position_ids),
+        }
+        for number in range(volumes['users'])
+    ]))
+    counts['new_users'] = len(bulk_insert(NewUser, [
+        {
+            'email': f'solicitud{number}.{suffix}@example.com',
+            'password': password_hash,
+            'name': f'Solicitud {number} {suffix}',
+            'status': generator.choice(['Pending', 'Approved', 'Denied']),
+        }
+        for number in range(volumes['users'] // 5)
+    ]))
+
+    # Inventory movements, split between entries, moves and exits of materials and tools
+    location_ids = bulk_insert(Locations, [
+        {'name': f'Almacen {stage_id}-{number} {suffix}', 'stage_id': stage_id}
+        for stage_id in stage_ids for number in range(volumes['locations'])
+    ])
+    counts['locations'] = len(location_ids)
+    for family, item_fk, entry_model, move_model, exit_model in [
+        ('material', 'material_id', MaterialEntry, MaterialMove, MaterialExit),
+        ('tools', 'tool_id', ToolEntry, ToolMove, ToolExit),
+    ]:
+        movements = volumes['movements'] // 2
+        entries = []
+        for number in range(movements // 2):
+            quantity = round(generator.uniform(1, 100), 2)
+            price = round(generator.uniform(*CATALOGS[family][2]), 2)
+            entries.append({
+                'entry_date': random_date(365), item_fk: generator.choice(catalog_ids[family]), 'quantity': quantity,
+                'unit_id': generator.choice(unit_ids), 'destination_location_id': generator.choice(location_ids),
+                'price': price, 'total': quantity * price, 'employee_id': generator.choice(employee_ids),
+            })
+        moves = [
+            {
+                'move_date': random_date(365), item_fk: generator.choice(catalog_ids[family]), 'quantity': round(generator.uniform(1, 20), 2),
+                'unit_id': generator.choice(unit_ids), 'source_location_id': generator.choice(location_ids),
+                'destination_location_id': generator.choice(location_ids), 'employee_id': generator.choice(employee_ids),
+            }
+            for number in range(movements // 4)
+        ]
+        exits = [
+            {
+                'exit_date': random_date(365), item_fk: generator.choice(catalog_ids[family]), 'quantity': round(generator.uniform(1, 20), 2),
+                'unit_id': generator.choice(unit_ids), 'concept_id': generator.choice(concept_ids), 'employee_id': generator.choice(employee_ids),
+            }
+            for number in range(movements - movements // 2 - movements // 4)
+        ]
+        if 'source_location_id' in inspect(exit_model).columns:
+            for row in exits:
+                row['source_location_id'] = generator.choice(location_ids)
+        for model, rows in [(entry_model, entries), (move_model, moves), (exit_model, exits)]:
+            counts[model.__tablename__] = len(bulk_insert(model, rows))
+
+    db.session.commit()
+    # The bulk inserts skip the stock ledger, custody and valuation events, they are rebuilt from the movements
+    reconcile_material_stock()
+    reconcile_tool_custody()
+    revalue_stale_items(everything=True)
+    return counts
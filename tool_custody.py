@@ -0,0 +1,240 @@
+from collections import defaultdict
+from sqlalchemy import event, select, update, delete, and_, or_, case, union_all
+from sqlalchemy.orm import Session
+from models import db, Tool, Locations, Employee, ToolCustody
+from stock_ledger import INVENTORY_FAMILIES, DIALECT_INSERTS, attribute_value, keep_previous_value, stock_from_movements
+
+
+# How every tool movement changes the custody: date column and [(sign, location column)]
+TOOL_MOVEMENTS = INVENTORY_FAMILIES['tool'][1]
+
+
+def movement_custody(instance, sign, deltas, arrivals, previous=False):
+    # Adds the quantity changes of a movement to deltas and the custody it gives to arrivals:
+    # {(tool_id, location_id): quantity} and {(tool_id, location_id): (date, employee_id)}
+    date_column, locations = TOOL_MOVEMENTS[type(instance)]
+    tool_id = attribute_value(instance, 'tool_id', previous)
+    quantity = attribute_value(instance, 'quantity', previous) or 0
+    movement_date = attribute_value(instance, date_column, previous)
+    employee_id = attribute_value(instance, 'employee_id', previous)
+    for movement_sign, location_column in locations:
+        location_id = attribute_value(instance, location_column, previous)
+        if tool_id is None or location_id is None:
+            continue
+        deltas[(tool_id, location_id)] += sign * movement_sign * quantity
+        if movement_sign > 0 and movement_date is not None:
+            key = (tool_id, location_id)
+            if key not in arrivals or arrivals[key][0] <= movement_date:
+                arrivals[key] = (movement_date, employee_id)
+
+
+def apply_custody_changes(connection, deltas, arrivals):
+    # One upsert per changed custody: the quantity adds the delta and the holder changes when the movement is not
+    # older than the one that gave the current custody, so a backdated entry doesn't take the tools from the holder.
+    rows = [
+        {
+            'tool_id': tool_id,
+            'location_id': location_id,
+            'quantity': deltas.get((tool_id, location_id), 0),
+            'employee_id': arrivals.get((tool_id, location_id), (None, None))[1],
+            'since': arrivals.get((tool_id, location_id), (None, None))[0],
+        }
+        for tool_id, location_id in deltas.keys() | arrivals.keys()
+    ]
+    if not rows:
+        return
+
+    table = ToolCustody.__table__
+    statement = DIALECT_INSERTS[connection.dialect.name](table)
+    newer = and_(
+        statement.excluded.since.isnot(None),
+        or_(table.c.since.is_(None), statement.excluded.since >= table.c.since)
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=['tool_id', 'location_id'],
+        set_={
+            'quantity': table.c.quantity + statement.excluded.quantity,
+            'employee_id': case((newer, statement.excluded.employee_id), else_=table.c.employee_id),
+            'since': case((newer, statement.excluded.since), else_=table.c.since),
+        }
+    )
+    connection.execute(statement, rows)
+
+
+def latest_arrivals(*criteria):
+    # (tool_id, location_id, date, employee_id) of every movement that brings tools to a location
+    selects = []
+    for model, (date_column, locations) in TOOL_MOVEMENTS.items():
+        for sign, location_column in locations:
+            if sign < 0:
+                continue
+            location_id = getattr(model, location_column)
+            selects.append(
+                select(
+                    model.tool_id.label('tool_id'),
+                    location_id.label('location_id'),
+                    getattr(model, date_column).label('movement_date'),
+                    model.employee_id.label('employee_id')
+                ).where(
+                    *[criterion(model.tool_id, location_id) for criterion in criteria]
+                )
+            )
+    return union_all(*selects).subquery()
+
+
+def refresh_holders(connection, keys):
+    # Finds again the holder of the custodies whose arriving movements were changed or deleted
+    for tool_id, location_id in keys:
+        arrivals = latest_arrivals(lambda tool, location: and_(tool == tool_id, location == location_id))
+        latest = connection.execute(
+            select(
+                arrivals.c.movement_date,
+                arrivals.c.employee_id
+            ).order_by(
+                arrivals.c.movement_date.desc()
+            ).limit(1)
+        ).first()
+        connection.execute(
+            update(ToolCustody.__table__).where(
+                ToolCustody.__table__.c.tool_id == tool_id,
+                ToolCustody.__table__.c.location_id == location_id
+            ).values(
+                since=latest.movement_date if latest else None,
+                employee_id=latest.employee_id if latest else None
+            )
+        )
+
+
+def watch_tool_custody():
+    # Keeps tool_custody up to date with every tool movement added, changed or deleted through the ORM, in the
+    # transaction of the flush. New movements update it with one upsert, the rare changes and deletions of
+    # movements that brought tools look up the holder again for the custodies they touched.
+    for model, (date_column, locations) in TOOL_MOVEMENTS.items():
+        for key in ['tool_id', 'quantity', 'employee_id', date_column] + [location_column for sign, location_column in locations]:
+            event.listen(getattr(model, key), 'set', keep_previous_value, active_history=True)
+
+    @event.listens_for(Session, 'after_flush')
+    def update_tool_custody(session, flush_context):
+        deltas = defaultdict(float)
+        arrivals = {}
+        stale_holders = set()
+        for instance in session.new:
+            if type(instance) in TOOL_MOVEMENTS:
+                movement_custody(instance, 1, deltas, arrivals)
+        for instance in session.dirty:
+            if type(instance) in TOOL_MOVEMENTS and session.is_modified(instance):
+                previous_arrivals = {}
+                movement_custody(instance, -1, deltas, previous_arrivals, previous=True)
+                movement_custody(instance, 1, deltas, previous_arrivals)
+                stale_holders.update(previous_arrivals)
+        for instance in session.deleted:
+            if type(instance) in TOOL_MOVEMENTS:
+                previous_arrivals = {}
+                movement_custody(instance, -1, deltas, previous_arrivals, previous=True)
+                stale_holders.update(previous_arrivals)
+
+        if deltas or arrivals:
+            apply_custody_changes(session.connection(), deltas, arrivals)
+        if stale_holders:
+            refresh_holders(session.connection(), stale_holders)
+
+
+def reconcile_tool_custody():
+    # Rebuilds tool_custody from the movement history, returns the custodies that didn't match:
+    # {(tool_id, location_id): ((ledger quantity, ledger holder), (history quantity, history holder))}
+    ledger = {
+        (tool_id, location_id): (quantity, employee_id)
+        for tool_id, location_id, quantity, employee_id in db.session.query(
+            ToolCustody.tool_id,
+            ToolCustody.location_id,
+            ToolCustody.quantity,
+            ToolCustody.employee_id
+        ).all()
+    }
+    quantities = stock_from_movements('tool')
+    arrivals = latest_arrivals()
+    holders = {}
+    for tool_id, location_id, movement_date, employee_id in db.session.query(
+        arrivals.c.tool_id,
+        arrivals.c.location_id,
+        arrivals.c.movement_date,
+        arrivals.c.employee_id
+    ).order_by(
+        arrivals.c.movement_date
+    ).all():
+        holders[(tool_id, location_id)] = (movement_date, employee_id)
+
+    history = {
+        key: (quantities.get(key, 0), holders.get(key, (None, None))[1])
+        for key in quantities.keys() | holders.keys()
+    }
+    mismatches = {}
+    for key in ledger.keys() | history.keys():
+        ledger_quantity, ledger_holder = ledger.get(key, (0, None))
+        history_quantity, history_holder = history.get(key, (0, None))
+        if abs(ledger_quantity - history_quantity) > 1e-9 or ledger_holder != history_holder:
+            mismatches[key] = (ledger.get(key, (0, None)), history.get(key, (0, None)))
+
+    db.session.execute(delete(ToolCustody.__table__))
+    rows = [
+        {
+            'tool_id': tool_id,
+            'location_id': location_id,
+            'quantity': quantity,
+            'employee_id': employee_id,
+            'since': holders.get((tool_id, location_id), (None, None))[0],
+        }
+        for (tool_id, location_id), (quantity, employee_id) in history.items()
+    ]
+    if rows:
+        db.session.execute(ToolCustody.__table__.insert(), rows)
+    db.session.commit()
+    return mismatches
+
+
+def custody_query():
+    return db.session.query(
+        ToolCustody.tool_id,
+        Tool.name.label('tool'),
+        ToolCustody.location_id,
+        Locations.name.label('location'),
+        ToolCustody.quantity,
+        ToolCustody.employee_id,
+        Employee.name.label('employee'),
+        ToolCustody.since
+    ).join(
+        Tool, Tool.id == ToolCustody.tool_id
+    ).join(
+        Locations, Locations.id == ToolCustody.location_id
+    ).outerjoin(
+        Employee, Employee.id == ToolCustody.employee_id
+    ).filter(
+        ToolCustody.quantity > 1e-9
+    )
+
+
+def custody_rows(query):
+    return [
+        {**row._asdict(), 'since': row.since.isoformat() if row.since else None}
+        for row in query.order_by(Locations.name, Tool.name).all()
+    ]
+
+
+def tools_at_location(location_id):
+    # Tools on hand in a location and their holders, a lookup on the location index
+    return custody_rows(custody_query().filter(ToolCustody.location_id == location_id))
+
+
+def tools_at_stage(stage_id):
+    # Tools on hand in every location of a stage
+    return custody_rows(custody_query().filter(Locations.stage_id == stage_id))
+
+
+def tools_held_by(employee_id):
+    # Tools an employee is responsible for, a lookup on the employee index
+    return custody_rows(custody_query().filter(ToolCustody.employee_id == employee_id))
+
+
+def tool_whereabouts(tool_id):
+    # Locations where a tool is and who holds it in each
+    return custody_rows(custody_query().filter(ToolCustody.tool_id == tool_id))
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from models import db, User
+
+
+class UserCache:
+    # In-process LRU cache of the users loaded by Flask-Login, with a time to live per entry.
+    # The users are kept as detached copies and merged into the request's session without a query.
+    # Invalidations touch a generation file, so every gunicorn worker of the host drops its cache too.
+    def __init__(self, maxsize=256, ttl=300, generation_file=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation_file = generation_file
+        self.generation = self.read_generation()
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        # The generation file lives in the instance folder, shared by the workers of the host
+        self.maxsize = app.config.get('USER_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.generation_file = os.path.join(app.instance_path, 'user_cache.generation')
+        self.generation = self.read_generation()
+        app.extensions['user_cache'] = self
+
+    def read_generation(self):
+        if not self.generation_file:
+            return None
+        try:
+            stat = os.stat(self.generation_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def bump_generation(self):
+        # A new file each time, so the inode changes even where mtimes are coarse
+        temporary_file = f'{self.generation_file}.{os.getpid()}'
+        with open(temporary_file, 'w') as file:
+            file.write(str(time.time()))
+        os.replace(temporary_file, self.generation_file)
+
+    def check_generation(self):
+        generation = self.read_generation()
+        if generation != self.generation:
+            self.users.clear()
+            self.generation = generation
+
+    def get(self, user_id):
+        with self.lock:
+            self.check_generation()
+            entry = self.users.get(user_id)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                del self.users[user_id]
+                return None
+            self.users.move_to_end(user_id)
+        return db.session.merge(user, load=False)
+
+    def put(self, user):
+        # Detached copy of the column values, independent of the session that loaded the user
+        user_copy = User(**{attribute.key: getattr(user, attribute.key) for attribute in inspect(User).column_attrs})
+        make_transient_to_detached(user_copy)
+        with self.lock:
+            self.users[user.id] = (user_copy, time.monotonic() + self.ttl)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.maxsize:
+                self.users.popitem(last=False)
+
+    def invalidate(self, user_ids=None):
+        # Drop the given users, or every user, here and in the other workers.
+        with self.lock:
+            if user_ids is None:
+                self.users.clear()
+            else:
+                for user_id in user_ids:
+                    self.users.pop(user_id, None)
+            if self.generation_file:
+                self.bump_generation()
+                self.generation = self.read_generation()
+
+    def load_user(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self.put(user)
+        return user
+
+
+def watch_user_changes():
+    # Invalidate the users changed by a session once its transaction is committed, in the cache of the app.
+    @event.listens_for(Session, 'after_flush')
+    def collect_changed_users(session, flush_context):
+        changed_users = session.info.setdefault('changed_users', set())
+        for instance in list(session.dirty) + list(session.deleted):
+            if isinstance(instance, User):
+                changed_users.add(instance.id)
+
+    @event.listens_for(Session, 'after_commit')
+    def invalidate_changed_users(session):
+        changed_users = session.info.pop('changed_users', None)
+        if changed_users and has_app_context() and 'user_cache' in current_app.extensions:
+            current_app.extensions['user_cache'].invalidate(changed_users)
+
+    @event.listens_for(Session, 'after_rollback')
+    def forget_changed_users(session):
+        session.info.pop('changed_users', None)
@@ -0,0 +1,377 @@
+from bisect import insort
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import event, inspect, select, insert, update, delete, func, literal, union_all, bindparam, tuple_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from models import db, Phase, Concept, Material, Tool, CostLayer, ItemValuation, VarianceReport
+from stock_ledger import INVENTORY_FAMILIES, DIALECT_INSERTS, attribute_value, keep_previous_value
+from variance import mark_variance_reports_stale
+
+
+VALUATION_METHODS = ('average', 'fifo')
+
+# Catalog of every family, the quantities taken without layers left are charged at its price
+FAMILY_CATALOGS = {
+    'material': Material,
+    'tool': Tool,
+}
+
+# Every valued movement: family, item column, date column and [(sign, location column)]. Receipts only add stock
+# and are valued at their price, moves and exits take stock from their source location and get a cost.
+VALUED_MOVEMENTS = {
+    model: (family, item_column, date_column, locations)
+    for family, (item_column, movements) in INVENTORY_FAMILIES.items()
+    for model, (date_column, locations) in movements.items()
+}
+
+# Items revalued per round of queries
+REVALUATION_BATCH = 500
+
+
+def is_receipt(model):
+    return all(sign > 0 for sign, location_column in VALUED_MOVEMENTS[model][3])
+
+
+def movement_order(model, movement_date, movement_id):
+    # Movements of a day are valued receipts first, then moves, then exits
+    locations = VALUED_MOVEMENTS[model][3]
+    return (movement_date, 0 if is_receipt(model) else len(locations), movement_id)
+
+
+def receive(layers, method, location_id, layer_date, quantity, unit_cost):
+    # Adds a layer to the [[date, quantity, unit cost]] of a location, oldest first, or merges the receipt into the
+    # average cost layer of the location
+    if quantity <= 0 or location_id is None:
+        return
+    location_layers = layers[location_id]
+    if method == 'average' and location_layers:
+        layer = location_layers[0]
+        total_quantity = layer[1] + quantity
+        layer[2] = (layer[1] * layer[2] + quantity * unit_cost) / total_quantity
+        layer[1] = total_quantity
+        return
+    insort(location_layers, [layer_date, quantity, unit_cost], key=lambda layer: layer[0])
+
+
+def consume(layers, location_id, quantity, price):
+    # Takes the quantity from the layers of a location, oldest first. Returns its cost and the [(date, quantity,
+    # unit cost)] taken, a shortage is charged at the catalog price.
+    taken = []
+    remaining = quantity
+    location_layers = layers.get(location_id, [])
+    while location_layers and remaining > 1e-9:
+        layer = location_layers[0]
+        quantity_taken = min(layer[1], remaining)
+        remaining -= quantity_taken
+        taken.append((layer[0], quantity_taken, layer[2]))
+        layer[1] -= quantity_taken
+        if layer[1] <= 1e-9:
+            location_layers.pop(0)
+
+    if remaining > 1e-9:
+        taken.append((None, remaining, price or 0))
+    return sum(quantity_taken * unit_cost for layer_date, quantity_taken, unit_cost in taken), taken
+
+
+def value_movement(layers, method, model, movement, price):
+    # Posts a movement to the layers of its item, returns the cost of moves and exits. movement is a mapping of its
+    # columns and price the catalog price of the item.
+    family, item_column, date_column, locations = VALUED_MOVEMENTS[model]
+    movement_date = movement[date_column]
+    quantity = movement['quantity'] or 0
+    if is_receipt(model):
+        for sign, location_column in locations:
+            receive(layers, method, movement[location_column], movement_date, quantity, movement['price'])
+        return None
+
+    cost, taken = consume(layers, movement['source_location_id'], quantity, price)
+    for sign, location_column in locations:
+        if sign < 0:
+            continue
+        # The moved quantity keeps the cost and the age of the layers it was taken from
+        for layer_date, quantity_taken, unit_cost in taken:
+            receive(layers, method, movement[location_column], layer_date or movement_date, quantity_taken, unit_cost)
+    return cost
+
+
+def valuation_method():
+    method = current_app.config.get('VALUATION_METHOD', 'average')
+    if method not in VALUATION_METHODS:
+        raise ValueError(f'VALUATION_METHOD must be one of {", ".join(VALUATION_METHODS)}')
+    return method
+
+
+def load_layers(connection, family, item_ids):
+    # {item_id: {location_id: [[date, quantity, unit cost]]}} of the items, one query
+    table = CostLayer.__table__
+    layers = {item_id: defaultdict(list) for item_id in item_ids}
+    rows = connection.execute(
+        select(table.c.item_id, table.c.location_id, table.c.layer_date, table.c.quantity, table.c.unit_cost).where(
+            table.c.family == family,
+            table.c.item_id.in_(item_ids)
+        ).order_by(
+            table.c.layer_date,
+            table.c.id
+        )
+    )
+    for item_id, location_id, layer_date, quantity, unit_cost in rows:
+        layers[item_id][location_id].append([layer_date, quantity, unit_cost])
+    return layers
+
+
+def save_layers(connection, family, layers):
+    # Replaces the layers of the items with one DELETE and one INSERT
+    table = CostLayer.__table__
+    connection.execute(delete(table).where(table.c.family == family, table.c.item_id.in_(list(layers))))
+    rows = [
+        {'family': family, 'item_id': item_id, 'location_id': location_id, 'layer_date': layer_date, 'quantity': quantity, 'unit_cost': unit_cost}
+        for item_id, item_layers in layers.items()
+        for location_id, location_layers in item_layers.items()
+        for layer_date, quantity, unit_cost in location_layers
+    ]
+    if rows:
+        connection.execute(insert(table), rows)
+
+
+def catalog_prices(connection, family, item_ids):
+    catalog = FAMILY_CATALOGS[family]
+    return dict(connection.execute(select(catalog.id, catalog.price).where(catalog.id.in_(item_ids))).all())
+
+
+def save_costs(connection, costs):
+    # One executemany UPDATE per table, costs: {model: {movement_id: cost}}
+    for model, movement_costs in costs.items():
+        if movement_costs:
+            table = model.__table__
+            connection.execute(
+                update(table).where(table.c.id == bindparam('movement_id')).values(cost=bindparam('movement_cost')),
+                [{'movement_id': movement_id, 'movement_cost': cost} for movement_id, cost in movement_costs.items()]
+            )
+
+
+def save_valuation_state(connection, family, method, valued_until, is_stale=False):
+    # One upsert for the items of a family, valued_until: {item_id: date of the last movement valued}
+    table = ItemValuation.__table__
+    rows = [
+        {'family': family, 'item_id': item_id, 'method': method, 'valued_until': until, 'is_stale': is_stale}
+        for item_id, until in valued_until.items()
+    ]
+    if not rows:
+        return
+    statement = DIALECT_INSERTS[connection.dialect.name](table)
+    values = {'is_stale': statement.excluded.is_stale}
+    if not is_stale:
+        values.update(method=statement.excluded.method, valued_until=statement.excluded.valued_until)
+    connection.execute(statement.on_conflict_do_update(index_elements=['family', 'item_id'], set_=values), rows)
+
+
+def movement_values(instance):
+    return {column.key: getattr(instance, column.key) for column in inspect(type(instance)).columns}
+
+
+def post_movements(connection, method, family, movements):
+    # Values new movements posted in date order on top of the saved layers of their items, movements:
+    # {item_id: [instance]}. Three queries to read and three to write for all the items, the costs are set on the
+    # instances too.
+    layers = load_layers(connection, family, list(movements))
+    prices = catalog_prices(connection, family, list(movements))
+    costs = defaultdict(dict)
+    valued_until = {}
+    for item_id, item_movements in movements.items():
+        for movement in item_movements:
+            cost = value_movement(layers[item_id], method, type(movement), movement_values(movement), prices.get(item_id))
+            if cost is not None:
+                costs[type(movement)][movement.id] = cost
+                set_committed_value(movement, 'cost', cost)
+        valued_until[item_id] = getattr(item_movements[-1], VALUED_MOVEMENTS[type(item_movements[-1])][2])
+    save_layers(connection, family, layers)
+    save_costs(connection, costs)
+    save_valuation_state(connection, family, method, valued_until)
+
+
+def revalue_items(connection, method, family, item_ids):
+    # Builds the layers and the costs of the items again from their whole history: one query per movement table
+    # reads it, the replay runs in memory and the layers, the costs that changed and the state are written in bulk.
+    # The variance reports of the stages whose exits cost changed are marked stale. Returns the costs changed,
+    # {model: {movement_id: cost}}.
+    item_column, movements = INVENTORY_FAMILIES[family]
+    history = defaultdict(list)
+    for model in movements:
+        table = model.__table__
+        for movement in connection.execute(select(table).where(table.c[item_column].in_(item_ids))).mappings():
+            history[movement[item_column]].append((movement_order(model, movement[VALUED_MOVEMENTS[model][2]], movement['id']), model, movement))
+
+    prices = catalog_prices(connection, family, item_ids)
+    layers = {item_id: defaultdict(list) for item_id in item_ids}
+    costs = defaultdict(dict)
+    changed_concepts = set()
+    valued_until = {}
+    for item_id in item_ids:
+        item_history = sorted(history[item_id], key=lambda valued: valued[0])
+        for order, model, movement in item_history:
+            cost = value_movement(layers[item_id], method, model, movement, prices.get(item_id))
+            if cost is not None and cost != movement['cost']:
+                costs[model][movement['id']] = cost
+                if 'concept_id' in movement:
+                    changed_concepts.add(movement['concept_id'])
+        valued_until[item_id] = item_history[-1][0][0] if item_history else None
+
+    save_layers(connection, family, layers)
+    save_costs(connection, costs)
+    save_valuation_state(connection, family, method, valued_until)
+
+    # Exits charged another cost change the actuals of the variance reports of their stages
+    if changed_concepts:
+        mark_variance_reports_stale(connection, VarianceReport.stage_id.in_(
+            select(Phase.stage_id).join(Concept, Concept.phase_id == Phase.id).where(Concept.id.in_(changed_concepts))
+        ))
+    return costs
+
+
+def revalue_in_session(session, method, items):
+    # Revalues {(family, item_id)} in the transaction of a session, the movements loaded get their new cost
+    by_family = defaultdict(list)
+    for family, item_id in items:
+        if item_id is not None:
+            by_family[family].append(item_id)
+
+    connection = session.connection()
+    changed = {}
+    for family, item_ids in by_family.items():
+        item_ids.sort()
+        for start in range(0, len(item_ids), REVALUATION_BATCH):
+            for model, movement_costs in revalue_items(connection, method, family, item_ids[start:start + REVALUATION_BATCH]).items():
+                changed.update({(model, movement_id): cost for movement_id, cost in movement_costs.items()})
+
+    for instance in list(session.identity_map.values()):
+        key = (type(instance), getattr(instance, 'id', None))
+        if key in changed:
+            set_committed_value(instance, 'cost', changed[key])
+    return changed
+
+
+def watch_valuation():
+    # Values the movements in the transaction of their flush. New movements posted in date order consume and add
+    # layers right away and their cost is saved. A movement older than the last one valued, or any change or
+    # deletion, revalues the item from its history in the same flush, so reads never have to.
+    watched_keys = {}
+    for model, (family, item_column, date_column, locations) in VALUED_MOVEMENTS.items():
+        watched_keys[model] = [item_column, 'quantity', date_column] + [location_column for sign, location_column in locations]
+        if is_receipt(model):
+            watched_keys[model].append('price')
+        for key in watched_keys[model]:
+            event.listen(getattr(model, key), 'set', keep_previous_value, active_history=True)
+
+    @event.listens_for(Session, 'after_flush')
+    def value_movements(session, flush_context):
+        new_movements = defaultdict(list)
+        stale_items = set()
+        for instance in session.new:
+            if type(instance) in VALUED_MOVEMENTS:
+                family, item_column = VALUED_MOVEMENTS[type(instance)][:2]
+                new_movements[(family, getattr(instance, item_column))].append(instance)
+        for instance in session.dirty:
+            if type(instance) in VALUED_MOVEMENTS:
+                state = inspect(instance)
+                if any(state.attrs[key].history.has_changes() for key in watched_keys[type(instance)]):
+                    family, item_column = VALUED_MOVEMENTS[type(instance)][:2]
+                    stale_items.add((family, attribute_value(instance, item_column, previous=True)))
+                    stale_items.add((family, attribute_value(instance, item_column, previous=False)))
+        for instance in session.deleted:
+            if type(instance) in VALUED_MOVEMENTS:
+                family, item_column = VALUED_MOVEMENTS[type(instance)][:2]
+                stale_items.add((family, attribute_value(instance, item_column, previous=True)))
+
+        if not new_movements and not stale_items:
+            return
+
+        connection = session.connection()
+        method = valuation_method()
+        states = {}
+        if new_movements:
+            table = ItemValuation.__table__
+            states = {
+                (state.family, state.item_id): state
+                for state in connection.execute(
+                    select(table).where(
+                        tuple_(table.c.family, table.c.item_id).in_(list(new_movements))
+                    )
+                )
+            }
+
+        posted = defaultdict(dict)
+        for (family, item_id), movements in new_movements.items():
+            if (family, item_id) in stale_items:
+                continue
+            movements.sort(key=lambda movement: movement_order(type(movement), getattr(movement, VALUED_MOVEMENTS[type(movement)][2]), movement.id))
+            first_date = getattr(movements[0], VALUED_MOVEMENTS[type(movements[0])][2])
+            state = states.get((family, item_id))
+            if state is not None and (state.is_stale or state.method != method or state.valued_until and first_date < state.valued_until):
+                stale_items.add((family, item_id))
+            else:
+                posted[family][item_id] = movements
+
+        for family, movements in posted.items():
+            post_movements(connection, method, family, movements)
+        if stale_items:
+            revalue_in_session(session, method, stale_items)
+
+
+def revalue_stale_items(everything=False):
+    # Revalues the items marked stale or valued with another method, or every item with movements, returns how
+    # many were revalued. Run by the value-inventory command, e.g. after VALUATION_METHOD changes.
+    method = valuation_method()
+    if everything:
+        items = set()
+        for family, (item_column, movements) in INVENTORY_FAMILIES.items():
+            for model in movements:
+                items.update((family, item_id) for item_id, in db.session.query(getattr(model, item_column)).distinct())
+    else:
+        items = set(db.session.query(
+            ItemValuation.family,
+            ItemValuation.item_id
+        ).filter(
+            ItemValuation.is_stale.is_(True) | (ItemValuation.method != method)
+        ).all())
+
+    if not items:
+        return 0
+
+    revalue_in_session(db.session, method, items)
+    db.session.commit()
+    return len(items)
+
+
+def inventory_values(family, as_of_date=None, location_id=None):
+    # {(item_id, location_id): value} on hand at the end of a date, one grouped query over the movement costs:
+    # receipts add quantity * price, moves and exits take their cost from the source and moves add it to the
+    # destination.
+    item_column, movements = INVENTORY_FAMILIES[family]
+    selects = []
+    for model, (date_column, locations) in movements.items():
+        movement_value = model.quantity * model.price if is_receipt(model) else func.coalesce(model.cost, 0)
+        for sign, location_column in locations:
+            movement_location = getattr(model, location_column)
+            criteria = [movement_location.isnot(None)]
+            if as_of_date is not None:
+                criteria.append(getattr(model, date_column) <= as_of_date)
+            if location_id is not None:
+                criteria.append(movement_location == location_id)
+            selects.append(
+                select(
+                    getattr(model, item_column).label('item_id'),
+                    movement_location.label('location_id'),
+                    (literal(sign) * movement_value).label('value')
+                ).where(*criteria)
+            )
+    values = union_all(*selects).subquery()
+    rows = db.session.query(
+        values.c.item_id,
+        values.c.location_id,
+        func.sum(values.c.value)
+    ).group_by(
+        values.c.item_id,
+        values.c.location_id
+    ).all()
+    return {(item_id, location_id): value for item_id, location_id, value in rows if value and abs(value) > 1e-9}
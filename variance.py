@@ -0,0 +1,260 @@
+import json
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, inspect, select, update, delete, func, extract, or_
+from sqlalchemy.orm import Session
+from models import db, Stage, Phase, Concept, Material, Tool, Job, Machinery, MatGenerator, MoGenerator, MaqGenerator, HerGenerator, MaterialExit, ToolExit, MaqRental, JobsHistory, VarianceReport
+from stock_ledger import DIALECT_INSERTS
+
+
+# Cost families of the report: catalog, generator with the budgeted quantities and the model of the actuals,
+# both with their catalog column.
+VARIANCE_FAMILIES = {
+    'material': (Material, MatGenerator, 'material_id', MaterialExit, 'material_id'),
+    'machinery': (Machinery, MaqGenerator, 'machinery_id', MaqRental, 'machinery_id'),
+    'labour': (Job, MoGenerator, 'job_id', JobsHistory, 'job_id'),
+    'tools': (Tool, HerGenerator, 'tool_id', ToolExit, 'tool_id'),
+}
+ACTUAL_MODELS = {actual: family for family, (catalog, generator, generator_column, actual, actual_column) in VARIANCE_FAMILIES.items()}
+GENERATOR_MODELS = {generator: family for family, (catalog, generator, generator_column, actual, actual_column) in VARIANCE_FAMILIES.items()}
+CATALOG_MODELS = {catalog: family for family, (catalog, generator, generator_column, actual, actual_column) in VARIANCE_FAMILIES.items()}
+
+# Types of the concept rows shown in the variance table, in the order of the row keys
+VARIANCE_COLUMN_TYPES = [str, str, str, str, str, float, float, float, float, float, float]
+
+
+def rental_days(dialect_name):
+    # Length of the machinery rentals in days, the unit the machinery is budgeted in
+    if dialect_name == 'postgresql':
+        return extract('epoch', MaqRental.end_date - MaqRental.start_date) / 86400
+    return func.julianday(MaqRental.end_date) - func.julianday(MaqRental.start_date)
+
+
+def actual_columns(family, dialect_name):
+    # (quantity, cost) of the actuals of a family. Exits cost what the valuation charged them, rentals and
+    # jobs are priced at the catalog.
+    catalog, generator, generator_column, actual, actual_column = VARIANCE_FAMILIES[family]
+    if actual is MaqRental:
+        quantity = rental_days(dialect_name)
+        return quantity, quantity * catalog.price
+    if actual is JobsHistory:
+        return actual.quantity, actual.quantity * catalog.price
+    return actual.quantity, func.coalesce(actual.cost, actual.quantity * catalog.price)
+
+
+def grouped_totals(model, item_column, catalog, quantity, cost, stage_id):
+    # One grouped query per table: {(concept_id, item name): (quantity, cost)} of the concepts of a stage
+    rows = db.session.query(
+        model.concept_id,
+        catalog.name,
+        func.sum(quantity),
+        func.sum(cost)
+    ).join(
+        catalog, catalog.id == getattr(model, item_column)
+    ).join(
+        Concept, Concept.id == model.concept_id
+    ).join(
+        Phase, Phase.id == Concept.phase_id
+    ).filter(
+        Phase.stage_id == stage_id
+    ).group_by(
+        model.concept_id,
+        catalog.name
+    ).all()
+    return {(concept_id, item): (quantity or 0, cost or 0) for concept_id, item, quantity, cost in rows}
+
+
+def cost_totals(rows, families=VARIANCE_FAMILIES):
+    totals = {}
+    for family in families:
+        budget = sum(row['budget cost'] for row in rows if row['family'] == family)
+        actual = sum(row['actual cost'] for row in rows if row['family'] == family)
+        totals.update({f'{family} budget': budget, f'{family} actual': actual, f'{family} variance': actual - budget})
+    budget = sum(row['budget cost'] for row in rows)
+    actual = sum(row['actual cost'] for row in rows)
+    totals.update({'budget': budget, 'actual': actual, 'variance': actual - budget})
+    return totals
+
+
+def build_variance_report(stage_id):
+    # Budget from the generators against the actuals per concept and item, rolled up by phase and for the stage.
+    # Two grouped queries per family, whatever the number of concepts.
+    dialect_name = db.engine.dialect.name
+    concepts = {
+        concept_id: (phase_id, phase_code, code, name)
+        for concept_id, phase_id, phase_code, code, name in db.session.query(
+            Concept.id,
+            Phase.id,
+            Phase.code,
+            Concept.code,
+            Concept.name
+        ).join(
+            Phase, Phase.id == Concept.phase_id
+        ).filter(
+            Phase.stage_id == stage_id
+        ).order_by(
+            Phase.id,
+            Concept.id
+        ).all()
+    }
+
+    rows = []
+    for family, (catalog, generator, generator_column, actual, actual_column) in VARIANCE_FAMILIES.items():
+        budget = grouped_totals(generator, generator_column, catalog, generator.quantity, generator.quantity * catalog.price, stage_id)
+        actuals = grouped_totals(actual, actual_column, catalog, *actual_columns(family, dialect_name), stage_id)
+        for concept_id, item in budget.keys() | actuals.keys():
+            phase_id, phase_code, code, name = concepts[concept_id]
+            budget_quantity, budget_cost = budget.get((concept_id, item), (0, 0))
+            actual_quantity, actual_cost = actuals.get((concept_id, item), (0, 0))
+            rows.append({
+                'phase_id': phase_id,
+                'concept_id': concept_id,
+                'phase': phase_code,
+                'code': code,
+                'name': name,
+                'family': family,
+                'item': item,
+                'budget quantity': budget_quantity,
+                'actual quantity': actual_quantity,
+                'quantity variance': actual_quantity - budget_quantity,
+                'budget cost': budget_cost,
+                'actual cost': actual_cost,
+                'cost variance': actual_cost - budget_cost,
+            })
+    concept_order = {concept_id: position for position, concept_id in enumerate(concepts)}
+    rows.sort(key=lambda row: (concept_order[row['concept_id']], list(VARIANCE_FAMILIES).index(row['family']), row['item']))
+
+    phase_rows = defaultdict(list)
+    for row in rows:
+        phase_rows[(row['phase_id'], row['phase'])].append(row)
+    phases = [
+        {'phase_id': phase_id, 'phase': phase_code, **cost_totals(rows_of_phase)}
+        for (phase_id, phase_code), rows_of_phase in phase_rows.items()
+    ]
+    return {'stage_id': stage_id, 'concepts': rows, 'phases': phases, 'stage': cost_totals(rows)}
+
+
+def mark_variance_reports_stale(connection, *criteria):
+    connection.execute(update(VarianceReport.__table__).where(*criteria).values(is_stale=True))
+
+
+def stage_variance_report(stage_id):
+    # The cached report of a stage, built again when it is missing or stale
+    cached = db.session.query(
+        VarianceReport.report
+    ).filter(
+        VarianceReport.stage_id == stage_id,
+        VarianceReport.is_stale.is_(False)
+    ).scalar()
+    if cached is not None:
+        return json.loads(cached)
+
+    # Upserted, two requests building the report of a stage at once both write instead of one failing on the key
+    report = build_variance_report(stage_id)
+    statement = DIALECT_INSERTS[db.engine.dialect.name](VarianceReport.__table__).values(
+        stage_id=stage_id, report=json.dumps(report), created_at=datetime.now(), is_stale=False
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=['stage_id'],
+        set_={key: statement.excluded[key] for key in ('report', 'created_at', 'is_stale')}
+    )
+    db.session.execute(statement)
+    db.session.commit()
+    return report
+
+
+def concept_actual_vs_budget(stage_id):
+    # Materials and tools budgeted for every concept of a stage against the cost of their exits, from the variance
+    # report so both price the tools budget the same way: HerGenerator quantities at the catalog price.
+    report = stage_variance_report(stage_id)
+    totals = defaultdict(lambda: {family: [0, 0] for family in ('material', 'tools')})
+    for row in report['concepts']:
+        if row['family'] in ('material', 'tools'):
+            totals[row['concept_id']][row['family']][0] += row['budget cost']
+            totals[row['concept_id']][row['family']][1] += row['actual cost']
+
+    concepts = db.session.query(
+        Concept.id,
+        Concept.code,
+        Concept.name
+    ).join(
+        Phase, Phase.id == Concept.phase_id
+    ).filter(
+        Phase.stage_id == stage_id
+    ).order_by(
+        Phase.id,
+        Concept.id
+    ).all()
+
+    rows = []
+    for concept_id, code, name in concepts:
+        material_budget, material_actual = totals[concept_id]['material']
+        tools_budget, tools_actual = totals[concept_id]['tools']
+        rows.append({
+            'concept_id': concept_id,
+            'code': code,
+            'name': name,
+            'material budget': material_budget,
+            'material actual': material_actual,
+            'material variance': material_actual - material_budget,
+            'tools budget': tools_budget,
+            'tools actual': tools_actual,
+            'tools variance': tools_actual - tools_budget,
+        })
+    return rows
+
+
+def variance_dataframe(report):
+    # Concept rows of a report for the filtering table
+    import pandas as pd
+    columns = ['phase', 'code', 'name', 'family', 'item', 'budget quantity', 'actual quantity', 'quantity variance', 'budget cost', 'actual cost', 'cost variance']
+    return pd.DataFrame(report['concepts'], columns=columns)
+
+
+def watch_variance_sources():
+    # Marks stale the cached reports of the stages whose generators, exits, rentals, jobs or concepts change,
+    # and every report when a catalog price or name changes.
+    @event.listens_for(Session, 'before_flush')
+    def collect_stale_variance_reports(session, flush_context, instances):
+        stale = session.info.setdefault('stale_variance', {'concepts': set(), 'phases': set(), 'stages': set(), 'all': False})
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            model = type(instance)
+            if model in ACTUAL_MODELS or model in GENERATOR_MODELS:
+                # Both the current and the previous concept if the record was moved
+                stale['concepts'].update(concept_id for concept_id in inspect(instance).attrs['concept_id'].history.sum() if concept_id is not None)
+            elif model is Concept and instance not in session.new:
+                stale['phases'].update(phase_id for phase_id in inspect(instance).attrs['phase_id'].history.sum() if phase_id is not None)
+            elif model is Phase and instance not in session.new:
+                stale['stages'].update(stage_id for stage_id in inspect(instance).attrs['stage_id'].history.sum() if stage_id is not None)
+            elif model is Stage and instance in session.deleted:
+                # The cached report has to go before the stage it references
+                session.connection().execute(
+                    delete(VarianceReport.__table__).where(VarianceReport.stage_id == instance.id)
+                )
+            elif model in CATALOG_MODELS and instance in session.dirty:
+                state = inspect(instance)
+                stale['all'] = stale['all'] or any(state.attrs[key].history.has_changes() for key in ('price', 'name'))
+
+    @event.listens_for(Session, 'after_flush')
+    def mark_stale_variance_reports(session, flush_context):
+        stale = session.info.pop('stale_variance', None)
+        if not stale:
+            return
+
+        if stale['all']:
+            mark_variance_reports_stale(session.connection())
+            return
+
+        conditions = []
+        if stale['concepts']:
+            conditions.append(VarianceReport.stage_id.in_(
+                select(Phase.stage_id).join(Concept, Concept.phase_id == Phase.id).where(Concept.id.in_(stale['concepts']))
+            ))
+        if stale['phases']:
+            conditions.append(VarianceReport.stage_id.in_(
+                select(Phase.stage_id).where(Phase.id.in_(stale['phases']))
+            ))
+        if stale['stages']:
+            conditions.append(VarianceReport.stage_id.in_(stale['stages']))
+        if conditions:
+            mark_variance_reports_stale(session.connection(), or_(*conditions))